@@ -0,0 +1,35 @@
+"""Bring the database up to the current layout, once per deployment.
+
+    python -m app.cli.migrate
+
+Creates the indexes and moves data written by older versions: sessions with
+raw tokens are dropped, embedded group `members` and room `messages` arrays
+move into their collections, and groups and DMs get their unique keys. These
+are full scans, so the app does not run them on startup; it only creates
+missing indexes. Every step skips what is already done, so the command can be
+re-run, and run while the app is serving.
+
+Uses the database configured in the environment (MONGO_URI / MONGO_DB).
+"""
+import argparse
+import asyncio
+import time
+from ..utils.db import connect, close
+from ..utils.repositories import migrate
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli.migrate", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args(argv)
+    started = time.monotonic()
+    connect()
+    try:
+        await migrate()
+    finally:
+        close()
+    print(f"migrate finished in {time.monotonic() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
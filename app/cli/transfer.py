@@ -0,0 +1,296 @@
+"""Stream chat data to and from NDJSON files (one Extended JSON document per line).
+
+    python -m app.cli.transfer export --dir backup/ [--compress zstd] [--collections users,messages]
+    python -m app.cli.transfer import --dir backup/ [--resume]
+
+Export reads each collection in `_id` order through a batched cursor; import
+writes unordered bulk upserts keyed by `_id`, so re-running a batch is
+harmless. Collections are processed in parallel. Progress is recorded in
+`<dir>/checkpoint.<command>.json` after every batch; `--resume` continues an
+interrupted run of the same command from there. Memory use is bounded by the batch size, not by
+the size of a collection. After importing `messages` the search index
+(`message_search`) is rebuilt from them; that pass is idempotent too.
+
+Uses the database configured in the environment (MONGO_URI / MONGO_DB).
+Compression needs the optional `zstandard` package.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from typing import Optional
+from bson import json_util
+from bson.codec_options import CodecOptions
+from pymongo import ReplaceOne
+from ..utils.db import connect, close
+from ..utils.repositories import (
+    UserRepository,
+    GroupRepository,
+    GroupMemberRepository,
+    ConversationRepository,
+    MessageRepository,
+    MessageArchiveRepository,
+    MessageSearchRepository,
+    AiSessionRepository,
+    ensure_indexes,
+)
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed for --compress zstd
+    zstandard = None
+
+COLLECTIONS = {
+    "users": lambda: UserRepository().col,
+    "groups": lambda: GroupRepository().col,
+    "group_members": lambda: GroupMemberRepository().col,
+    "conversations": lambda: ConversationRepository().col,
+    "messages": lambda: MessageRepository().col,
+    "message_archive": lambda: MessageArchiveRepository().col,
+    "ai_sessions": lambda: AiSessionRepository().col,
+}
+
+# the app decodes documents JSON-ready (ObjectId/datetime as strings); a dump needs the real BSON types back
+RAW_CODEC_OPTIONS = CodecOptions()
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+
+
+def _collection(name: str):
+    return COLLECTIONS[name]().with_options(codec_options=RAW_CODEC_OPTIONS)
+
+
+def _data_file(directory: str, name: str) -> Optional[str]:
+    for suffix in (".ndjson.zst", ".ndjson"):
+        path = os.path.join(directory, name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class Checkpoint:
+    """Per-collection progress, rewritten atomically after every batch.
+    Export and import keep separate files, so importing from a directory never
+    picks up the offsets of the export that wrote it (or the other way round)."""
+
+    def __init__(self, directory: str, command: str, resume: bool):
+        self.path = os.path.join(directory, f"checkpoint.{command}.json")
+        self.state: dict = {}
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+
+    def get(self, name: str) -> dict:
+        return self.state.get(name, {})
+
+    def set(self, name: str, progress: dict):
+        self.state[name] = progress
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+class Progress:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.docs: dict[str, int] = {}
+        self.bytes: dict[str, int] = {}
+        self.done: set[str] = set()
+
+    def add(self, name: str, docs: int, nbytes: int):
+        self.docs[name] = self.docs.get(name, 0) + docs
+        self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        for name in sorted(self.docs):
+            state = "done" if name in self.done else "running"
+            print(f"  {name:<14} {self.docs[name]:>13,} docs  {self.docs[name] / elapsed:>10,.0f} docs/s  "
+                  f"{self.bytes[name] / elapsed / 1e6:>7.1f} MB/s  {state}")
+        total = sum(self.docs.values())
+        print(f"  {'total':<14} {total:>13,} docs  {total / elapsed:>10,.0f} docs/s  {elapsed:8.1f} s", flush=True)
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.report()
+
+
+# --- export ---
+
+def _write(f, payload: bytes, compressor) -> int:
+    # with zstd every batch is its own frame, so a resumed export can simply append
+    f.write(compressor.compress(payload) if compressor else payload)
+    f.flush()
+    return f.tell()
+
+
+async def export_collection(name: str, directory: str, compress: bool, batch_size: int,
+                            checkpoint: Checkpoint, progress: Progress):
+    col = _collection(name)
+    path = os.path.join(directory, name + (".ndjson.zst" if compress else ".ndjson"))
+    state = checkpoint.get(name)
+    if state.get("done"):
+        progress.done.add(name)
+        return
+    query = {}
+    offset = 0
+    if state.get("last_id"):
+        # drop whatever was written after the last checkpoint and continue from there
+        query = {"_id": {"$gt": json_util.loads(state["last_id"])}}
+        offset = state["offset"]
+    compressor = zstandard.ZstdCompressor(level=3) if compress else None
+    exported = state.get("docs", 0)
+
+    f = open(path, "r+b" if offset else "wb")
+    try:
+        f.truncate(offset)
+        f.seek(offset)
+        cursor = col.find(query).sort("_id", 1).batch_size(batch_size)
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                offset, exported = await _flush_export(name, f, batch, compressor, offset, exported, checkpoint, progress)
+                batch = []
+        if batch:
+            offset, exported = await _flush_export(name, f, batch, compressor, offset, exported, checkpoint, progress)
+    finally:
+        f.close()
+    checkpoint.set(name, {**checkpoint.get(name), "docs": exported, "offset": offset, "done": True})
+    progress.done.add(name)
+
+
+async def _flush_export(name, f, batch, compressor, offset, exported, checkpoint, progress):
+    def encode_and_write():
+        payload = "".join(json_util.dumps(d, json_options=JSON_OPTIONS) + "\n" for d in batch).encode()
+        return len(payload), _write(f, payload, compressor)
+
+    nbytes, new_offset = await asyncio.to_thread(encode_and_write)
+    exported += len(batch)
+    checkpoint.set(name, {"last_id": json_util.dumps(batch[-1]["_id"]), "offset": new_offset, "docs": exported})
+    progress.add(name, len(batch), nbytes)
+    return new_offset, exported
+
+
+# --- import ---
+
+def _open_reader(path: str, offset: int):
+    f = open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise SystemExit(f"{path} is zstd-compressed: pip install zstandard")
+        return f, io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True))
+    f.seek(offset)
+    return f, f
+
+
+def _read_batch(reader, batch_size: int) -> tuple[list, int]:
+    docs, nbytes = [], 0
+    for line in reader:
+        nbytes += len(line)
+        if line.strip():
+            docs.append(json_util.loads(line, json_options=JSON_OPTIONS))
+        if len(docs) >= batch_size:
+            break
+    return docs, nbytes
+
+
+def _skip_lines(reader, count: int):
+    for _ in range(count):
+        if not reader.readline():
+            break
+
+
+async def import_collection(name: str, directory: str, batch_size: int, checkpoint: Checkpoint, progress: Progress):
+    path = _data_file(directory, name)
+    if path is None:
+        print(f"  {name}: no export file, skipped")
+        return
+    state = checkpoint.get(name)
+    if state.get("done"):
+        progress.done.add(name)
+        return
+    col = _collection(name)
+    lines, offset = state.get("lines", 0), state.get("offset", 0)
+    f, reader = _open_reader(path, offset)
+    try:
+        if path.endswith(".zst") and lines:
+            await asyncio.to_thread(_skip_lines, reader, lines)
+        while True:
+            docs, nbytes = await asyncio.to_thread(_read_batch, reader, batch_size)
+            if not docs:
+                break
+            # upserts by _id: replaying a batch after an interruption does not duplicate anything
+            await col.bulk_write([ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in docs], ordered=False)
+            lines += len(docs)
+            offset += nbytes
+            checkpoint.set(name, {"lines": lines, "offset": offset})
+            progress.add(name, len(docs), nbytes)
+    finally:
+        f.close()
+    checkpoint.set(name, {"lines": lines, "offset": offset, "done": True})
+    progress.done.add(name)
+
+
+# --- entry point ---
+
+async def _run_all(jobs, parallel: int):
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def limited(job):
+        async with semaphore:
+            await job
+
+    await asyncio.gather(*(limited(job) for job in jobs))
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli.transfer", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("--dir", required=True, help="directory holding <collection>.ndjson[.zst] files")
+    parser.add_argument("--collections", default=",".join(COLLECTIONS), help="comma-separated subset")
+    parser.add_argument("--compress", choices=["none", "zstd"], default="none", help="export compression")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--parallel", type=int, default=4, help="collections processed at the same time")
+    parser.add_argument("--resume", action="store_true", help="continue from <dir>/checkpoint.<command>.json")
+    parser.add_argument("--progress", type=float, default=10.0, help="seconds between throughput reports")
+    parser.add_argument("--skip-indexes", action="store_true", help="import: do not ensure indexes afterwards")
+    args = parser.parse_args(argv)
+
+    names = [n.strip() for n in args.collections.split(",") if n.strip()]
+    unknown = [n for n in names if n not in COLLECTIONS]
+    if unknown:
+        parser.error(f"unknown collections: {', '.join(unknown)}")
+    if args.compress == "zstd" and zstandard is None:
+        parser.error("--compress zstd needs the zstandard package (pip install zstandard)")
+
+    os.makedirs(args.dir, exist_ok=True)
+    checkpoint = Checkpoint(args.dir, args.command, args.resume)
+    progress = Progress()
+    connect()
+    reporter = asyncio.get_running_loop().create_task(progress.run(args.progress))
+    try:
+        if args.command == "export":
+            jobs = [export_collection(n, args.dir, args.compress == "zstd", args.batch_size, checkpoint, progress)
+                    for n in names]
+        else:
+            jobs = [import_collection(n, args.dir, args.batch_size, checkpoint, progress) for n in names]
+        await _run_all(jobs, args.parallel)
+        if args.command == "import" and not args.skip_indexes:
+            await ensure_indexes()
+        if args.command == "import" and "messages" in names:
+            indexed = await MessageSearchRepository().backfill(MessageRepository(), args.batch_size)
+            print(f"  search index: {indexed:,} messages checked")
+    finally:
+        reporter.cancel()
+        close()
+    print(f"{args.command} finished")
+    progress.report()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
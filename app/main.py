@@ -1,15 +1,27 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from .utils.config import settings
-from .utils.db import connect, close
+from .utils.db import connect, close, warm_up, db
+from .utils.repositories import ensure_indexes
+from .utils import background
+from .utils.rate_limit import rate_limiter
+from .utils.metrics import metrics
+from .utils.overload import overload, InflightMiddleware
+from .services import ai_loader
+from .services import retention_service  # noqa: F401  (registers the retention job)
+import asyncio
+import hmac
 from .routers import auth, chat
 from .utils.socketio_server import sio
 from socketio import ASGIApp as SocketIOASGIApp
 from fastapi.openapi.models import APIKey
 from fastapi.openapi.utils import get_openapi
 from .utils.deps import get_current_user_from_cookie
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from .utils.utils import FastJSONResponse
+from fastapi.responses import Response
+from .utils.assets import assets
+import json
 
 api_key_scheme = APIKey(name="Authorization", scheme_name="Bearer", type="apiKey", **{"in": "header"})
 
@@ -18,6 +30,7 @@ def create_app() -> FastAPI:
     app = FastAPI(
         title=settings.app_name,
         debug=settings.debug,
+        default_response_class=FastJSONResponse,
     )
 
     # Add CORS middleware to allow cross-origin requests from the frontend
@@ -30,12 +43,31 @@ def create_app() -> FastAPI:
         allow_headers=["*"],  # Allows all headers
     )
 
+    # Compress large API responses (static pages are served precompressed, streams are skipped)
+    app.add_middleware(GZipMiddleware, minimum_size=settings.gzip_minimum_size)
+    # outermost, so the count covers everything including streamed responses
+    app.add_middleware(InflightMiddleware)
+
     @app.on_event("startup")
     async def startup():
         connect()
+        assets.load("static")
+        try:
+            await warm_up()
+        except Exception as e:
+            print(f"Database warm-up failed: {e}")
+        try:
+            await ensure_indexes()
+            await rate_limiter.store.ensure_indexes()
+        except Exception as e:
+            print(f"Could not ensure database indexes: {e}")
+        background.start_all()
+        if settings.ai_warmup:
+            asyncio.get_running_loop().create_task(ai_loader.warm_up())
 
     @app.on_event("shutdown")
     async def shutdown():
+        await background.stop_all()
         close()
 
     # Routers that do NOT require auth by default
@@ -62,18 +94,57 @@ def create_app() -> FastAPI:
         return app.openapi_schema
     app.openapi = custom_openapi
 
+    # Health check for the load balancer: only passes once the database pool is warm.
+    # The shed level is reported in the body and in X-Overload-Level so the balancer can
+    # lower the weight of a worker that is already degrading.
+    @app.get("/healthz", include_in_schema=False)
+    async def healthz():
+        headers = {"X-Overload-Level": str(overload.level)}
+        if not db.ready:
+            try:
+                await warm_up()
+            except Exception as e:
+                return FastJSONResponse({"status": "starting", "database": str(e)}, status_code=503, headers=headers)
+        return FastJSONResponse({"status": "ok", "overload": overload.status()}, headers=headers)
+
+    # Process-local metrics (queue depths, buffers, limiter rejections) as JSON;
+    # not served at all unless METRICS_TOKEN is configured
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_snapshot(request: Request):
+        if not settings.metrics_token:
+            raise HTTPException(status_code=404, detail="Not found")
+        expected = f"Bearer {settings.metrics_token}".encode()
+        if not hmac.compare_digest(request.headers.get("authorization", "").encode(), expected):
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        return metrics.snapshot()
+
+    # Client-side settings the static pages need before opening the socket
+    @app.get("/client-config.js", include_in_schema=False)
+    async def client_config():
+        config = {"socketSerializer": settings.socketio_serializer}
+        return Response(f"window.CHAT_CONFIG = {json.dumps(config)};", media_type="application/javascript")
+
+    def serve_asset(request: Request, name: str):
+        asset = assets.get(name)
+        if asset is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        return assets.response(request, asset)
+
     # Serve chat.html at the /chat endpoint
     @app.get("/chat")
-    async def serve_chat():
-        return FileResponse("static/chat.html")
+    async def serve_chat(request: Request):
+        return serve_asset(request, "chat.html")
 
     # Serve index.html at the root endpoint
     @app.get("/", include_in_schema=False)
-    async def serve_index():
-        return FileResponse("static/index.html")
-
-    # Mount the static directory for CSS, JS, etc.
-    app.mount("/", StaticFiles(directory="static"), name="static")
+    async def serve_index(request: Request):
+        return serve_asset(request, "index.html")
+
+    # Everything else in the static directory (chat.html, index.html, ...), from memory as well;
+    # registered last so it never shadows an API route
+    @app.api_route("/{name:path}", methods=["GET", "HEAD"], include_in_schema=False)
+    async def serve_static(name: str, request: Request):
+        return serve_asset(request, name)
 
     return app
 
@@ -2,7 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, status, Request
 from fastapi.responses import JSONResponse
 from datetime import datetime, timedelta
 import logging
-from ..utils.utils import normalize_doc
+from ..utils.utils import FastJSONResponse
 from ..utils.models import (
     SignupPayload,
     LoginPayload,
@@ -16,12 +16,24 @@ from ..utils.models import (
 logger = logging.getLogger(__name__)
 from ..services.auth_service import AuthService
 from ..utils.config import settings
+from ..utils.rate_limit import rate_limit
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 auth = AuthService()
 
 
-@router.post("/signup")
+def _set_token_cookies(resp, tokens: dict) -> int:
+    """Set tokens as secure, https-only cookies (access token short-lived, refresh longer).
+    Returns the access cookie max-age."""
+    access_max_age = int(getattr(settings, "access_token_expires_seconds", 15 * 60))
+    refresh_max_age = int(getattr(settings, "refresh_token_expires_seconds", 7 * 24 * 3600))
+    # Set HttpOnly cookies for tokens with SameSite=None for cross-origin requests
+    resp.set_cookie("access_token", tokens.get("access_token"), max_age=access_max_age, secure=not settings.debug, httponly=True, samesite="lax")
+    resp.set_cookie("refresh_token", tokens.get("refresh_token"), max_age=refresh_max_age, secure=not settings.debug, httponly=True, samesite="lax")
+    return access_max_age
+
+
+@router.post("/signup", dependencies=[Depends(rate_limit("auth.signup"))])
 async def signup(payload: SignupPayload):
     try:
         user = await auth.signup(payload.username, payload.email, payload.password)
@@ -30,7 +42,7 @@ async def signup(payload: SignupPayload):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@router.post("/login")
+@router.post("/login", dependencies=[Depends(rate_limit("auth.login"))])
 async def login(payload: LoginPayload):
     try:
         r = await auth.login(payload.email, payload.password)
@@ -40,12 +52,9 @@ async def login(payload: LoginPayload):
         except Exception:
             pass
         # set tokens as secure, https-only cookies (access token short-lived, refresh longer)
-        resp = JSONResponse(content=normalize_doc(r, exclude={"password_hash"}))
-        access_max_age = int(getattr(settings, "access_token_expires_seconds", 15 * 60))
-        refresh_max_age = int(getattr(settings, "refresh_token_expires_seconds", 7 * 24 * 3600))
-        # Set HttpOnly cookies for tokens with SameSite=None for cross-origin requests
-        resp.set_cookie("access_token", r.get("access_token"), max_age=access_max_age, secure=not settings.debug, httponly=True, samesite="lax")
-        resp.set_cookie("refresh_token", r.get("refresh_token"), max_age=refresh_max_age, secure=not settings.debug, httponly=True, samesite="lax")
+        # the user document is already JSON-ready and sanitized by AuthService.login
+        resp = FastJSONResponse(content=r)
+        access_max_age = _set_token_cookies(resp, r)
         # user id available to JS (not HttpOnly) so UI can show current user; keep it minimal
         user = r.get("user") or {}
         if user and user.get("_id"):
@@ -55,12 +64,20 @@ async def login(payload: LoginPayload):
         raise HTTPException(status_code=401, detail=str(e))
 
 
-@router.post("/refresh")
-async def refresh(payload: RefreshPayload):
+@router.post("/refresh", dependencies=[Depends(rate_limit("auth.refresh"))])
+async def refresh(payload: RefreshPayload = None, request: Request = None):
+    # accept refresh token either from payload or from cookie
+    token = payload.refresh_token if payload and payload.refresh_token else request.cookies.get("refresh_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="invalid_refresh")
     try:
-        return await auth.refresh(payload.refresh_token)
+        r = await auth.refresh(token)
     except ValueError as e:
         raise HTTPException(status_code=401, detail=str(e))
+    # refresh tokens are single use: hand out the rotated one
+    resp = FastJSONResponse(content=r)
+    _set_token_cookies(resp, r)
+    return resp
 
 
 @router.post("/logout")
@@ -81,7 +98,7 @@ async def logout(payload: LogoutPayload = None, request: Request = None):
     return resp
 
 
-@router.post("/forgot-password")
+@router.post("/forgot-password", dependencies=[Depends(rate_limit("auth.forgot_password"))])
 async def forgot_password(payload: ForgotPasswordPayload):
     try:
         await auth.request_password_reset(payload.email)
@@ -97,7 +114,7 @@ async def forgot_password(payload: ForgotPasswordPayload):
             raise HTTPException(status_code=500, detail="Failed to send email.")
 
 
-@router.post("/resend-otp")
+@router.post("/resend-otp", dependencies=[Depends(rate_limit("auth.forgot_password"))])
 async def resend_otp(payload: ResendOTPPayload):
     """Resends the OTP for password reset."""
     try:
@@ -111,7 +128,7 @@ async def resend_otp(payload: ResendOTPPayload):
             raise HTTPException(status_code=500, detail="Failed to send email.")
 
 
-@router.post("/reset-password")
+@router.post("/reset-password", dependencies=[Depends(rate_limit("auth.reset_password"))])
 async def reset_password(payload: ResetPasswordPayload):
     if payload.new_password != payload.confirm_new_password:
         raise HTTPException(status_code=400, detail="Passwords do not match.")
@@ -1,23 +1,42 @@
-from fastapi import APIRouter, Depends, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, Request, HTTPException, Query
+from fastapi.responses import StreamingResponse, Response
 from ..services.chat_service import ChatService
+from ..services.search_service import SearchService
+from ..services.attachment_service import (
+    AttachmentService,
+    AttachmentTooLarge,
+    INLINE_TYPES,
+    parse_range,
+    thumbnailer,
+)
 from typing import Optional, AsyncGenerator
-from ..utils.models import CreateGroupPayload, JoinGroupPayload, AiChatPayload
-from ..services.ai_service import get_ai_response_stream
+from ..utils.models import CreateGroupPayload, JoinGroupPayload, AiChatPayload, RetentionPayload
+from ..services.ai_loader import get_ai_service
 from ..utils.repositories import AiSessionRepository
+from ..utils.utils import FastJSONResponse
+from ..utils.rate_limit import rate_limit
+from ..utils.overload import shed_at, SHED_AI, SHED_READS
+from ..utils.config import settings
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import quote
 import json
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 service = ChatService()
+search_service = SearchService()
+attachments = AttachmentService()
 
 
 @router.post("/groups")
 async def create_group(payload: CreateGroupPayload, request: Request):
     """Create a new group, automatically adding the current user as a member."""
     user_id = request.state.user.get("_id")
-    # Ensure the creator is always in the member list
-    members = list(set(payload.members + [user_id]))
-    group = await service.groups.create({"name": payload.name, "members": members})
+    # The creator is always a member (and the group's owner)
+    try:
+        group = await service.create_group(payload.name, user_id, payload.members)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return group
 
 
@@ -29,27 +48,182 @@ async def join_or_create_group(payload: JoinGroupPayload, request: Request):
     return group
 
 
-@router.get("/groups/{group_id}")
-async def get_group(group_id: str):
-    return await service.groups.find_by_id(group_id)
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match", "")
+    return bool(if_none_match) and ("*" in if_none_match or etag in {t.strip().removeprefix("W/") for t in if_none_match.split(",")})
+
+
+@router.get("/groups/{group_id}", dependencies=[Depends(shed_at(SHED_READS, "group"))])
+async def get_group(group_id: str, request: Request):
+    """A group. Revalidate with `If-None-Match`: an unchanged group is a 304 without a body."""
+    version = await service.groups.version(group_id)
+    if version is None:
+        return FastJSONResponse(None)
+    headers = {"ETag": f'"{version}"', "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    # a fresh read (not joined to one in flight), tagged with the version it carries itself
+    group = await service.groups.find_by_id(group_id, shared=False)
+    if group is None:
+        return FastJSONResponse(None)
+    headers["ETag"] = f'"{group.get("version", 0)}"'
+    return FastJSONResponse(group, headers=headers)
+
+
+@router.get("/groups/{group_id}/members", dependencies=[Depends(shed_at(SHED_READS, "group_members"))])
+async def list_group_members(group_id: str, request: Request, after: Optional[str] = None,
+                             limit: int = Query(50, ge=1, le=200)):
+    """Paginated member list. Pass the returned `next` as `after` to get the following page."""
+    user_id = request.state.user.get("_id")
+    try:
+        page = await service.list_group_members(group_id, user_id, after=after, limit=limit)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Not a member of this group")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse(page)
+
+
+@router.put("/groups/{group_id}/retention")
+async def set_group_retention(group_id: str, payload: RetentionPayload, request: Request):
+    """Archive this group's messages after `retention_days` instead of the global period."""
+    user_id = request.state.user.get("_id")
+    try:
+        await service.set_group_retention(group_id, user_id, payload.retention_days)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Only the group owner can change retention")
+    return {"ok": True, "retention_days": payload.retention_days}
 
 
 @router.delete("/groups/{group_id}")
 async def delete_group(group_id: str, request: Request):
     """Deletes a group. For simplicity, any member can delete."""
     # In a real app, you might want to check for creator/admin privileges.
-    await service.groups.delete(group_id)
+    await service.delete_group(group_id)
     return {"ok": True, "message": "Group deleted"}
 
 
+@router.get("/rooms/{room_id}/messages")
+async def get_room_history(room_id: str, request: Request, before_seq: Optional[int] = None,
+                           limit: Optional[int] = Query(None, ge=1, le=200),
+                           edits_since: Optional[int] = Query(None, ge=0)):
+    """A page of room history, oldest first. Use `before_seq` to page backwards, and `edits_since`
+    (the highest `edit_seq` seen in the room) to also get the edits and deletes made since."""
+    user_id = request.state.user.get("_id")
+    try:
+        return FastJSONResponse(await service.get_history(room_id, user_id, before_seq=before_seq, limit=limit,
+                                                          edits_since=edits_since))
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+
+
+@router.post("/rooms/{room_id}/attachments")
+async def upload_attachment(room_id: str, request: Request, filename: str = Query(..., min_length=1, max_length=255)):
+    """Upload a file to a room. The request body is the raw file (no multipart) and is
+    streamed to storage as it arrives. Send the returned `id` in a message's `attachments`."""
+    user_id = request.state.user.get("_id")
+    if not await service.is_member(room_id, user_id):
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > settings.attachment_max_bytes:
+        raise HTTPException(status_code=413, detail="Attachment too large")
+    try:
+        ref = await attachments.upload(room_id, user_id, filename, request.headers.get("content-type"), request.stream())
+    except AttachmentTooLarge:
+        raise HTTPException(status_code=413, detail="Attachment too large")
+    return FastJSONResponse(ref, status_code=201)
+
+
+async def _readable_attachment(attachment_id: str, request: Request) -> dict:
+    doc = await attachments.get(attachment_id)
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    if not await service.is_member((doc.get("metadata") or {}).get("room_id") or "", request.state.user.get("_id")):
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    return doc
+
+
+def _file_response(request: Request, doc: dict) -> Response:
+    """Serve a stored file with ETag revalidation and single byte-range support."""
+    meta = doc.get("metadata") or {}
+    size = doc.get("length") or 0
+    content_type = meta.get("content_type") or "application/octet-stream"
+    etag = f'"{(doc.get("sha256") or doc["_id"])[:32]}"'
+    disposition = "inline" if content_type in INLINE_TYPES else "attachment"
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=86400",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"{disposition}; filename*=UTF-8''{quote(doc.get('filename') or doc['_id'])}",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if doc.get("uploadDate"):
+        headers["Last-Modified"] = format_datetime(datetime.fromisoformat(doc["uploadDate"]).replace(tzinfo=timezone.utc), usegmt=True)
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if request.headers.get("if-range", etag) != etag:
+        range_header = None  # the client's partial copy is of a different file: send it whole
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    status, (start, end) = 200, (0, size - 1)
+    if byte_range is not None:
+        status, (start, end) = 206, byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+    if not size:
+        return Response(status_code=200, media_type=content_type, headers=headers)
+    return StreamingResponse(attachments.stream(doc["_id"], start, end), status_code=status,
+                             media_type=content_type, headers=headers)
+
+
+@router.get("/attachments/{attachment_id}")
+async def download_attachment(attachment_id: str, request: Request):
+    """Download an attachment. Supports `Range`, `If-Range` and `If-None-Match`."""
+    return _file_response(request, await _readable_attachment(attachment_id, request))
+
+
+@router.get("/attachments/{attachment_id}/thumbnail", dependencies=[Depends(shed_at(SHED_READS, "thumbnail"))])
+async def attachment_thumbnail(attachment_id: str, request: Request):
+    """JPEG thumbnail of an image attachment; 404 until it has been generated."""
+    doc = await _readable_attachment(attachment_id, request)
+    thumbnail_id = (doc.get("metadata") or {}).get("thumbnail_id")
+    thumb = await attachments.get(thumbnail_id) if thumbnail_id else None
+    if thumb is None:
+        thumbnailer.submit(doc)
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    return _file_response(request, thumb)
+
+
+@router.get("/search", dependencies=[Depends(shed_at(SHED_READS, "search"))])
+async def search_messages(request: Request, q: str = Query(..., min_length=1, max_length=200),
+                          room: Optional[str] = None, page: int = Query(1, ge=1),
+                          limit: Optional[int] = Query(None, ge=1, le=100)):
+    """Full-text search over messages in the current user's rooms, best matches first."""
+    user_id = request.state.user.get("_id")
+    return FastJSONResponse(await search_service.search(user_id, q, room=room, page=page, limit=limit))
+
+
 @router.get("/chats")
-async def list_chats(request: Request):
-    """List chats (groups and simple metadata) for the current user."""
+async def list_chats(request: Request, since: Optional[str] = Query(None, max_length=40)):
+    """List chats (groups and simple metadata) for the current user.
+    The response's `version` is also its ETag: revalidate with `If-None-Match` (304 when
+    nothing changed), or pass it as `since` to get only the chats changed after it."""
     user_id = request.state.user.get("_id")
     if not user_id:
         return {"error": "User not authenticated"}
-    chats = await service.list_user_chats(user_id)
-    return chats
+    headers = {"Cache-Control": "private, no-cache"}
+    if not since and request.headers.get("if-none-match"):
+        etag = f'"{await service.chat_list_version(user_id)}"'
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers={**headers, "ETag": etag})
+    chats = await service.list_user_chats(user_id, since=since)
+    if chats["full"]:
+        headers["ETag"] = f'"{chats["version"]}"'
+    return FastJSONResponse(chats, headers=headers)
 
 
 @router.post("/dm/{other_id}")
@@ -66,24 +240,24 @@ async def create_dm(other_id: str, request: Request):
 async def delete_conversation(conv_id: str, request: Request):
     """Deletes a DM conversation document."""
     # Here too, you might want to check if the user is a participant.
-    await service.convs.delete(conv_id)
+    await service.delete_conversation(conv_id)
     return {"ok": True, "message": "Conversation deleted"}
 
 
-@router.get("/users/search")
+@router.get("/users/search", dependencies=[Depends(shed_at(SHED_READS, "user_search"))])
 async def search_users(q: str, request: Request):
     """Search for users by username."""
     current_user_id = request.state.user.get("_id")
     return await service.users.search_by_username(q, exclude_id=str(current_user_id))
 
 
-@router.get("/users")
+@router.get("/users", dependencies=[Depends(shed_at(SHED_READS, "users"))])
 async def list_all_users(request: Request):
     """List all users on the platform, excluding the current user."""
     return await service.users.list_all()
 
 
-@router.get("/ai/history")
+@router.get("/ai/history", dependencies=[Depends(shed_at(SHED_READS, "ai_history"))])
 async def get_ai_chat_history(request: Request):
     """Get the AI chat history for the current user."""
     user_id = request.state.user.get("_id")
@@ -114,7 +288,7 @@ async def clear_ai_chat_history(request: Request):
     return {"ok": True, "message": "AI chat history cleared."}
 
 
-@router.post("/ai")
+@router.post("/ai", dependencies=[Depends(shed_at(SHED_AI, "ai")), Depends(rate_limit("chat.ai", per_user=True))])
 async def chat_with_ai(payload: AiChatPayload, request: Request):
     """Streams a response from the AI assistant."""
     user_id = request.state.user.get("_id")
@@ -130,10 +304,11 @@ async def chat_with_ai(payload: AiChatPayload, request: Request):
 
     # Limit history to the last 20 messages to keep context relevant and manage token usage
     history = session.get("messages", [])[-20:]
+    ai_service = await get_ai_service()
 
     async def stream_wrapper() -> AsyncGenerator[str, None]:
         full_response = ""
-        async for chunk in get_ai_response_stream(payload.content, history):
+        async for chunk in ai_service.get_ai_response_stream(payload.content, history):
             full_response += chunk
             yield chunk
         await ai_sessions.add_message(session["_id"], {"role": "assistant", "content": full_response})
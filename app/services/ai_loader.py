@@ -0,0 +1,33 @@
+import asyncio
+import importlib
+import time
+from types import ModuleType
+from typing import Optional
+
+# The AI stack (langchain, langgraph, groq, tavily) is heavy to import and compiles its graph
+# at import time, so it is only loaded on the first AI request or by an explicit warm-up.
+_ai_service: Optional[ModuleType] = None
+
+
+def _import_ai_service() -> ModuleType:
+    global _ai_service
+    if _ai_service is None:
+        started = time.perf_counter()
+        _ai_service = importlib.import_module(".ai_service", __package__)
+        print(f"AI service loaded in {time.perf_counter() - started:.2f}s")
+    return _ai_service
+
+
+async def get_ai_service() -> ModuleType:
+    """The `ai_service` module, imported in a worker thread on first use."""
+    if _ai_service is not None:
+        return _ai_service
+    return await asyncio.to_thread(_import_ai_service)
+
+
+async def warm_up():
+    """Load the AI stack in the background (e.g. after startup) so the first AI call is fast."""
+    try:
+        await get_ai_service()
+    except Exception as e:
+        print(f"AI service warm-up failed: {e}")
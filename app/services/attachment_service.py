@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Optional
+from bson import ObjectId
+from ..utils.repositories import AttachmentRepository
+from ..utils.metrics import metrics
+from ..utils.config import settings
+
+try:  # Pillow is optional; without it attachments simply have no thumbnails
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = ImageOps = None
+
+THUMBNAIL_TYPES = frozenset({"image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp"})
+# served inline; anything else is forced to download so uploaded HTML/SVG never runs on our origin
+INLINE_TYPES = THUMBNAIL_TYPES | {"application/pdf", "text/plain"}
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def attachment_ref(doc: dict) -> dict:
+    """The lightweight reference stored on messages."""
+    meta = doc.get("metadata") or {}
+    return {
+        "id": doc["_id"],
+        "filename": doc.get("filename"),
+        "content_type": meta.get("content_type"),
+        "size": doc.get("length"),
+        "sha256": doc.get("sha256"),
+    }
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """The (start, end) byte positions (inclusive) of a single-range `Range` header.
+    Returns None when the whole file should be sent (no header, multiple ranges or
+    a malformed one, which RFC 9110 says to ignore); raises ValueError when unsatisfiable."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:  # suffix range: the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ValueError("unsatisfiable_range")
+    return start, min(end, size - 1)
+
+
+def _render_thumbnail(data: bytes, size: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", (size, size))  # JPEGs are decoded at a reduced scale
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=80, optimize=True)
+        return out.getvalue()
+
+
+class Thumbnailer:
+    """Renders image thumbnails in a thread pool so decoding never blocks the event loop
+    (Pillow releases the GIL while decoding and resampling). At most `workers` images are
+    held in memory at once; beyond `max_pending` queued jobs new ones are dropped and
+    regenerated when the thumbnail is first requested."""
+
+    def __init__(self, repo: AttachmentRepository, workers: int, max_pending: int = 1000):
+        self.repo = repo
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="thumbnail") if Image is not None else None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def wants(doc: dict) -> bool:
+        meta = doc.get("metadata") or {}
+        return (meta.get("content_type") in THUMBNAIL_TYPES
+                and not meta.get("thumbnail_id") and not meta.get("thumbnail_of")
+                and (doc.get("length") or 0) <= settings.thumbnail_max_source_bytes)
+
+    def submit(self, doc: dict):
+        file_id = doc["_id"]
+        if self._executor is None or file_id in self._pending or not self.wants(doc):
+            return
+        if len(self._pending) >= self.max_pending:
+            metrics.inc("attachments.thumbnails_dropped")
+            return
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        task = asyncio.get_running_loop().create_task(self._make(doc))
+        self._pending[file_id] = task
+        task.add_done_callback(lambda _: self._pending.pop(file_id, None))
+
+    async def _make(self, doc: dict):
+        async with self._slots:
+            try:
+                source = await (await self.repo.open_download(doc["_id"])).read()
+                thumb = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, _render_thumbnail, source, settings.thumbnail_size
+                )
+                thumb_id = await self.repo.upload(f"thumbnail-{doc['_id']}.jpg", thumb, {
+                    "thumbnail_of": doc["_id"],
+                    "room_id": (doc.get("metadata") or {}).get("room_id"),
+                    "content_type": "image/jpeg",
+                })
+                await self.repo.set_thumbnail(doc["_id"], thumb_id)
+                metrics.inc("attachments.thumbnails")
+            except Exception as e:
+                metrics.inc("attachments.thumbnail_errors")
+                print(f"Thumbnail for attachment {doc['_id']} failed: {e}")
+
+    def stats(self) -> dict:
+        return {"enabled": self._executor is not None, "workers": self.workers, "pending": len(self._pending)}
+
+
+class AttachmentService:
+    def __init__(self):
+        self.repo = AttachmentRepository()
+
+    async def upload(self, room_id: str, user_id: str, filename: str, content_type: Optional[str],
+                     chunks: AsyncIterator[bytes]) -> dict:
+        """Stream an upload into GridFS, hashing it on the way. Only one GridFS chunk is
+        buffered at a time. Raises AttachmentTooLarge past ATTACHMENT_MAX_BYTES; a failed or
+        aborted upload leaves nothing behind."""
+        metadata = {"room_id": room_id, "uploader_id": user_id,
+                    "content_type": (content_type or "application/octet-stream").split(";")[0].strip().lower()}
+        grid_in = self.repo.open_upload(filename, settings.attachment_chunk_size, metadata)
+        digest, size = hashlib.sha256(), 0
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > settings.attachment_max_bytes:
+                    raise AttachmentTooLarge()
+                digest.update(chunk)
+                await grid_in.write(chunk)
+            # a top-level field, like the `md5` older GridFS drivers wrote
+            await grid_in.set("sha256", digest.hexdigest())
+            await grid_in.close()
+        except BaseException:
+            await grid_in.abort()
+            raise
+        doc = {"_id": str(grid_in._id), "filename": filename, "length": size,
+               "sha256": digest.hexdigest(), "metadata": metadata}
+        metrics.inc("attachments.uploaded_bytes", size)
+        thumbnailer.submit(doc)
+        return attachment_ref(doc)
+
+    async def get(self, attachment_id: str) -> Optional[dict]:
+        if not ObjectId.is_valid(attachment_id):
+            return None
+        return await self.repo.find_by_id(attachment_id)
+
+    async def resolve(self, room_id: str, user_id: str, ids: List[str]) -> List[dict]:
+        """References for attachments a message wants to carry. Each must have been uploaded
+        to the same room by the sender; raises ValueError otherwise."""
+        if not isinstance(ids, list) or not all(isinstance(i, str) and ObjectId.is_valid(i) for i in ids):
+            raise ValueError("invalid_attachment")
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > settings.attachment_max_per_message:
+            raise ValueError("too_many_attachments")
+        docs = {d["_id"]: d for d in await self.repo.find_by_ids(ids)}
+        refs = []
+        for i in ids:
+            meta = (docs.get(i) or {}).get("metadata") or {}
+            if meta.get("room_id") != room_id or meta.get("uploader_id") != user_id or meta.get("thumbnail_of"):
+                raise ValueError("invalid_attachment")
+            refs.append(attachment_ref(docs[i]))
+        return refs
+
+    async def stream(self, file_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Bytes start..end (inclusive) of a stored file, one chunk at a time."""
+        grid_out = await self.repo.open_download(file_id)
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await grid_out.read(min(remaining, settings.attachment_chunk_size))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+thumbnailer = Thumbnailer(AttachmentRepository(), settings.thumbnail_workers)
+metrics.register("thumbnails", thumbnailer.stats)
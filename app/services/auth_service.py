@@ -1,10 +1,74 @@
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional
+from jose import JWTError
 from ..utils.repositories import UserRepository, SessionRepository
-from ..utils.utils import hash_password, verify_password, create_access_token
+from ..utils.utils import hash_password, verify_password, create_access_token, create_refresh_token, decode_token, hash_token
 from datetime import datetime, timedelta
 from .email_service import generate_otp, send_otp_email, send_confirmation_email, smtp_is_configured
 from ..utils.config import settings
 
 
+class RevokedTokens:
+    """Bounded, per-worker memory of refresh tokens that must be rejected: tokens already
+    rotated (presenting one again is a replay) and session families that were revoked.
+    Lets /auth/refresh answer repeat offenders without a database round trip. Entries
+    drop out when the token would have expired anyway, or in LRU order past `max_size`.
+    For a short grace window it also keeps the successor each rotated token was exchanged
+    for, so a concurrent refresh from another tab gets that same token back."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # "token:<digest>" -> (family, expires_at) / "family:<id>" -> (None, expires_at)
+        self._entries: "OrderedDict[str, tuple[Optional[str], float]]" = OrderedDict()
+        # rotated token digest -> (successor token, successor digest, grace deadline)
+        self._successors: "OrderedDict[str, tuple[str, str, float]]" = OrderedDict()
+
+    def _add(self, key: str, family: Optional[str], expires_at: float):
+        self._entries[key] = (family, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        return entry
+
+    def mark_rotated(self, token_hash: str, family: str, expires_at: float, successor: Optional[str] = None):
+        self._add(f"token:{token_hash}", family, expires_at)
+        if successor is not None and settings.refresh_reuse_grace_seconds > 0:
+            now = time.time()
+            self._successors[token_hash] = (successor, hash_token(successor), now + settings.refresh_reuse_grace_seconds)
+            while self._successors and next(iter(self._successors.values()))[2] <= now:
+                self._successors.popitem(last=False)
+            while len(self._successors) > self.max_size:
+                self._successors.popitem(last=False)
+
+    def successor(self, token_hash: str) -> Optional[str]:
+        """The token `token_hash` was rotated into, while the grace window is open and
+        that successor has not been rotated itself; None otherwise."""
+        entry = self._successors.get(token_hash)
+        if entry is None or entry[2] <= time.time() or self.was_rotated(entry[1]):
+            return None
+        return entry[0]
+
+    def was_rotated(self, token_hash: str) -> bool:
+        return self._get(f"token:{token_hash}") is not None
+
+    def revoke_family(self, family: str, expires_at: float):
+        self._add(f"family:{family}", None, expires_at)
+
+    def family_revoked(self, family: str) -> bool:
+        return self._get(f"family:{family}") is not None
+
+
+revoked_tokens = RevokedTokens(settings.revocation_cache_size)
+
+
 class AuthService:
     def __init__(self):
         self.users = UserRepository()
@@ -19,30 +83,105 @@ class AuthService:
 
     async def login(self, email: str, password: str) -> dict:
         user = await self.users.find_by_email(email)
-        # user now has ObjectId converted to strings by repository normalize_doc
+        # documents come back JSON-ready (ObjectId as str) from the database codec
         if not user or not verify_password(password, user.get("password_hash", "")):
             raise ValueError("invalid_credentials")
 
         access = create_access_token(str(user["_id"]))
-        refresh = create_access_token(str(user["_id"]), expires_delta=settings.refresh_token_expires_seconds)
-        session = {"user_id": user["_id"], "refresh_token": refresh, "expires_at": datetime.utcnow() + timedelta(seconds=settings.refresh_token_expires_seconds)}
-        await self.sessions.create(session)
+        refresh = await self._issue_refresh(str(user["_id"]), family=secrets.token_hex(12))
 
         # sanitize user before returning (remove password hash)
         user_sanitized = dict(user)
         user_sanitized.pop("password_hash", None)
         return {"access_token": access, "refresh_token": refresh, "user": user_sanitized}
 
+    async def _issue_refresh(self, user_id: str, family: str, rotating: Optional[str] = None) -> Optional[str]:
+        """Create a refresh token and its session. When `rotating` (the digest of the token
+        being exchanged) is given, the new session only exists if that token was still unused."""
+        token = create_refresh_token(user_id, family)
+        session = {
+            "user_id": user_id,
+            "token_hash": hash_token(token),
+            "family": family,
+            "expires_at": datetime.utcnow() + timedelta(seconds=settings.refresh_token_expires_seconds),
+        }
+        if rotating is None:
+            await self.sessions.create(session)
+        elif await self.sessions.rotate(rotating, session) is None:
+            return None
+        return token
+
+    async def _revoke_family(self, family: str, expires_at: float):
+        revoked_tokens.revoke_family(family, expires_at)
+        await self.sessions.delete_family(family)
+
     async def refresh(self, refresh_token: str) -> dict:
-        session = await self.sessions.find_by_refresh(refresh_token)
-        if not session:
+        """Exchange a refresh token for a new access token and a new refresh token.
+
+        Each refresh token is single use. Presenting one that was already exchanged
+        means it leaked (or was replayed), so every session of its family is revoked -
+        unless it was rotated less than `refresh_reuse_grace_seconds` ago and its successor
+        is still unused: two tabs or a retried request refreshing at once then get a token
+        of the same session. Signature, expiry and known-bad tokens are checked before
+        touching Mongo.
+        """
+        try:
+            claims = decode_token(refresh_token)
+        except JWTError:
             raise ValueError("invalid_refresh")
-        user_id = session["user_id"]
-        access = create_access_token(str(user_id))
-        return {"access_token": access}
+        family, user_id, expires_at = claims.get("fam"), claims.get("sub"), claims.get("exp", 0)
+        if claims.get("typ") != "refresh" or not family or not user_id:
+            raise ValueError("invalid_refresh")
+        if revoked_tokens.family_revoked(family):
+            raise ValueError("invalid_refresh")
+        token_hash = hash_token(refresh_token)
+        if revoked_tokens.was_rotated(token_hash):
+            successor = revoked_tokens.successor(token_hash)
+            if successor is not None:
+                return {"access_token": create_access_token(user_id), "refresh_token": successor}
+            await self._revoke_family(family, expires_at)
+            raise ValueError("refresh_reused")
+
+        new_refresh = await self._issue_refresh(user_id, family, rotating=token_hash)
+        if new_refresh is None:
+            session = await self.sessions.find_by_refresh(token_hash)
+            if session is not None:
+                # rotated by another worker, which holds the successor: issue a sibling instead
+                if await self._rotated_within_grace(session):
+                    return {"access_token": create_access_token(user_id),
+                            "refresh_token": await self._issue_refresh(user_id, family)}
+                await self._revoke_family(family, expires_at)
+                raise ValueError("refresh_reused")
+            # expired, logged out or revoked elsewhere: remember it so retries stay in memory
+            revoked_tokens.revoke_family(family, expires_at)
+            raise ValueError("invalid_refresh")
+        revoked_tokens.mark_rotated(token_hash, family, expires_at, successor=new_refresh)
+        return {"access_token": create_access_token(user_id), "refresh_token": new_refresh}
+
+    async def _rotated_within_grace(self, session: dict) -> bool:
+        """Whether `session` was rotated inside the reuse grace window into a successor
+        that is still unused (a reuse of an older token is always theft)."""
+        rotated_at = session.get("rotated_at")
+        if not rotated_at or settings.refresh_reuse_grace_seconds <= 0:
+            return False
+        if isinstance(rotated_at, str):
+            rotated_at = datetime.fromisoformat(rotated_at)
+        if datetime.utcnow() - rotated_at > timedelta(seconds=settings.refresh_reuse_grace_seconds):
+            return False
+        successor = await self.sessions.find_by_refresh(session["replaced_by"])
+        return successor is not None and successor.get("replaced_by") is None
 
     async def logout(self, refresh_token: str):
-        await self.sessions.delete(refresh_token)
+        """Revoke the whole session family the token belongs to."""
+        try:
+            claims = decode_token(refresh_token)
+        except JWTError:
+            await self.sessions.delete(hash_token(refresh_token))
+            return
+        if claims.get("fam"):
+            await self._revoke_family(claims["fam"], claims.get("exp", 0))
+        else:
+            await self.sessions.delete(hash_token(refresh_token))
 
     async def request_password_reset(self, email: str):
         if not smtp_is_configured():
@@ -1,44 +1,209 @@
-from ..utils.repositories import UserRepository, MessageRepository, GroupRepository, ConversationRepository
+import asyncio
+from collections import OrderedDict
+from ..utils.repositories import (
+    UserRepository,
+    MessageRepository,
+    MessageArchiveRepository,
+    GroupRepository,
+    GroupMemberRepository,
+    ConversationRepository,
+    ChatListVersionRepository,
+)
 from ..utils.utils import normalize_doc
+from ..utils.config import settings
+from ..utils.message_buffer import recent_messages
+from ..utils.singleflight import SingleFlight
+from .unread_service import unread_counters, list_version
+from .membership_service import membership
+from .search_service import search_indexer
+from .notification_service import notification_digests
+from .attachment_service import AttachmentService
 from datetime import datetime
+from typing import Optional
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+
+class DuplicateMessage(Exception):
+    """Raised by post_message when a client message id was already stored.
+    `message` is the originally stored message."""
+
+    def __init__(self, message: dict):
+        super().__init__("duplicate_message")
+        self.message = message
+
+
+# a user's chat list is rebuilt by every tab and reconnect at once; concurrent builds share one
+_chat_lists = SingleFlight("chat.list_user_chats")
+
+# (chat_id, client_msg_id) -> stored message, for cheap de-duplication of client retries
+_recent_client_ids: "OrderedDict[tuple[str, str], dict]" = OrderedDict()
+
+
+def update_delta(msg: dict) -> dict:
+    """The compact form of an edited or deleted message, sent as a `message_update` event
+    and returned by sync: just enough for a client to patch its copy."""
+    delta = {"room": msg["chat_id"], "seq": msg["seq"], "edit_seq": msg["edit_seq"]}
+    if msg.get("deleted"):
+        delta["deleted"] = True
+    else:
+        delta["content"] = msg.get("content", "")
+        delta["edited_at"] = msg.get("edited_at")
+    return delta
+
+
+def _remember_client_id(chat_id: str, client_msg_id: str, msg: dict):
+    _recent_client_ids[(chat_id, client_msg_id)] = msg
+    _recent_client_ids.move_to_end((chat_id, client_msg_id))
+    while len(_recent_client_ids) > settings.message_dedupe_cache_size:
+        _recent_client_ids.popitem(last=False)
 
 
 class ChatService:
     def __init__(self):
         self.msgs = MessageRepository()
+        self.archive = MessageArchiveRepository()
         self.groups = GroupRepository()
+        self.members = GroupMemberRepository()
         self.users = UserRepository()
         self.convs = ConversationRepository()
+        self.list_versions = ChatListVersionRepository()
+        self.attachments = AttachmentService()
 
     async def create_dm(self, user_a: str, user_b: str) -> dict:
-        existing = await self.convs.find_dm_between(user_a, user_b)
-        ids = sorted([user_a, user_b])
-        room_id = f"dm:{ids[0]}-{ids[1]}"
-        if existing:
-            existing["room_id"] = room_id
-            return existing
-        doc = {"participant_ids": ids, "type": "dm"}
-        created = await self.convs.create(doc)
-        created["room_id"] = room_id
-        return created
+        conv = await self.convs.get_or_create_dm(user_a, user_b)
+        conv["room_id"] = f"dm:{self.convs.dm_key(user_a, user_b)}"
+        unread_counters.touch(conv["room_id"], {user_a, user_b})
+        return conv
+
+    async def delete_conversation(self, conv_id: str):
+        conv = await self.convs.find_by_id(conv_id) if ObjectId.is_valid(conv_id) else None
+        if conv is None:
+            return
+        await self.convs.delete(conv_id)
+        await self.list_versions.bump(list(dict.fromkeys(conv.get("participant_ids") or [])), removed=True)
+
+    async def create_group(self, name: str, owner_id: str, member_ids: Optional[list] = None) -> dict:
+        """Create a group owned by `owner_id` with the given initial members."""
+        others = [uid for uid in dict.fromkeys(member_ids or []) if uid != owner_id]
+        try:
+            group = await self.groups.create({"name": name, "created_by": owner_id, "member_count": 1 + len(others)})
+        except DuplicateKeyError:
+            raise ValueError("group_name_taken")
+        await self.members.add(group["_id"], owner_id, role="owner")
+        await self.members.add_many(group["_id"], others)
+        membership.added(group["_id"], [owner_id, *others])
+        unread_counters.touch(f"group:{group['_id']}", [owner_id, *others])
+        return group
+
+    async def add_member(self, group_id: str, user_id: str, role: str = "member") -> bool:
+        """Constant-time join: one membership upsert, plus a counter bump if the user is new."""
+        added = await self.members.add(group_id, user_id, role=role)
+        if added:
+            membership.added(group_id, [user_id])
+            await self.groups.inc_member_count(group_id, 1)
+            # the new member sees a new room, everyone else a new member count
+            room_id = f"group:{group_id}"
+            unread_counters.touch(room_id, await membership.members(room_id))
+        return added
 
     async def join_or_create_group_by_name(self, group_name: str, user_id: str) -> dict:
         """Finds a group by name or creates it if it doesn't exist. Adds user to members."""
-        group = await self.groups.find_by_name(group_name)
-        if group:
-            # Group exists, ensure user is a member
-            await self.groups.add_member(group["_id"], user_id)
-        else:
-            # Group doesn't exist, create it with the user as the first member
-            doc = {"name": group_name, "members": [user_id], "messages": []}
-            group = await self.groups.create(doc)
+        group = await self.groups.get_or_create_by_name(group_name, user_id)
+        # whoever created the group owns it
+        role = "owner" if group.get("created_by") == user_id else "member"
+        if await self.add_member(group["_id"], user_id, role=role):
+            group["member_count"] = group.get("member_count", 0) + 1
         return group
 
-    async def list_user_chats(self, user_id: str):
-        groups = await self.groups.find_by_member(user_id)
-        convs = await self.convs.find_by_participant(user_id)
-        
+    async def list_group_members(self, group_id: str, user_id: str, after: Optional[str] = None,
+                                 limit: int = 50) -> dict:
+        """A page of a group's members with usernames and roles."""
+        if not ObjectId.is_valid(group_id) or not await self.members.is_member(group_id, user_id):
+            raise PermissionError("not_a_member")
+        if after is not None and not ObjectId.is_valid(after):
+            raise ValueError("invalid_cursor")
+        page = await self.members.list(group_id, after=after, limit=limit + 1)
+        has_more = len(page) > limit
+        page = page[:limit]
+        users = await self.users.find_by_ids([m["user_id"] for m in page])
+        members = [
+            {
+                "user_id": m["user_id"],
+                "username": (users.get(m["user_id"]) or {}).get("username", "Unknown User"),
+                "role": m.get("role", "member"),
+                "joined_at": m.get("joined_at"),
+            }
+            for m in page
+        ]
+        group = await self.groups.find_by_id(group_id)
+        return {
+            "group_id": group_id,
+            "member_count": (group or {}).get("member_count", 0),
+            "members": members,
+            "next": page[-1]["_id"] if has_more else None,
+        }
+
+    async def set_group_retention(self, group_id: str, user_id: str, days: Optional[int]):
+        """Override the retention period of a group (owners only); None restores the global policy."""
+        if not ObjectId.is_valid(group_id) or await self.members.role(group_id, user_id) != "owner":
+            raise PermissionError("not_an_owner")
+        await self.groups.set_retention(group_id, days)
+        room_id = f"group:{group_id}"
+        unread_counters.touch(room_id, await membership.members(room_id))
+
+    async def delete_group(self, group_id: str):
+        member_ids = list(await membership.members(f"group:{group_id}"))
+        await self.groups.delete(group_id)
+        await self.members.delete_group(group_id)
+        membership.forget(group_id)
+        await self.list_versions.bump(member_ids, removed=True)
+
+    async def chat_list_version(self, user_id: str) -> str:
+        return list_version(*await self.list_versions.get(user_id))
+
+    async def list_user_chats(self, user_id: str, since: Optional[str] = None) -> dict:
+        """The user's groups and conversations plus the list's `version`.
+        With `since` (a version from an earlier call) only the chats changed after it are
+        returned, with `full` false; a `since` that cannot be answered with a delta (rooms
+        were removed meanwhile, or it is malformed) gets the whole list, `full` true."""
+        if since:
+            epoch, _, v = since.partition(".")
+            current_epoch, _ = await self.list_versions.get(user_id)
+            if epoch.isdigit() and v.isdigit() and int(epoch) == current_epoch:
+                return await _chat_lists.do((user_id, int(v)), lambda: self._build_chat_list(user_id, since_v=int(v)))
+        return await _chat_lists.do(user_id, lambda: self._build_chat_list(user_id))
+
+    async def _build_chat_list(self, user_id: str, since_v: Optional[int] = None) -> dict:
+        # the version is read before the chats, so they are at least as new as it says
+        epoch, v = await self.list_versions.get(user_id)
+        result = {"version": list_version(epoch, v), "full": since_v is None, "groups": [], "conversations": []}
+        if since_v is None:
+            group_ids = await self.members.group_ids_for_user(user_id)
+            convs = await self.convs.find_by_participant(user_id)
+        else:
+            if since_v >= v:
+                return result
+            changed = set(await unread_counters.repo.changed_since(user_id, since_v))
+            # counter docs only say a room changed; the list shows only rooms the user is in
+            member_of = set(await self.members.group_ids_for_user(user_id))
+            group_ids = [r.split(":", 1)[1] for r in changed if r.startswith("group:")]
+            group_ids = [g for g in group_ids if g in member_of]
+            convs = await self.convs.find_by_participant(user_id) if any(r.startswith("dm:") for r in changed) else []
+            convs = [c for c in convs if len(c.get("participant_ids") or []) == 2
+                     and f"dm:{self.convs.dm_key(*c['participant_ids'])}" in changed]
+        groups = await self.groups.find_by_ids(group_ids) if group_ids else []
+        unread = await unread_counters.counts_for_user(user_id)
+
+        # Resolve the other DM participants with one query instead of one per conversation
+        other_ids = {}
+        for c in convs:
+            parts = c.get("participant_ids", [])
+            if c.get("type") == "dm" and len(parts) == 2:
+                # If there is no other participant, it's a DM with self.
+                other_ids[c["_id"]] = next((pid for pid in parts if pid != user_id), user_id)
+        other_users = await self.users.find_by_ids(list(other_ids.values()))
+
         # Process conversations (DMs)
         processed_convs = []
         for c in convs:
@@ -46,23 +211,22 @@ class ChatService:
                 parts = c.get("participant_ids", [])
                 if len(parts) == 2:
                     c["room_id"] = f"dm:{parts[0]}-{parts[1]}"
-                    other_id = next((pid for pid in parts if pid != user_id), None)
-                    # If other_id is None, it's a DM with self.
-                    if other_id is None and len(set(parts)) == 1:
-                        other_id = user_id
-
-                    other_user = await self.users.find_by_id(other_id) if other_id else None
+                    other_user = other_users.get(other_ids[c["_id"]])
                     c["participant_display_name"] = other_user.get("username") if other_user else "Unknown User"
-                if c.get("messages"):
-                    c["last_message"] = c["messages"][-1]
+            if not c.get("last_message") and c.get("messages"):
+                c["last_message"] = c["messages"][-1]
+            c.pop("messages", None)
+            c["unread_count"] = unread.get(c.get("room_id"), 0)
             processed_convs.append(c)
 
         # Process groups
         processed_groups = []
         for g in groups:
             g["room_id"] = f"group:{g['_id']}"
-            if g.get("messages"):
+            if not g.get("last_message") and g.get("messages"):
                 g["last_message"] = g["messages"][-1]
+            g.pop("messages", None)
+            g["unread_count"] = unread.get(g["room_id"], 0)
             processed_groups.append(g)
 
         # Sort both lists by last_message timestamp
@@ -70,23 +234,247 @@ class ChatService:
         processed_convs.sort(key=sorter, reverse=True)
         processed_groups.sort(key=sorter, reverse=True)
 
-        return {"groups": processed_groups, "conversations": processed_convs}
+        result["groups"], result["conversations"] = processed_groups, processed_convs
+        return result
 
-    async def post_message(self, chat_id: str, sender_id: str, content: str, is_group: bool = False) -> dict:
-        msg = {"sender_id": sender_id, "content": content, "created_at": datetime.utcnow()}
-        user = await self.users.find_by_id(sender_id)
+    async def _allocate_seq(self, chat_id: str) -> Optional[dict]:
+        """Reserve the next sequence number of a room.
+        Returns {"_id", "seq", "member_ids", "is_group"} or None for unknown rooms.
+        """
+        if chat_id.startswith("group:"):
+            group_id = chat_id.split(":", 1)[1]
+            if ObjectId.is_valid(group_id):
+                room, member_ids = await asyncio.gather(self.groups.next_seq(group_id), membership.members(chat_id))
+                if room:
+                    return {"_id": room["_id"], "seq": room["seq"], "member_ids": member_ids, "is_group": True}
+        elif chat_id.startswith("dm:"):
+            dm_ids = chat_id.split(":", 1)[1].split("-")
+            if len(dm_ids) == 2:
+                room = await self.convs.next_dm_seq(dm_ids[0], dm_ids[1])
+                if room:
+                    return {"_id": room["_id"], "seq": room["seq"], "member_ids": dm_ids, "is_group": False}
+        return None
+
+    async def post_message(self, chat_id: str, sender_id: str, content: str, is_group: bool = False,
+                           client_msg_id: Optional[str] = None, attachments: Optional[list] = None,
+                           sender_username: Optional[str] = None) -> dict:
+        """Store a message under the room's next sequence number.
+        `attachments` are ids returned by the upload endpoint; the message stores references to them.
+        `sender_username` skips the user lookup for senders that are not users (the room assistant).
+        Raises DuplicateMessage if `client_msg_id` was already used in this room, ValueError if an
+        attachment was not uploaded to this room by the sender.
+        """
+        if client_msg_id and (chat_id, client_msg_id) in _recent_client_ids:
+            raise DuplicateMessage(_recent_client_ids[(chat_id, client_msg_id)])
+
+        refs = await self.attachments.resolve(chat_id, sender_id, attachments) if attachments else []
+        if sender_username is not None:
+            room, user = await self._allocate_seq(chat_id), {"username": sender_username}
+        else:
+            room, user = await asyncio.gather(self._allocate_seq(chat_id), self.users.find_by_id(sender_id))
+        msg = {"chat_id": chat_id, "sender_id": sender_id, "content": content, "created_at": datetime.utcnow()}
+        if refs:
+            msg["attachments"] = refs
         if user:
             msg["sender_username"] = user.get("username")
+        if room is None:
+            # unknown room: still delivered to whoever joined it, but not persisted
+            return normalize_doc(msg)
+
+        msg["seq"] = room["seq"]
+        if client_msg_id:
+            msg["client_msg_id"] = client_msg_id
+        try:
+            stored = await self.msgs.insert(msg)
+        except DuplicateKeyError:
+            original = await self.msgs.find_by_client_id(chat_id, client_msg_id) if client_msg_id else None
+            if original is None:
+                raise
+            _remember_client_id(chat_id, client_msg_id, original)
+            raise DuplicateMessage(original)
+
+        if settings.message_buffer_enabled:
+            recent_messages.append(chat_id, stored)
+        repo = self.groups if room["is_group"] else self.convs
+        await repo.set_last_message(str(room["_id"]), msg)
+        if client_msg_id:
+            _remember_client_id(chat_id, client_msg_id, stored)
+        unread_counters.record_message(chat_id, sender_id, room["member_ids"])
+        search_indexer.enqueue(stored)
+        if not room["is_group"]:
+            notification_digests.record_message(stored, room["member_ids"])
+        return stored
+
+    async def _room_counters(self, chat_id: str) -> Optional[dict]:
+        """The room's current {"seq", "edit_seq", "first_seq"}; the message buffer must match the
+        first two to answer a read. None for unknown rooms."""
         if chat_id.startswith("group:"):
+            group_id = chat_id.split(":", 1)[1]
+            return await self.groups.counters(group_id) if ObjectId.is_valid(group_id) else None
+        if chat_id.startswith("dm:"):
+            dm_ids = chat_id.split(":", 1)[1].split("-")
+            return await self.convs.dm_counters(dm_ids[0], dm_ids[1]) if len(dm_ids) == 2 else None
+        return None
+
+    async def _allocate_edit_seq(self, chat_id: str) -> Optional[dict]:
+        """Reserve the next edit number of a room. Returns {"_id", "edit_seq", "last_seq", "is_group"}
+        (last_seq: seq of the room's newest message) or None for unknown rooms."""
+        room, is_group = None, chat_id.startswith("group:")
+        if is_group:
             group_id = chat_id.split(":", 1)[1]
             if ObjectId.is_valid(group_id):
-                await self.groups.add_message(group_id, msg)
+                room = await self.groups.next_edit_seq(group_id)
         elif chat_id.startswith("dm:"):
-            dm_ids_str = chat_id.split(":", 1)[1]
-            dm_ids = dm_ids_str.split("-")
+            dm_ids = chat_id.split(":", 1)[1].split("-")
             if len(dm_ids) == 2:
-                conv = await self.convs.find_dm_between(dm_ids[0], dm_ids[1])
-                if conv:
-                    await self.convs.add_message(conv["_id"], msg)
-        msg["chat_id"] = chat_id
-        return normalize_doc(msg)
\ No newline at end of file
+                room = await self.convs.next_dm_edit_seq(dm_ids[0], dm_ids[1])
+        if room is None:
+            return None
+        last_seq = (room.get("last_message") or {}).get("seq")
+        return {"_id": room["_id"], "edit_seq": room["edit_seq"], "last_seq": last_seq, "is_group": is_group}
+
+    async def _change_message(self, chat_id: str, user_id: str, seq, changes: dict, unset: tuple = (),
+                              owner_may: bool = False) -> dict:
+        """Apply an edit or delete to message `seq` in place and return its update delta.
+
+        The message is updated where it is stored, stamped with a new edit number of
+        its room; the room document only changes when it is the chat list's newest message.
+        Only the sender may change a message (or a group owner, with `owner_may`).
+        Archived messages are read-only."""
+        if isinstance(seq, bool) or not isinstance(seq, int):
+            raise ValueError("invalid_seq")
+        msg = await self.msgs.find_by_seq(chat_id, seq)
+        if msg is None:
+            raise ValueError("message_not_found")
+        if msg.get("deleted"):
+            raise ValueError("message_deleted")
+        if msg.get("sender_id") != user_id:
+            is_owner = (owner_may and chat_id.startswith("group:")
+                        and await self.members.role(chat_id.split(":", 1)[1], user_id) == "owner")
+            if not is_owner:
+                raise PermissionError("not_the_sender")
+        room = await self._allocate_edit_seq(chat_id)
+        if room is None:
+            raise ValueError("message_not_found")
+        updated = await self.msgs.apply_edit(chat_id, seq, room["edit_seq"], changes, unset)
+        if updated is None:
+            # deleted meanwhile, or a concurrent edit with a later number already landed
+            current = await self.msgs.find_by_seq(chat_id, seq)
+            raise ValueError("message_deleted" if current is None or current.get("deleted") else "edit_conflict")
+
+        if settings.message_buffer_enabled:
+            recent_messages.update(chat_id, updated)
+        search_indexer.changed(updated)
+        if room["last_seq"] == seq:
+            repo = self.groups if room["is_group"] else self.convs
+            await repo.edit_last_message(str(room["_id"]), seq, {**changes, "edit_seq": room["edit_seq"]}, unset)
+            unread_counters.touch(chat_id, await membership.members(chat_id))
+        return update_delta(updated)
+
+    async def edit_message(self, chat_id: str, user_id: str, seq, content: str) -> dict:
+        """Replace the text of one of the user's messages. Returns the update delta."""
+        if not isinstance(content, str) or not content.strip():
+            raise ValueError("empty_message")
+        return await self._change_message(chat_id, user_id, seq, {"content": content, "edited_at": datetime.utcnow()})
+
+    async def delete_message(self, chat_id: str, user_id: str, seq) -> dict:
+        """Delete a message, leaving a tombstone (seq, sender and time, no content or attachments)
+        so sequence numbers stay contiguous. Senders and group owners may delete."""
+        return await self._change_message(chat_id, user_id, seq, {"deleted": True, "deleted_at": datetime.utcnow()},
+                                          unset=("content", "attachments", "edited_at"), owner_may=True)
+
+    async def _edits_since(self, chat_id: str, edit_seq, max_seq: Optional[int] = None) -> Optional[dict]:
+        """{"edits": [deltas], "has_more"} for the room's edits after `edit_seq`, None if it is malformed."""
+        try:
+            edit_seq = int(edit_seq or 0)
+        except (TypeError, ValueError):
+            return None
+        limit = settings.sync_max_messages
+        edits = await self.msgs.edits_since(chat_id, edit_seq, max_seq=max_seq, limit=limit + 1)
+        return {"edits": [update_delta(m) for m in edits[:limit]], "has_more": len(edits) > limit}
+
+    async def is_member(self, chat_id: str, user_id: str) -> bool:
+        if chat_id.startswith("dm:"):
+            return user_id in chat_id.split(":", 1)[1].split("-")
+        if chat_id.startswith("group:"):
+            group_id = chat_id.split(":", 1)[1]
+            return ObjectId.is_valid(group_id) and await self.members.is_member(group_id, user_id)
+        return False
+
+    async def get_history(self, chat_id: str, user_id: str, before_seq: Optional[int] = None,
+                          limit: Optional[int] = None, edits_since: Optional[int] = None) -> dict:
+        """A page of room history, oldest first. Pass the smallest seq seen as `before_seq` for older pages.
+        With `edits_since` (the highest edit_seq the client has seen in this room) the result also
+        carries `edits`: update deltas of the messages edited or deleted since."""
+        if not await self.is_member(chat_id, user_id):
+            raise PermissionError("not_a_member")
+        page = await self._history_page(chat_id, before_seq, limit or settings.history_page_size)
+        if edits_since is not None:
+            edits = await self._edits_since(chat_id, edits_since)
+            page["edits"], page["edits_has_more"] = edits["edits"], edits["has_more"]
+        return page
+
+    async def _history_page(self, chat_id: str, before_seq: Optional[int], limit: int) -> dict:
+        # read before the messages, so a page filled into the buffer is at least this current
+        room = await self._room_counters(chat_id)
+        first_seq = room["first_seq"] if room else 1
+        counters = (room["seq"], room["edit_seq"]) if room and settings.message_buffer_enabled else None
+        if counters is not None:
+            buffered = recent_messages.latest(chat_id, limit, counters, first_seq, before_seq=before_seq)
+            if buffered is not None:
+                return {"room_id": chat_id, "messages": buffered,
+                        "has_more": bool(buffered) and buffered[0]["seq"] > first_seq}
+        msgs = await self.msgs.list_for_chat(chat_id, limit=limit + 1, before_seq=before_seq)
+        if len(msgs) <= limit and (not msgs or msgs[0].get("seq", first_seq) > first_seq):
+            # the hot store ran out before the start of the room: older messages may be archived
+            older = await self.archive.list_before(chat_id, msgs[0]["seq"] if msgs else before_seq, limit + 1 - len(msgs))
+            msgs = older + msgs
+        has_more = len(msgs) > limit
+        msgs = msgs[-limit:]
+        if counters is not None and before_seq is None:
+            recent_messages.fill(chat_id, msgs, counters)
+        return {"room_id": chat_id, "messages": msgs, "has_more": has_more}
+
+    async def sync(self, user_id: str, last_seqs: dict, edit_seqs: Optional[dict] = None) -> dict:
+        """Reconnect catch-up: for each {room: last_seq} return only the messages after last_seq.
+        `has_more` means the gap was larger than sync_max_messages and the client should reload history.
+        For rooms also given in `edit_seqs` ({room: highest edit_seq seen}) the result carries `edits`,
+        the update deltas of messages up to last_seq edited or deleted since (later messages are
+        returned whole anyway), with `edits_has_more` when there were more than sync_max_messages.
+        """
+        edit_seqs = edit_seqs if isinstance(edit_seqs, dict) else {}
+        group_ids = set(await self.members.group_ids_for_user(user_id))
+        limit = settings.sync_max_messages
+        out = {}
+        for chat_id, last_seq in last_seqs.items():
+            if chat_id.startswith("group:"):
+                allowed = chat_id.split(":", 1)[1] in group_ids
+            else:
+                allowed = chat_id.startswith("dm:") and user_id in chat_id.split(":", 1)[1].split("-")
+            if not allowed:
+                continue
+            try:
+                last_seq = int(last_seq or 0)
+            except (TypeError, ValueError):
+                continue
+            room = await self._room_counters(chat_id) if settings.message_buffer_enabled else None
+            counters = (room["seq"], room["edit_seq"]) if room else None
+            msgs = recent_messages.since(chat_id, last_seq, limit + 1, counters) if counters is not None else None
+            if msgs is None:
+                msgs = await self.msgs.list_since(chat_id, last_seq, limit=limit + 1)
+                if msgs:
+                    gap = msgs[0].get("seq", last_seq + 1) > last_seq + 1
+                else:
+                    if not settings.message_buffer_enabled:
+                        room = await self._room_counters(chat_id)
+                    # nothing live after last_seq: the client is current unless everything newer was archived
+                    gap = room is not None and last_seq < room["seq"]
+                if gap:
+                    # a gap right after last_seq was archived by the retention job
+                    older = await self.archive.list_since(chat_id, last_seq, limit + 1)
+                    msgs = (older + [m for m in msgs if not older or m["seq"] > older[-1]["seq"]])[:limit + 1]
+            out[chat_id] = {"messages": msgs[:limit], "has_more": len(msgs) > limit}
+            edits = await self._edits_since(chat_id, edit_seqs[chat_id], max_seq=last_seq) if chat_id in edit_seqs else None
+            if edits is not None:
+                out[chat_id]["edits"], out[chat_id]["edits_has_more"] = edits["edits"], edits["has_more"]
+        return out
@@ -1,11 +1,12 @@
 import os
+import html
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
 import random
 import string
-from typing import Literal
+from typing import List, Literal, Tuple
 
 load_dotenv()
 
@@ -14,6 +15,10 @@ SMTP_SERVER = os.getenv("ZOHO_SMTP_SERVER", "smtp.zoho.com")
 SMTP_PORT = int(os.getenv("ZOHO_SMTP_PORT", "587")) 
 SMTP_EMAIL = os.getenv("ZOHO_EMAIL")
 SMTP_PASSWORD = os.getenv("ZOHO_APP_PASSWORD")
+# only for a local relay or test sink: skip STARTTLS (and AUTH when the server does not offer it)
+SMTP_STARTTLS = str(os.getenv("ZOHO_SMTP_STARTTLS", "True")).lower() in ("1", "true", "yes")
+# link back to the app in notification emails
+APP_URL = os.getenv("APP_URL", "")
 
 
 def smtp_is_configured():
@@ -33,22 +38,11 @@ def send_smtp_email(to: str, subject: str, html: str) -> bool:
         print("SMTP settings are not fully configured. Skipping email sending.")
         return False
 
-    assert SMTP_EMAIL is not None
-    assert SMTP_PASSWORD is not None
-
-    msg = MIMEMultipart()
-    msg["From"] = SMTP_EMAIL
-    msg["To"] = to
-    msg["Subject"] = subject
-    msg.attach(MIMEText(html, "html"))
+    msg = _build_message(to, subject, html)
 
     try:
         print(f"Connecting to SMTP server at {SMTP_SERVER}:{SMTP_PORT} as {SMTP_EMAIL}")
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20) as server:
-            server.ehlo()
-            server.starttls()
-            server.ehlo()
-            server.login(SMTP_EMAIL, SMTP_PASSWORD)
+        with _open_smtp() as server:
             server.send_message(msg)
         print(f"Mail sent successfully to {to} via Zoho SMTP (TLS).")
         return True
@@ -64,6 +58,68 @@ def send_smtp_email(to: str, subject: str, html: str) -> bool:
         return False
 
 
+def _build_message(to: str, subject: str, html_body: str) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg["From"] = SMTP_EMAIL
+    msg["To"] = to
+    msg["Subject"] = subject
+    msg.attach(MIMEText(html_body, "html"))
+    return msg
+
+
+def _open_smtp() -> smtplib.SMTP:
+    """A logged-in SMTP connection."""
+    assert SMTP_EMAIL is not None
+    assert SMTP_PASSWORD is not None
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=20)
+    try:
+        server.ehlo()
+        if SMTP_STARTTLS:
+            server.starttls()
+            server.ehlo()
+        if SMTP_STARTTLS or server.has_extn("auth"):
+            server.login(SMTP_EMAIL, SMTP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def send_smtp_batch(emails: List[Tuple[str, str, str]]) -> List[bool]:
+    """Send (to, subject, html) emails over one SMTP connection, in order.
+    Blocking: run it in a thread. Returns one flag per email; a dropped connection is
+    reopened once, and a rejected recipient only fails its own email."""
+    results = []
+    server = None
+    try:
+        for to, subject, html_body in emails:
+            msg = _build_message(to, subject, html_body)
+            for attempt in range(2):
+                try:
+                    if server is None:
+                        server = _open_smtp()
+                    server.send_message(msg)
+                    results.append(True)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    server = None
+                    if attempt:
+                        results.append(False)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                    print(f"SMTP rejected email to {to}: {e}")
+                    results.append(False)
+                    break
+    except Exception as e:
+        print(f"SMTP batch failed after {len(results)} of {len(emails)} emails: {e}")
+    finally:
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+    return results + [False] * (len(emails) - len(results))
+
+
 def generate_otp(length: int = 6) -> str:
     """Generates a random OTP of a given length."""
     return "".join(random.choices(string.digits, k=length))
@@ -105,3 +161,31 @@ def send_confirmation_email(user_email: str, purpose: Literal["password"]) -> bo
     if subject and html_body:
         return send_smtp_email(to=user_email, subject=subject, html=html_body)
     return False
+
+
+def render_digest_email(username: str, rooms: List[dict]) -> Tuple[str, str]:
+    """(subject, html) of a missed-messages digest. Each room is
+    {"name", "count", "last_sender", "last_preview"}; user content is escaped."""
+    total = sum(r["count"] for r in rooms)
+    subject = f"You have {total} unread message{'s' if total != 1 else ''}"
+    items = "".join(
+        f"""
+            <li style="margin-bottom: 8px;">
+                <strong>{html.escape(r["name"])}</strong> ({r["count"]} new)<br>
+                <span style="color: #555;">{html.escape(r["last_sender"] or "")}: {html.escape(r["last_preview"] or "")}</span>
+            </li>"""
+        for r in rooms
+    )
+    link = f'<p><a href="{html.escape(APP_URL)}/chat">Open the chat</a></p>' if APP_URL else ""
+    html_body = f"""
+    <html>
+        <body>
+            <h3>Hi {html.escape(username)}, you missed some messages</h3>
+            <ul style="padding-left: 16px;">{items}
+            </ul>
+            {link}
+            <p>You get at most one of these emails per notification window while you are away.</p>
+        </body>
+    </html>
+    """
+    return subject, html_body
@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict
+from typing import FrozenSet, List
+from bson import ObjectId
+from ..utils.repositories import GroupMemberRepository
+from ..utils.singleflight import SingleFlight
+from ..utils.metrics import metrics
+from ..utils.config import settings
+
+
+# id the room assistant posts under (and of the private AI chat in the UI); not a user
+ASSISTANT_ID = "ai_assistant"
+
+
+def user_channel(user_id: str) -> str:
+    """Socket.IO room every connection of a user joins on connect."""
+    return f"user:{user_id}"
+
+
+class MembershipIndex:
+    """Who is in each room, kept in memory so a message can be fanned out to
+    every member's `user:{id}` channel without a query per send.
+
+    DM members are part of the room id. A group's member ids are loaded with
+    one covered index query (concurrent loads of a room share it) and kept for
+    MEMBERSHIP_CACHE_SECONDS, least recently used rooms beyond
+    MEMBERSHIP_CACHE_ROOMS being dropped. Joins made through this worker update
+    the cached entry in place; the expiry only bounds how long a join made on
+    another worker takes to show up here.
+    """
+
+    def __init__(self, ttl: float, max_rooms: int):
+        self.ttl = ttl
+        self.max_rooms = max_rooms
+        self.repo = GroupMemberRepository()
+        self._groups: "OrderedDict[str, tuple[float, FrozenSet[str]]]" = OrderedDict()
+        self._loads = SingleFlight("membership.member_ids")
+        self._loading: dict[str, set] = {}  # group id -> members added while its list is being loaded
+        self.hits = 0
+        self.misses = 0
+
+    async def members(self, room_id: str) -> FrozenSet[str]:
+        """Member ids of a room; empty for rooms that do not exist or are not rooms."""
+        if room_id.startswith("dm:"):
+            dm_ids = room_id.split(":", 1)[1].split("-")
+            return frozenset(dm_ids) if len(dm_ids) == 2 else frozenset()
+        if not room_id.startswith("group:"):
+            return frozenset()
+        group_id = room_id.split(":", 1)[1]
+        if not ObjectId.is_valid(group_id):
+            return frozenset()
+        entry = self._groups.get(group_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._groups.move_to_end(group_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return await self._loads.do(group_id, lambda: self._load(group_id))
+
+    async def _load(self, group_id: str) -> FrozenSet[str]:
+        self._loading[group_id] = set()
+        try:
+            member_ids = frozenset(await self.repo.member_ids(group_id))
+        finally:
+            joined = self._loading.pop(group_id)
+        member_ids = member_ids.union(joined)
+        self._store(group_id, member_ids)
+        return member_ids
+
+    def _store(self, group_id: str, member_ids: FrozenSet[str]):
+        self._groups[group_id] = (time.monotonic() + self.ttl, member_ids)
+        self._groups.move_to_end(group_id)
+        while len(self._groups) > self.max_rooms:
+            self._groups.popitem(last=False)
+
+    def added(self, group_id: str, user_ids: List[str]):
+        """Record members that just joined a group. Only a cached (or loading) room is
+        updated; otherwise the next lookup loads the full list anyway."""
+        if group_id in self._loading:
+            self._loading[group_id].update(user_ids)
+        entry = self._groups.get(group_id)
+        if entry is not None:
+            self._groups[group_id] = (entry[0], entry[1].union(user_ids))
+
+    def forget(self, group_id: str):
+        self._groups.pop(group_id, None)
+
+    async def channels(self, room_id: str) -> List[str]:
+        """Socket.IO rooms a room's events go to: the room itself (clients that joined it)
+        plus every member's user channel. A connection in several of them gets the event once."""
+        return [room_id, *(user_channel(uid) for uid in sorted(await self.members(room_id)))]
+
+    def stats(self) -> dict:
+        return {"rooms": len(self._groups), "hits": self.hits, "misses": self.misses}
+
+
+membership = MembershipIndex(settings.membership_cache_seconds, settings.membership_cache_rooms)
+metrics.register("membership", membership.stats)
@@ -0,0 +1,195 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List, Optional
+from ..utils.repositories import NotificationRepository, UnreadCounterRepository, UserRepository
+from ..utils.background import register_periodic
+from ..utils.rate_limit import MemoryBucketStore, parse_rule
+from ..utils.metrics import metrics
+from ..utils.config import settings
+from .presence_service import online_users
+from . import email_service
+
+PREVIEW_CHARS = 140
+# users handled per round of the digest run: one summary, user and unread-count query each
+USERS_PER_ROUND = 1000
+# after this many failed sends a user's queued notifications are dropped
+MAX_ATTEMPTS = 3
+# how long a digest run holds a user: well beyond one round, short enough to recover from a crashed worker
+CLAIM_SECONDS = 300
+
+
+def _as_datetime(value) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _render_and_send(batch: List[tuple]) -> List[bool]:
+    """Render and send (to, username, rooms) digests over one SMTP connection (runs in a thread)."""
+    return email_service.send_smtp_batch([(to, *email_service.render_digest_email(username, rooms))
+                                          for to, username, rooms in batch])
+
+
+class NotificationDigests:
+    """Emails users a digest of the direct messages they missed while offline.
+
+    A DM to a recipient with no live connection on this worker is queued in
+    memory and written to `notification_queue` by a periodic flush, so the send
+    path only pays for a list append. The digest run picks users whose oldest
+    queued notification has waited NOTIFY_DIGEST_WINDOW_SECONDS and, a round
+    of USERS_PER_ROUND at a time, summarizes their queue per room. Every
+    worker runs the job, so a round first claims its users with a lease in
+    `notification_claims`; users another run holds are left to it, and users
+    it already handled are no longer due. Rooms they have read meanwhile
+    (unread count 0) and users connected to any worker (see OnlineUsers) are
+    dropped without an email; everyone else gets one digest, whatever the
+    number of messages.
+
+    Digests are sent NOTIFY_SMTP_BATCH to a connection over up to
+    NOTIFY_SMTP_CONNECTIONS connections at once, in threads since smtplib
+    blocks. Each recipient domain has a token bucket (NOTIFY_DOMAIN_RATE);
+    digests over it stay queued for the next run, as do failed ones (up to
+    MAX_ATTEMPTS).
+    """
+
+    def __init__(self):
+        self.repo = NotificationRepository()
+        self.unread = UnreadCounterRepository()
+        self.users = UserRepository()
+        self._queue: List[dict] = []
+        self._domains = MemoryBucketStore()
+        self._domain_rule = parse_rule(settings.notify_domain_rate)
+        # set by the socket server: whether a user has a live connection on this worker (a cheap
+        # first filter on the send path; the digest run checks presence across workers)
+        self.is_online: Callable[[str], bool] = lambda user_id: False
+        self.last_run: dict = {}
+
+    @property
+    def enabled(self) -> bool:
+        return settings.notify_digests and bool(email_service.SMTP_EMAIL and email_service.SMTP_PASSWORD)
+
+    def record_message(self, msg: dict, recipient_ids: Iterable[str]):
+        if not self.enabled:
+            return
+        for user_id in recipient_ids:
+            if user_id == msg.get("sender_id") or self.is_online(user_id):
+                continue
+            self._queue.append({
+                "user_id": user_id,
+                "room_id": msg["chat_id"],
+                "sender_username": msg.get("sender_username"),
+                "preview": (msg.get("content") or "")[:PREVIEW_CHARS],
+                "created_at": datetime.utcnow(),
+            })
+
+    async def flush(self):
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        await self.repo.insert_many(batch)
+
+    async def _send(self, digests: List[tuple]) -> List[bool]:
+        """Send (to, username, rooms) digests; returns one flag per digest."""
+        size = max(1, settings.notify_smtp_batch)
+        batches = [digests[i:i + size] for i in range(0, len(digests), size)]
+        slots = asyncio.Semaphore(max(1, settings.notify_smtp_connections))
+
+        async def send(batch):
+            async with slots:
+                return await asyncio.to_thread(_render_and_send, batch)
+
+        results = await asyncio.gather(*(send(b) for b in batches))
+        return [ok for batch_results in results for ok in batch_results]
+
+    async def _round(self, user_ids: List[str], cutoff: datetime, until: datetime, stats: dict):
+        owner = uuid.uuid4().hex
+        user_ids = await self.repo.claim(user_ids, owner, until + timedelta(seconds=CLAIM_SECONDS))
+        try:
+            await self._digest(user_ids, cutoff, until, stats)
+        finally:
+            await self.repo.release(user_ids, owner)
+
+    async def _digest(self, user_ids: List[str], cutoff: datetime, until: datetime, stats: dict):
+        summaries = await self.repo.summarize(user_ids, until)
+        # handled by another run since they were listed: what is left has not waited long enough
+        due = {s["_id"]["user_id"] for s in summaries if _as_datetime(s["first_at"]) <= cutoff}
+        user_ids = [uid for uid in user_ids if uid in due]
+        if not user_ids:
+            return
+        users = await self.users.find_by_ids(user_ids)
+        online = await online_users.online(user_ids)
+        rooms_by_user: dict[str, list] = {uid: [] for uid in user_ids}
+        attempts: dict[str, int] = {}
+        for s in summaries:
+            uid = s["_id"]["user_id"]
+            if uid not in rooms_by_user:
+                continue
+            rooms_by_user[uid].append(s)
+            attempts[uid] = max(attempts.get(uid, 0), s.get("attempts") or 0)
+        unread = {
+            (c["user_id"], c["room_id"]): c.get("count", 0)
+            for c in await self.unread.counts_for(user_ids, list({s["_id"]["room_id"] for s in summaries}))
+        }
+
+        digests, digest_users, dropped = [], [], []
+        for uid in user_ids:
+            user = users.get(uid) or {}
+            rooms = []
+            for s in rooms_by_user[uid]:
+                count = unread.get((uid, s["_id"]["room_id"]), s["count"])
+                if count:
+                    rooms.append({"name": s.get("last_sender") or "Someone", "count": count,
+                                  "last_sender": s.get("last_sender"), "last_preview": s.get("last_preview")})
+            if (not rooms or not user.get("email") or uid in online
+                    or attempts.get(uid, 0) >= MAX_ATTEMPTS):
+                dropped.append(uid)
+                continue
+            domain = user["email"].rpartition("@")[2].lower()
+            allowed, _ = await self._domains.take(domain, self._domain_rule)
+            if not allowed:
+                stats["deferred"] += 1
+                continue
+            rooms.sort(key=lambda r: r["count"], reverse=True)
+            digests.append((user["email"], user.get("username") or "there", rooms[:settings.notify_digest_max_rooms]))
+            digest_users.append(uid)
+
+        results = await self._send(digests) if digests else []
+        sent = [uid for uid, ok in zip(digest_users, results) if ok]
+        failed = [uid for uid, ok in zip(digest_users, results) if not ok]
+        await self.repo.delete_for(sent + dropped, until)
+        await self.repo.mark_failed(failed, until)
+        stats["sent"] += len(sent)
+        stats["failed"] += len(failed)
+        stats["dropped"] += len(dropped)
+
+    async def run(self):
+        if not self.enabled:
+            return
+        await self.flush()
+        started, now = time.monotonic(), datetime.utcnow()
+        cutoff = now - timedelta(seconds=settings.notify_digest_window_seconds)
+        stats = {"sent": 0, "failed": 0, "dropped": 0, "deferred": 0}
+        after: Optional[str] = None
+        while True:
+            user_ids = await self.repo.due_users(cutoff, after, USERS_PER_ROUND)
+            if not user_ids:
+                break
+            after = user_ids[-1]
+            await self._round(user_ids, cutoff, now, stats)
+        for key, value in stats.items():
+            metrics.inc(f"notifications.{key}", value)
+        self.last_run = {"at": now.isoformat(), **stats, "seconds": round(time.monotonic() - started, 3)}
+        if stats["sent"] or stats["failed"]:
+            print(f"Notification digests: {stats['sent']} sent, {stats['failed']} failed, "
+                  f"{stats['deferred']} deferred by domain limits")
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "queued": len(self._queue), "last_run": self.last_run}
+
+
+notification_digests = NotificationDigests()
+register_periodic("notification-queue-flush", 1.0, notification_digests.flush)
+# nothing is buffered by the run itself; an interrupted run is simply repeated by the next one
+register_periodic("notification-digests", settings.notify_digest_interval_seconds, notification_digests.run,
+                  flush_on_stop=False)
+metrics.register("notifications", notification_digests.stats)
@@ -0,0 +1,140 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Iterable, List
+from ..utils.repositories import ReadReceiptRepository, PresenceRepository
+from ..utils.background import register_periodic
+from ..utils.config import settings
+
+# emit(event, data, room=...) -- normally `sio.emit`
+Emitter = Callable[..., Awaitable[None]]
+
+
+class TypingBatcher:
+    """Coalesces typing notifications per room.
+
+    Keystrokes from a user are throttled (at most one accepted per
+    `typing_throttle_seconds`), and each room gets at most one `typing` broadcast
+    per flush interval carrying the full list of users currently typing.
+    """
+
+    def __init__(self, emit: Emitter):
+        self.emit = emit
+        # room -> {user_id: (username, expires_at)}
+        self._typing: dict[str, dict[str, tuple[str, float]]] = {}
+        # (room, user_id) -> last accepted time
+        self._last_seen: dict[tuple[str, str], float] = {}
+        self._dirty: set[str] = set()
+
+    def touch(self, room: str, user_id: str, username: str) -> bool:
+        """Record that a user is typing. Returns False if throttled."""
+        now = time.monotonic()
+        key = (room, user_id)
+        last = self._last_seen.get(key)
+        if last is not None and now - last < settings.typing_throttle_seconds:
+            return False
+        self._last_seen[key] = now
+        users = self._typing.setdefault(room, {})
+        if user_id not in users:
+            self._dirty.add(room)
+        users[user_id] = (username, now + settings.typing_expire_seconds)
+        return True
+
+    def stop(self, room: str, user_id: str):
+        """User stopped typing (sent a message, cleared the input, left)."""
+        self._last_seen.pop((room, user_id), None)
+        users = self._typing.get(room)
+        if users and users.pop(user_id, None) is not None:
+            self._dirty.add(room)
+
+    def _expire(self, now: float):
+        for room, users in list(self._typing.items()):
+            expired = [uid for uid, (_, exp) in users.items() if exp <= now]
+            for uid in expired:
+                del users[uid]
+                self._last_seen.pop((room, uid), None)
+            if expired:
+                self._dirty.add(room)
+            if not users:
+                del self._typing[room]
+
+    async def flush(self):
+        self._expire(time.monotonic())
+        dirty, self._dirty = self._dirty, set()
+        for room in dirty:
+            users = self._typing.get(room, {})
+            payload = {"room": room, "users": [{"user_id": uid, "username": name} for uid, (name, _) in users.items()]}
+            await self.emit("typing", payload, room=room)
+
+
+class ReadReceiptBuffer:
+    """Write-coalescing buffer for "last read" watermarks.
+
+    Many `read` events for the same (user, room) between flushes collapse into
+    one `$max` upsert, and each room gets one `receipts` broadcast per flush.
+    """
+
+    def __init__(self, emit: Emitter):
+        self.emit = emit
+        self.repo = ReadReceiptRepository()
+        self._pending: dict[tuple[str, str], datetime] = {}
+
+    def mark_read(self, user_id: str, room: str, last_read_at: datetime):
+        key = (user_id, room)
+        current = self._pending.get(key)
+        if current is None or last_read_at > current:
+            self._pending[key] = last_read_at
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self.repo.bulk_advance(pending)
+        except Exception:
+            # put the batch back (later marks win, as usual) so the next flush retries it
+            for (user_id, room), ts in pending.items():
+                self.mark_read(user_id, room, ts)
+            raise
+
+        by_room: dict[str, list[dict]] = {}
+        for (user_id, room), ts in pending.items():
+            by_room.setdefault(room, []).append({"user_id": user_id, "last_read_at": ts.isoformat()})
+        for room, receipts in by_room.items():
+            await self.emit("receipts", {"room": room, "receipts": receipts}, room=room)
+
+
+class OnlineUsers:
+    """Which users are connected to any worker, for decisions one worker cannot make from its
+    own sockets (e.g. whether a user is offline and should get an email digest).
+
+    Each worker writes one `presence` document per user connected to it when
+    they connect, refreshes them all every PRESENCE_HEARTBEAT_SECONDS and
+    removes a user's document when their last connection to it closes. A user
+    counts as online while some worker's document is younger than three
+    heartbeats, so a crashed worker's users go offline on their own.
+    """
+
+    def __init__(self):
+        self.repo = PresenceRepository()
+        self.worker = uuid.uuid4().hex
+        # set by the socket server: ids of the users with a connection on this worker
+        self.local_users: Callable[[], Iterable[str]] = lambda: ()
+
+    async def connected(self, user_id: str):
+        await self.repo.heartbeat(self.worker, [user_id])
+
+    async def disconnected(self, user_id: str):
+        await self.repo.remove(self.worker, user_id)
+
+    async def heartbeat(self):
+        await self.repo.heartbeat(self.worker, list(self.local_users()))
+
+    async def online(self, user_ids: List[str]) -> set[str]:
+        seen_after = datetime.utcnow() - timedelta(seconds=3 * settings.presence_heartbeat_seconds)
+        return await self.repo.online(user_ids, seen_after)
+
+
+online_users = OnlineUsers()
+register_periodic("presence-heartbeat", settings.presence_heartbeat_seconds, online_users.heartbeat,
+                  flush_on_stop=False)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from ..utils.repositories import (
+    MessageRepository,
+    MessageArchiveRepository,
+    MessageSearchRepository,
+    GroupRepository,
+    ConversationRepository,
+)
+from ..utils.background import register_periodic
+from ..utils.metrics import metrics
+from ..utils.overload import overload
+from ..utils.config import settings
+
+
+def _created_at(msg: dict) -> Optional[datetime]:
+    value = msg.get("created_at")
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class RetentionJob:
+    """Moves messages past their room's retention period into `message_archive`.
+
+    A room's period is its own `retention_days` when set, else RETENTION_DAYS;
+    0 keeps everything. Rooms are walked one at a time from their oldest
+    message: each run of up to RETENTION_SEGMENT_SIZE expired messages is
+    written as one compressed segment and only then deleted from `messages`
+    and the `message_search` index, so an interrupted run leaves duplicates
+    (skipped next time), never gaps, and search never returns archived text.
+
+    The job paces itself to RETENTION_RATE messages per second by sleeping
+    after every segment, which keeps its reads and deletes a small, steady
+    load next to live traffic instead of a burst. It stops early whenever the
+    worker starts shedding load and carries on at the next run.
+    """
+
+    def __init__(self):
+        self.msgs = MessageRepository()
+        self.archive = MessageArchiveRepository()
+        self.search = MessageSearchRepository()
+        self.groups = GroupRepository()
+        self.convs = ConversationRepository()
+        self.last_run: dict = {}
+
+    async def _policies(self):
+        async for room in self.groups.retention_policies():
+            yield room
+        async for room in self.convs.retention_policies():
+            yield room
+
+    async def archive_room(self, chat_id: str, cutoff: datetime) -> int:
+        """Archive every message of `chat_id` created before `cutoff`. Returns how many were moved."""
+        moved = 0
+        while not overload.level:
+            batch = await self.msgs.oldest(chat_id, settings.retention_segment_size)
+            # seq order is creation order, so the expired messages are a prefix of the batch
+            expired = []
+            for m in batch:
+                created_at = _created_at(m)
+                if created_at is None or created_at >= cutoff:
+                    break
+                expired.append(m)
+            if not expired:
+                return moved
+            last_seq = await self.archive.insert_segment(chat_id, expired)
+            # drop the search copies before the messages, so a failure in between leaves the
+            # messages in place and the next run deletes both
+            await self.search.delete_range(chat_id, expired[0]["seq"], last_seq)
+            moved += await self.msgs.delete_range(chat_id, expired[0]["seq"], last_seq)
+            metrics.inc("retention.segments")
+            await asyncio.sleep(len(expired) / settings.retention_rate)
+            if len(expired) < len(batch):
+                return moved
+        return moved
+
+    async def run(self):
+        started, now = time.monotonic(), datetime.utcnow()
+        rooms = moved = 0
+        async for chat_id, days in self._policies():
+            if overload.level:
+                break
+            days = settings.retention_days if days is None else days
+            if not days:
+                continue
+            count = await self.archive_room(chat_id, now - timedelta(days=days))
+            if count:
+                rooms += 1
+                moved += count
+                metrics.inc("retention.archived_messages", count)
+        self.last_run = {"at": now.isoformat(), "rooms": rooms, "messages": moved,
+                         "seconds": round(time.monotonic() - started, 3)}
+        if moved:
+            print(f"Retention: archived {moved} messages from {rooms} rooms")
+
+    def stats(self) -> dict:
+        return {"retention_days": settings.retention_days, "last_run": self.last_run}
+
+
+retention_job = RetentionJob()
+# nothing is buffered, so a run interrupted by shutdown is simply picked up by the next one
+register_periodic("retention", settings.retention_interval_seconds, retention_job.run, flush_on_stop=False)
+metrics.register("retention", retention_job.stats)
@@ -0,0 +1,136 @@
+import asyncio
+import re
+import uuid
+from typing import Awaitable, Callable, Optional
+from .ai_loader import get_ai_service
+from .chat_service import ChatService
+from .membership_service import membership, ASSISTANT_ID
+from ..utils.config import settings
+from ..utils.metrics import metrics
+
+# sender id of replies the assistant posts into rooms
+AI_SENDER_ID = ASSISTANT_ID
+AI_USERNAME = "AI Assistant"
+
+
+class TokenBatcher:
+    """Collects streamed tokens and emits them to `channels` as one `ai_token` event per flush interval.
+
+    Each event carries the text added since the previous one and its `offset`
+    in the full reply, so a client that missed an event can tell and simply
+    wait for the final message.
+    """
+
+    def __init__(self, emit: Callable[..., Awaitable[None]], room: str, channels: list, stream_id: str, interval: float):
+        self.emit = emit
+        self.room = room
+        self.channels = channels
+        self.stream_id = stream_id
+        self.interval = interval
+        self.text = ""
+        self._sent = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, token: str):
+        self.text += token
+
+    async def _flush(self):
+        if len(self.text) > self._sent:
+            chunk, offset = self.text[self._sent:], self._sent
+            self._sent = len(self.text)
+            metrics.inc("room_ai.token_emits")
+            await self.emit("ai_token", {"room": self.room, "stream_id": self.stream_id,
+                                         "offset": offset, "text": chunk}, room=self.channels)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._flush()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._flush()
+
+
+class RoomAssistant:
+    """The AI assistant inside group rooms, invoked by mentioning it (AI_MENTION, "@ai").
+
+    Each invocation runs exactly one `get_ai_response_stream` generation. Its
+    tokens are batched by a TokenBatcher and broadcast once per flush to the
+    whole room, and the finished reply is stored once as a regular room
+    message. So a room of fifty members watching one answer costs one LLM call
+    and one emit per flush interval. A room runs at most one generation at a time.
+    """
+
+    def __init__(self):
+        self.chat = ChatService()
+        self._running: dict[str, asyncio.Task] = {}
+        # set by the socket server: emit(event, data, room=...)
+        self.emit: Optional[Callable[..., Awaitable[None]]] = None
+
+    @staticmethod
+    def mentioned(content: str) -> bool:
+        mention = settings.ai_mention
+        return bool(mention) and re.search(rf"(?<!\w){re.escape(mention)}\b", content or "", re.IGNORECASE) is not None
+
+    def busy(self, room: str) -> bool:
+        return room in self._running
+
+    def invoke(self, room: str, user_id: str, message: dict) -> Optional[str]:
+        """Start a reply to `message` in the background. Returns its stream id, or None if the
+        room already has a generation running."""
+        if self.busy(room):
+            return None
+        stream_id = uuid.uuid4().hex
+        task = asyncio.get_running_loop().create_task(self._reply(room, user_id, message, stream_id))
+        self._running[room] = task
+        task.add_done_callback(lambda _: self._running.pop(room, None))
+        return stream_id
+
+    async def _history(self, room: str, user_id: str, before_seq: Optional[int]) -> list:
+        page = await self.chat.get_history(room, user_id, before_seq=before_seq, limit=settings.ai_room_context_messages)
+        history = []
+        for m in page["messages"]:
+            if m.get("sender_id") == AI_SENDER_ID:
+                history.append({"role": "assistant", "content": m.get("content", "")})
+            else:
+                history.append({"role": "user", "content": f"{m.get('sender_username', 'someone')}: {m.get('content', '')}"})
+        return history
+
+    async def _reply(self, room: str, user_id: str, message: dict, stream_id: str):
+        metrics.inc("room_ai.invocations")
+        channels = await membership.channels(room)
+        await self.emit("ai_start", {"room": room, "stream_id": stream_id, "reply_to": message.get("seq")}, room=channels)
+        batcher = TokenBatcher(self.emit, room, channels, stream_id, settings.ai_token_flush_ms / 1000)
+        try:
+            history = await self._history(room, user_id, message.get("seq"))
+            prompt = f"{message.get('sender_username', 'someone')}: {message.get('content', '')}"
+            ai_service = await get_ai_service()
+            batcher.start()
+            async for token in ai_service.get_ai_response_stream(prompt, history):
+                batcher.add(token)
+            await batcher.close()
+        except Exception as e:
+            await batcher.close()
+            metrics.inc("room_ai.errors")
+            print(f"Room AI reply in {room} failed: {e}")
+            await self.emit("ai_error", {"room": room, "stream_id": stream_id, "error": "ai_failed"}, room=channels)
+            return
+        reply = await self.chat.post_message(room, AI_SENDER_ID, batcher.text, is_group=True,
+                                             sender_username=AI_USERNAME)
+        await self.emit("message", {"message": reply, "stream_id": stream_id}, room=channels)
+
+    def stats(self) -> dict:
+        return {"running": len(self._running)}
+
+
+room_assistant = RoomAssistant()
+metrics.register("room_ai", room_assistant.stats)
@@ -0,0 +1,105 @@
+import html
+import re
+from typing import Dict, List, Optional
+from ..utils.repositories import MessageSearchRepository, GroupMemberRepository, ConversationRepository
+from ..utils.background import register_periodic
+from ..utils.config import settings
+
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def highlight(content: str, terms: List[str]) -> str:
+    """HTML-escaped `content` with every occurrence of the search terms wrapped in <mark>."""
+    if not terms:
+        return html.escape(content)
+    alternatives = "|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True))
+    pattern = re.compile(rf"\b(?:{alternatives})\b", re.IGNORECASE)
+    out, last = [], 0
+    for m in pattern.finditer(content):
+        out.append(html.escape(content[last:m.start()]))
+        out.append(f"<mark>{html.escape(m.group(0))}</mark>")
+        last = m.end()
+    out.append(html.escape(content[last:]))
+    return "".join(out)
+
+
+class SearchIndexer:
+    """Queues stored messages and indexes them in batches from a background flush,
+    so the send path only pays for a list append. Edits and deletes are queued the
+    same way and applied after the inserts of the same flush. A batch whose write
+    fails goes back to the front of its queue for the next flush."""
+
+    def __init__(self):
+        self.repo = MessageSearchRepository()
+        self._queue: List[dict] = []
+        self._changes: Dict[str, Optional[str]] = {}  # message id -> new content, None when deleted
+
+    def enqueue(self, msg: dict):
+        if msg.get("_id") and msg.get("content"):
+            self._queue.append(msg)
+
+    def changed(self, msg: dict):
+        """Queue an edited or deleted message; only its latest state is applied."""
+        if msg.get("_id"):
+            self._changes[msg["_id"]] = None if msg.get("deleted") else msg.get("content")
+
+    async def flush(self):
+        if self._queue:
+            await self._insert()
+        if self._changes:
+            changes, self._changes = self._changes, {}
+            try:
+                await self.repo.apply_changes(changes)
+            except Exception:
+                # changes queued since are newer and win
+                self._changes = {**changes, **self._changes}
+                raise
+
+    async def _insert(self):
+        batch, self._queue = self._queue, []
+        try:
+            # re-inserting the part that did get written is harmless: duplicates are skipped
+            await self.repo.insert_many([self.repo.document(m) for m in batch])
+        except Exception:
+            self._queue[:0] = batch
+            raise
+
+
+search_indexer = SearchIndexer()
+register_periodic("search-index-flush", settings.search_flush_seconds, search_indexer.flush)
+
+
+class SearchService:
+    def __init__(self):
+        self.index = MessageSearchRepository()
+        self.members = GroupMemberRepository()
+        self.convs = ConversationRepository()
+
+    async def search(self, user_id: str, query: str, room: Optional[str] = None, page: int = 1,
+                     limit: Optional[int] = None) -> dict:
+        """Ranked, paginated, highlighted search over the rooms the user belongs to."""
+        limit = limit or settings.search_page_size
+        rooms = [f"group:{gid}" for gid in await self.members.group_ids_for_user(user_id)]
+        rooms += await self.convs.room_ids_for_participant(user_id)
+        if room is not None:
+            rooms = [r for r in rooms if r == room]
+        terms = [t.lower() for t in _TERM_RE.findall(query)]
+        if not rooms or not terms:
+            return {"query": query, "page": page, "results": [], "has_more": False}
+
+        hits = await self.index.search(query, rooms, skip=(page - 1) * limit, limit=limit + 1)
+        results = [
+            {
+                "_id": h["_id"],
+                "chat_id": h["chat_id"],
+                "seq": h.get("seq"),
+                "sender_id": h.get("sender_id"),
+                "sender_username": h.get("sender_username"),
+                "created_at": h.get("created_at"),
+                "content": h["content"],
+                "highlighted": highlight(h["content"], terms),
+                "score": h.get("score"),
+            }
+            for h in hits[:limit]
+        ]
+        return {"query": query, "page": page, "results": results, "has_more": len(hits) > limit}
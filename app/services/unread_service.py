@@ -0,0 +1,125 @@
+from typing import Awaitable, Callable, Iterable, Optional
+from ..utils.repositories import UnreadCounterRepository, ChatListVersionRepository
+from ..utils.background import register_periodic
+from ..utils.config import settings
+from .membership_service import user_channel, ASSISTANT_ID
+
+
+def list_version(epoch: int, v: int) -> str:
+    """The opaque chat list version clients send back as `since` (and see as the ETag)."""
+    return f"{epoch}.{v}"
+
+
+class UnreadCounters:
+    """Incrementally maintained unread counts per (user, room).
+
+    Message fan-out and reads only touch in-memory pending state; a periodic
+    flush turns it into one bulk write and pushes fresh counts to the affected
+    users over their `user:{id}` socket channel.
+
+    The flush also advances the chat list version of every affected user, once
+    per flush however many messages arrived, and stamps the changed rooms with
+    it (see ChatListVersionRepository). Other changes to a room that show in
+    its members' lists are queued the same way with `touch`.
+    """
+
+    def __init__(self):
+        self.repo = UnreadCounterRepository()
+        self.versions = ChatListVersionRepository()
+        self._increments: dict[tuple[str, str], int] = {}
+        self._resets: set[tuple[str, str]] = set()
+        self._touched: set[tuple[str, str]] = set()
+        # pending marks written by `apply` whose version bump or stamp failed: (user, room) -> marks
+        self._unstamped: dict[tuple[str, str], int] = {}
+        # set by the socket server: emit(event, data, room=...)
+        self.emit: Optional[Callable[..., Awaitable[None]]] = None
+
+    def record_message(self, room_id: str, sender_id: str, member_ids: Iterable[str]):
+        for member_id in member_ids:
+            if member_id == sender_id or member_id == ASSISTANT_ID:
+                continue
+            key = (member_id, room_id)
+            self._increments[key] = self._increments.get(key, 0) + 1
+        # sending into a room implies having read it
+        self.mark_read(sender_id, room_id)
+
+    def mark_read(self, user_id: str, room_id: str):
+        if user_id == ASSISTANT_ID:
+            return  # the assistant has no chat list
+        key = (user_id, room_id)
+        self._increments.pop(key, None)
+        self._resets.add(key)
+
+    def touch(self, room_id: str, user_ids: Iterable[str]):
+        """Note that `room_id` changed (or appeared) in these users' chat lists."""
+        self._touched.update((uid, room_id) for uid in user_ids if uid != ASSISTANT_ID)
+
+    async def counts_for_user(self, user_id: str) -> dict[str, int]:
+        """Stored counts for a user (one query) with not-yet-flushed changes applied."""
+        counts = await self.repo.counts_for_user(user_id)
+        for uid, room_id in self._resets:
+            if uid == user_id:
+                counts.pop(room_id, None)
+        for (uid, room_id), delta in self._increments.items():
+            if uid == user_id:
+                counts[room_id] = counts.get(room_id, 0) + delta
+        return counts
+
+    def _restore(self, increments: dict[tuple[str, str], int], resets: set[tuple[str, str]],
+                 touches: set[tuple[str, str]]):
+        """Merge a batch whose write failed back into the pending state, as if it had been
+        recorded before everything pending now, so the next flush retries it."""
+        for key, n in increments.items():
+            if key not in self._resets:  # read since: the older messages no longer count
+                self._increments[key] = self._increments.get(key, 0) + n
+        self._resets |= resets
+        self._touched |= touches
+
+    async def flush(self):
+        if not self._increments and not self._resets and not self._touched and not self._unstamped:
+            return
+        increments, self._increments = self._increments, {}
+        resets, self._resets = self._resets, set()
+        touches, self._touched = self._touched, set()
+        touched = touches | set(increments) | resets
+        try:
+            await self.repo.apply(increments, resets, touches)
+        except Exception:
+            self._restore(increments, resets, touches)
+            raise
+
+        # versions move only after the changes are written, so whoever reads the new
+        # version reads the new state too; the rooms stay marked pending until stamped
+        marks, self._unstamped = self._unstamped, {}
+        for key in touched:
+            marks[key] = marks.get(key, 0) + 1
+        users = list({uid for uid, _ in marks})
+        try:
+            versions = await self.versions.bump(users)
+            await self.repo.stamp({(uid, rid): versions[uid][1] for uid, rid in marks if uid in versions}, marks)
+        except Exception:
+            # written but not versioned: the next flush bumps and stamps these rooms
+            for key, n in marks.items():
+                self._unstamped[key] = self._unstamped.get(key, 0) + n
+            raise
+
+        if self.emit is None:
+            return
+        rooms = list({rid for _, rid in touched})
+        counts: dict[str, dict[str, int]] = {uid: {} for uid in users}
+        for c in await self.repo.counts_for(users, rooms):
+            if (c["user_id"], c["room_id"]) in touched:
+                counts[c["user_id"]][c["room_id"]] = c["count"]
+        # a client that applies these counts (and the messages it was sent) is current at the new
+        # version, unless a room changed in some other way it was not told about
+        # (rooms left over from a failed stamp count as such)
+        other_changes = {uid for uid, _ in (touches - set(increments) - resets) | (set(marks) - touched)}
+        for uid, room_counts in counts.items():
+            payload = {"counts": room_counts}
+            if uid in versions and uid not in other_changes:
+                payload["version"] = list_version(*versions[uid])
+            await self.emit("unread", payload, room=user_channel(uid))
+
+
+unread_counters = UnreadCounters()
+register_periodic("unread-flush", settings.unread_flush_seconds, unread_counters.flush)
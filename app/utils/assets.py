@@ -0,0 +1,87 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Optional
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:  # brotli is optional; without it only gzip variants are produced
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# only text-like assets above this size are worth precompressing
+_COMPRESS_MIN_BYTES = 1024
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+REVALIDATE_CACHE = "no-cache"
+
+
+class Asset:
+    """A static file held in memory with its precompressed variants."""
+
+    __slots__ = ("name", "media_type", "digest", "variants")
+
+    def __init__(self, name: str, body: bytes):
+        self.name = name
+        self.media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.digest = hashlib.sha256(body).hexdigest()
+        # content-encoding ("identity", "br", "gzip") -> body
+        self.variants: dict[str, bytes] = {"identity": body}
+        if len(body) >= _COMPRESS_MIN_BYTES and self.media_type.startswith(_COMPRESSIBLE):
+            if brotli is not None:
+                self._add_variant("br", brotli.compress(body, quality=11))
+            self._add_variant("gzip", gzip.compress(body, compresslevel=9, mtime=0))
+
+    def _add_variant(self, encoding: str, body: bytes):
+        if len(body) < len(self.variants["identity"]):
+            self.variants[encoding] = body
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.digest[:32]}"' if encoding == "identity" else f'"{self.digest[:32]}-{encoding}"'
+
+    def pick_encoding(self, accept_encoding: str) -> str:
+        accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+class AssetStore:
+    """Loads the static directory once, precompresses it, and serves it from memory
+    with ETag revalidation."""
+
+    def __init__(self):
+        self._by_name: dict[str, Asset] = {}
+
+    def load(self, directory: str):
+        by_name = {}
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    asset = Asset(name, f.read())
+                by_name[name] = asset
+        self._by_name = by_name
+        print(f"Loaded {len(by_name)} static assets from {directory}")
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self._by_name.get(name)
+
+    def response(self, request: Request, asset: Asset, cache_control: str = REVALIDATE_CACHE) -> Response:
+        encoding = asset.pick_encoding(request.headers.get("accept-encoding", ""))
+        headers = {"ETag": asset.etag(encoding), "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match:
+            tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+            if "*" in tags or tags & {asset.etag(e) for e in asset.variants}:
+                return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+
+assets = AssetStore()
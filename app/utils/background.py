@@ -0,0 +1,66 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class PeriodicTask:
+    """Runs an async callable every `interval` seconds on the event loop.
+
+    Used by the buffering subsystems (typing, receipts, counters, ...) to flush
+    coalesced work. Exceptions are logged and the loop keeps going.
+    """
+
+    def __init__(self, name: str, interval: float, fn: Callable[[], Awaitable[None]], flush_on_stop: bool = True):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.flush_on_stop = flush_on_stop
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(), name=self.name)
+
+    async def stop(self):
+        """Cancel the loop and run one last flush so buffered work is not lost.
+        Jobs that hold no buffered work (flush_on_stop=False) are only cancelled."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.flush_on_stop:
+            await self._safe_call()
+
+    async def _safe_call(self):
+        try:
+            await self.fn()
+        except Exception as e:
+            print(f"Background task {self.name} failed: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._safe_call()
+
+
+_tasks: list[PeriodicTask] = []
+
+
+def register_periodic(name: str, interval: float, fn: Callable[[], Awaitable[None]],
+                      flush_on_stop: bool = True) -> PeriodicTask:
+    """Register a periodic task; it is started/stopped with the application."""
+    task = PeriodicTask(name, interval, fn, flush_on_stop)
+    _tasks.append(task)
+    return task
+
+
+def start_all():
+    for task in _tasks:
+        task.start()
+
+
+async def stop_all():
+    for task in _tasks:
+        await task.stop()
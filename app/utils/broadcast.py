@@ -0,0 +1,115 @@
+import heapq
+from .metrics import metrics
+
+# state snapshots that the next broadcast supersedes, safe to skip for a lagging client
+# (streamed AI tokens are superseded by the final reply, which is a regular message)
+NON_CRITICAL_EVENTS = frozenset({"typing", "receipts", "unread", "system", "ai_token"})
+
+
+class SlowConsumerGuard:
+    """Bounds what the server buffers for clients that read slower than we write.
+
+    Engine.IO keeps one unbounded outbound queue per connection. Every emit
+    addressed to rooms or sids looks at its recipients' queues before anything
+    is queued:
+
+    - above the soft limit non-critical events (typing, receipts, unread
+      counts, join notices) are not queued for the connection; each is a full
+      snapshot, so the next one it does receive is current again.
+    - at the hard limit the backlog is dropped, a `resync` event is queued and
+      the transport is closed instead of queueing one more packet. The client
+      reconnects, catches up with `sync` from its last seen seq and reloads
+      the room it has open.
+
+    So per-connection memory stays bounded by the hard limit (plus the batch
+    the transport is currently writing) however slow the worst client is. A
+    periodic sample also feeds the metrics and covers whole-namespace broadcasts.
+    """
+
+    def __init__(self, server, soft_limit: int, hard_limit: int):
+        self.server = server
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self._slow: set[str] = set()  # socket.io sids over the soft limit
+        self._depths: dict[str, int] = {}  # sid -> queue depth at the last sample
+
+    def _queue_depths(self):
+        manager = self.server.manager
+        for eio_sid, socket in list(self.server.eio.sockets.items()):
+            sid = manager.sid_from_eio_sid(eio_sid, "/")
+            if sid is not None and not socket.closed:
+                yield sid, socket, socket.queue.qsize()
+
+    def _recipients(self, rooms, namespace: str):
+        """(sid, engine.io socket, queue depth) of every open connection in `rooms`, once each."""
+        seen = set()
+        for room in [rooms] if isinstance(rooms, str) else rooms:
+            for sid, eio_sid in list(self.server.manager.get_participants(namespace, room)):
+                socket = self.server.eio.sockets.get(eio_sid)
+                if sid in seen or socket is None or socket.closed:
+                    continue
+                seen.add(sid)
+                yield sid, socket, socket.queue.qsize()
+
+    async def emit(self, event: str, data, room=None, to=None, skip_sid=None, namespace=None, **kwargs):
+        """Drop-in for `sio.emit` that checks the recipients' queues first: non-critical events
+        skip connections over the soft limit, connections at the hard limit are evicted."""
+        skipped = set([skip_sid] if isinstance(skip_sid, str) else skip_sid or ())
+        target = to if to is not None else room
+        if target is None:
+            # a broadcast to the whole namespace: only the sampled slow set is known
+            if event in NON_CRITICAL_EVENTS:
+                skipped |= self._slow
+        else:
+            full = []
+            for sid, socket, depth in list(self._recipients(target, namespace or "/")):
+                if depth >= self.hard_limit:
+                    full.append((sid, socket))
+                elif depth >= self.soft_limit and event in NON_CRITICAL_EVENTS:
+                    skipped.add(sid)
+                    metrics.inc("broadcast.skipped_slow")
+            for sid, socket in full:
+                skipped.add(sid)
+                await self._evict(sid, socket)
+        await self.server.emit(event, data, room=room, to=to, skip_sid=list(skipped) or None,
+                               namespace=namespace, **kwargs)
+
+    async def _evict(self, sid: str, socket):
+        dropped = 0
+        while not socket.queue.empty():
+            socket.queue.get_nowait()
+            socket.queue.task_done()
+            dropped += 1
+        metrics.inc("broadcast.evicted")
+        metrics.inc("broadcast.dropped_packets", dropped)
+        print(f"Slow consumer {sid}: dropped {dropped} queued packets, asking it to resync")
+        await self.server.emit("resync", {"reason": "slow_consumer"}, to=sid)
+        await socket.close(wait=False, abort=True)
+        # wake the transport writer so it flushes the resync hint and closes the connection
+        socket.queue.put_nowait(None)
+
+    async def check(self):
+        slow, depths = set(), {}
+        for sid, socket, depth in self._queue_depths():
+            if depth >= self.hard_limit:
+                await self._evict(sid, socket)
+                continue
+            if depth:
+                depths[sid] = depth
+            if depth >= self.soft_limit:
+                slow.add(sid)
+        self._slow, self._depths = slow, depths
+
+    def stats(self, top: int = 20) -> dict:
+        depths = self._depths
+        return {
+            "soft_limit": self.soft_limit,
+            "hard_limit": self.hard_limit,
+            "connections": len(self.server.eio.sockets),
+            "backlogged": len(depths),
+            "slow": len(self._slow),
+            "queued_packets": sum(depths.values()),
+            "max_depth": max(depths.values(), default=0),
+            # depths only, without the sids they belong to
+            "deepest": heapq.nlargest(top, depths.values()),
+        }
@@ -15,6 +15,19 @@ class Settings:
         # support several common env names
         self.mongo_uri: str = os.getenv("DATABASE_URL") or os.getenv("MONGO_URI") or "mongodb://localhost:27017"
         self.mongo_db: str = os.getenv("MONGO_DB") or "realtime_chat"
+        # connection pool, timeouts and wire compression ("zstd,snappy,zlib"; zstd/snappy need their python packages)
+        self.mongo_max_pool_size: int = int(os.getenv("MONGO_MAX_POOL_SIZE") or 100)
+        self.mongo_min_pool_size: int = int(os.getenv("MONGO_MIN_POOL_SIZE") or 10)
+        self.mongo_max_idle_time_ms: int = int(os.getenv("MONGO_MAX_IDLE_TIME_MS") or 300_000)
+        self.mongo_connect_timeout_ms: int = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS") or 5_000)
+        self.mongo_server_selection_timeout_ms: int = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS") or 5_000)
+        self.mongo_socket_timeout_ms: int = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS") or 20_000)
+        self.mongo_wait_queue_timeout_ms: int = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS") or 5_000)
+        self.mongo_compressors: str = os.getenv("MONGO_COMPRESSORS") or ""
+        # read-heavy queries (history, search, chat list) can be routed away from the primary;
+        # writes, auth and membership checks always use the primary
+        self.mongo_read_preference: str = os.getenv("MONGO_READ_PREFERENCE") or "primary"
+        self.mongo_max_staleness_seconds: int = int(os.getenv("MONGO_MAX_STALENESS_SECONDS") or -1)
         self.jwt_secret: str = os.getenv("JWT_SECRET_KEY") or os.getenv("JWT_SECRET") or "changeme_in_prod"
         self.jwt_algorithm: str = os.getenv("JWT_ALGORITHM") or "HS256"
 
@@ -27,6 +40,99 @@ class Settings:
             self.access_token_expires_seconds = 60 * 15
 
         self.refresh_token_expires_seconds = int(os.getenv("REFRESH_TOKEN_EXPIRES_SECONDS") or 60 * 60 * 24 * 7)
+        # rotated/revoked refresh tokens remembered per worker to reject replays without a DB hit
+        self.revocation_cache_size: int = int(os.getenv("REVOCATION_CACHE_SIZE") or 100_000)
+        # a refresh token presented again this soon after its rotation (two tabs, a retried
+        # request) gets a token of the same session instead of revoking it; 0 disables
+        self.refresh_reuse_grace_seconds: float = float(os.getenv("REFRESH_REUSE_GRACE_SECONDS") or 10)
+
+        # Socket.IO wire format: "json" (default, works with every client) or "msgpack" (binary, opt-in)
+        self.socketio_serializer: str = (os.getenv("SOCKETIO_SERIALIZER") or "json").lower()
+        # payloads smaller than this are sent uncompressed on the HTTP long-polling transport
+        self.socketio_compression_threshold: int = int(os.getenv("SOCKETIO_COMPRESSION_THRESHOLD") or 1024)
+
+        # load the AI stack in the background after startup instead of on the first /chat/ai call
+        self.ai_warmup: bool = str(os.getenv("AI_WARMUP", "False")).lower() in ("1", "true", "yes")
+        # group rooms: a message mentioning AI_MENTION gets an assistant reply streamed to the whole room,
+        # tokens batched into one emit per AI_TOKEN_FLUSH_MS
+        self.ai_mention: str = os.getenv("AI_MENTION") or "@ai"
+        self.ai_token_flush_ms: float = float(os.getenv("AI_TOKEN_FLUSH_MS") or 30)
+        self.ai_room_context_messages: int = int(os.getenv("AI_ROOM_CONTEXT_MESSAGES") or 20)
+
+        # API responses larger than this are gzip-compressed
+        self.gzip_minimum_size: int = int(os.getenv("GZIP_MINIMUM_SIZE") or 1024)
+
+        # typing indicators: per-user throttle, per-room broadcast batching and expiry
+        self.typing_throttle_seconds: float = float(os.getenv("TYPING_THROTTLE_SECONDS") or 2.0)
+        self.typing_flush_seconds: float = float(os.getenv("TYPING_FLUSH_SECONDS") or 0.5)
+        self.typing_expire_seconds: float = float(os.getenv("TYPING_EXPIRE_SECONDS") or 5.0)
+        # read receipts ("last read" watermarks) are coalesced and written in batches
+        self.receipt_flush_seconds: float = float(os.getenv("RECEIPT_FLUSH_SECONDS") or 2.0)
+        # unread counters are kept incrementally; increments/resets are batched per flush
+        self.unread_flush_seconds: float = float(os.getenv("UNREAD_FLUSH_SECONDS") or 1.0)
+        # group member lists cached per worker for fanning messages out to members' user channels;
+        # joins on this worker apply at once, joins on other workers within MEMBERSHIP_CACHE_SECONDS
+        self.membership_cache_seconds: float = float(os.getenv("MEMBERSHIP_CACHE_SECONDS") or 30)
+        self.membership_cache_rooms: int = int(os.getenv("MEMBERSHIP_CACHE_ROOMS") or 10000)
+        # message history / reconnect catch-up
+        self.history_page_size: int = int(os.getenv("HISTORY_PAGE_SIZE") or 50)
+        self.sync_max_messages: int = int(os.getenv("SYNC_MAX_MESSAGES") or 200)
+        # recently seen client message ids kept per worker to drop duplicate sends
+        self.message_dedupe_cache_size: int = int(os.getenv("MESSAGE_DEDUPE_CACHE_SIZE") or 10000)
+        # full-text search: messages are indexed by a background flush, off the send path
+        self.search_flush_seconds: float = float(os.getenv("SEARCH_FLUSH_SECONDS") or 1.0)
+        self.search_page_size: int = int(os.getenv("SEARCH_PAGE_SIZE") or 20)
+        # in-memory ring buffer of recent messages per room (per worker), LRU-evicted under global caps
+        self.message_buffer_enabled: bool = str(os.getenv("MESSAGE_BUFFER_ENABLED", "True")).lower() in ("1", "true", "yes")
+        self.message_buffer_room_size: int = int(os.getenv("MESSAGE_BUFFER_ROOM_SIZE") or 100)
+        self.message_buffer_max_messages: int = int(os.getenv("MESSAGE_BUFFER_MAX_MESSAGES") or 200_000)
+        self.message_buffer_max_bytes: int = int(os.getenv("MESSAGE_BUFFER_MAX_BYTES") or 64 * 1024 * 1024)
+        # slow consumers: outbound Engine.IO queue depth (packets) per connection above which
+        # non-critical events are skipped (soft) or the backlog is dropped and the client resyncs (hard)
+        self.slow_consumer_soft_limit: int = int(os.getenv("SLOW_CONSUMER_SOFT_LIMIT") or 64)
+        self.slow_consumer_hard_limit: int = int(os.getenv("SLOW_CONSUMER_HARD_LIMIT") or 1000)
+        self.slow_consumer_check_seconds: float = float(os.getenv("SLOW_CONSUMER_CHECK_SECONDS") or 0.5)
+        # GET /metrics is served only when set, and then requires "Authorization: Bearer <token>"
+        self.metrics_token: str = os.getenv("METRICS_TOKEN") or ""
+        # token-bucket rate limits: "memory" (per worker) or "mongo" (shared by all workers);
+        # RATE_LIMITS overrides individual rules, see app/utils/rate_limit.py
+        self.rate_limit_backend: str = (os.getenv("RATE_LIMIT_BACKEND") or "memory").lower()
+        self.rate_limits: str = os.getenv("RATE_LIMITS") or ""
+        # only honour X-Forwarded-For when running behind a proxy that sets it
+        self.trust_forwarded_for: bool = str(os.getenv("TRUST_FORWARDED_FOR", "False")).lower() in ("1", "true", "yes")
+        # retention: messages older than RETENTION_DAYS (0 = keep forever; groups can override) are moved
+        # into compressed `message_archive` segments by a background job capped at RETENTION_RATE messages/s
+        self.retention_days: int = int(os.getenv("RETENTION_DAYS") or 0)
+        self.retention_interval_seconds: float = float(os.getenv("RETENTION_INTERVAL_SECONDS") or 3600)
+        self.retention_segment_size: int = int(os.getenv("RETENTION_SEGMENT_SIZE") or 500)
+        self.retention_rate: float = float(os.getenv("RETENTION_RATE") or 2000)
+        # attachments: streamed into GridFS chunk by chunk, so memory per upload is one chunk
+        self.attachment_max_bytes: int = int(os.getenv("ATTACHMENT_MAX_BYTES") or 25 * 1024 * 1024)
+        self.attachment_chunk_size: int = int(os.getenv("ATTACHMENT_CHUNK_SIZE") or 255 * 1024)
+        self.attachment_max_per_message: int = int(os.getenv("ATTACHMENT_MAX_PER_MESSAGE") or 10)
+        # image thumbnails (needs Pillow) are rendered by a small thread pool, off the event loop
+        self.thumbnail_size: int = int(os.getenv("THUMBNAIL_SIZE") or 320)
+        self.thumbnail_workers: int = int(os.getenv("THUMBNAIL_WORKERS") or 2)
+        self.thumbnail_max_source_bytes: int = int(os.getenv("THUMBNAIL_MAX_SOURCE_BYTES") or 20 * 1024 * 1024)
+        # offline DM notifications: collected per user and emailed as one digest once the oldest has waited
+        # NOTIFY_DIGEST_WINDOW_SECONDS; sent over NOTIFY_SMTP_CONNECTIONS reused connections, each
+        # recipient domain held to NOTIFY_DOMAIN_RATE ("<emails>/<seconds>[:<burst>]")
+        self.notify_digests: bool = str(os.getenv("NOTIFY_DIGESTS", "True")).lower() in ("1", "true", "yes")
+        self.notify_digest_window_seconds: float = float(os.getenv("NOTIFY_DIGEST_WINDOW_SECONDS") or 900)
+        self.notify_digest_interval_seconds: float = float(os.getenv("NOTIFY_DIGEST_INTERVAL_SECONDS") or 60)
+        self.notify_digest_max_rooms: int = int(os.getenv("NOTIFY_DIGEST_MAX_ROOMS") or 10)
+        self.notify_smtp_connections: int = int(os.getenv("NOTIFY_SMTP_CONNECTIONS") or 4)
+        self.notify_smtp_batch: int = int(os.getenv("NOTIFY_SMTP_BATCH") or 100)
+        self.notify_domain_rate: str = os.getenv("NOTIFY_DOMAIN_RATE") or "600/60:100"
+        # presence shared by all workers: each one refreshes its connected users every
+        # PRESENCE_HEARTBEAT_SECONDS; a user counts as online until three heartbeats are missed
+        self.presence_heartbeat_seconds: float = float(os.getenv("PRESENCE_HEARTBEAT_SECONDS") or 30)
+        # load shedding: event-loop lag (ms) at which levels 1..3 start, and in-flight HTTP requests
+        # at which the worker counts as full (0 = lag only); see app/utils/overload.py
+        self.overload_lag_ms: str = os.getenv("OVERLOAD_LAG_MS") or "50,150,400"
+        self.overload_max_inflight: int = int(os.getenv("OVERLOAD_MAX_INFLIGHT") or 0)
+        self.overload_sample_seconds: float = float(os.getenv("OVERLOAD_SAMPLE_SECONDS") or 0.25)
+        self.overload_cooldown_seconds: float = float(os.getenv("OVERLOAD_COOLDOWN_SECONDS") or 5.0)
 
 
 settings = Settings()
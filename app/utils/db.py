@@ -1,10 +1,51 @@
+from datetime import datetime
+from bson import ObjectId
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 from .config import settings
 
 
+class _ObjectIdAsStr(TypeDecoder):
+    bson_type = ObjectId
+
+    def transform_bson(self, value):
+        return str(value)
+
+
+class _DatetimeAsIso(TypeDecoder):
+    bson_type = datetime
+
+    def transform_bson(self, value):
+        return value.isoformat()
+
+
+# Documents are decoded straight into JSON-ready values (ObjectId -> str, datetime -> ISO string),
+# so repository reads need no second pass over the document before being returned or serialized.
+JSON_READY_CODEC_OPTIONS = CodecOptions(type_registry=TypeRegistry([_ObjectIdAsStr(), _DatetimeAsIso()]))
+
+
+_READ_PREFERENCES = {
+    "primarypreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondarypreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def _read_preference():
+    mode = settings.mongo_read_preference.replace("_", "").lower()
+    if mode not in _READ_PREFERENCES:
+        return Primary()
+    return _READ_PREFERENCES[mode](max_staleness=settings.mongo_max_staleness_seconds)
+
+
 class Database:
     client: AsyncIOMotorClient | None = None
     db = None
+    # same database, routed per MONGO_READ_PREFERENCE for read-heavy queries
+    read_db = None
+    ready: bool = False
 
 
 db = Database()
@@ -12,13 +53,46 @@ db = Database()
 
 def connect():
     if db.client is None:
-        db.client = AsyncIOMotorClient(settings.mongo_uri)
-        db.db = db.client[settings.mongo_db]
+        options = dict(
+            maxPoolSize=settings.mongo_max_pool_size,
+            minPoolSize=settings.mongo_min_pool_size,
+            maxIdleTimeMS=settings.mongo_max_idle_time_ms,
+            connectTimeoutMS=settings.mongo_connect_timeout_ms,
+            serverSelectionTimeoutMS=settings.mongo_server_selection_timeout_ms,
+            socketTimeoutMS=settings.mongo_socket_timeout_ms,
+            waitQueueTimeoutMS=settings.mongo_wait_queue_timeout_ms,
+        )
+        if settings.mongo_compressors:
+            options["compressors"] = settings.mongo_compressors
+        db.client = AsyncIOMotorClient(settings.mongo_uri, **options)
+        db.db = db.client.get_database(settings.mongo_db, codec_options=JSON_READY_CODEC_OPTIONS)
+        db.read_db = db.client.get_database(
+            settings.mongo_db, codec_options=JSON_READY_CODEC_OPTIONS, read_preference=_read_preference()
+        )
     return db.db
 
 
+def connect_read():
+    """Database handle for read-heavy, staleness-tolerant queries."""
+    connect()
+    return db.read_db
+
+
+async def warm_up():
+    """Open one connection (per routed node) up front so the first request after a cold start
+    doesn't pay for the handshake. The rest of the pool opens on demand, and the driver fills
+    it to `mongo_min_pool_size` in the background, so startup never waits for it."""
+    connect()
+    await db.client.admin.command("ping")
+    if not isinstance(db.read_db.read_preference, Primary):
+        await db.read_db.command("ping", read_preference=db.read_db.read_preference)
+    db.ready = True
+
+
 def close():
     if db.client:
         db.client.close()
         db.client = None
         db.db = None
+        db.read_db = None
+        db.ready = False
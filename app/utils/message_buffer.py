@@ -0,0 +1,237 @@
+import sys
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from .config import settings
+from .metrics import metrics
+
+# rough per-entry overhead (object, slots, strings headers) used for the memory cap
+_ENTRY_OVERHEAD_BYTES = 200
+# per attachment reference: the dict plus its id, content type and hash strings
+_ATTACHMENT_OVERHEAD_BYTES = 400
+
+
+class BufferedMessage:
+    """Compact, immutable-ish copy of a stored message. Dicts are only built on read."""
+
+    __slots__ = ("seq", "id", "sender_id", "sender_username", "content", "created_at", "client_msg_id",
+                 "attachments", "edit_seq", "edited_at", "deleted", "deleted_at")
+
+    def __init__(self, msg: dict):
+        self.seq: int = msg["seq"]
+        self.id: Optional[str] = msg.get("_id")
+        # sender ids/names repeat a lot within a room, share one string object
+        self.sender_id: str = sys.intern(msg.get("sender_id") or "")
+        self.sender_username: Optional[str] = sys.intern(msg["sender_username"]) if msg.get("sender_username") else None
+        self.content: str = msg.get("content") or ""
+        self.created_at: Optional[str] = msg.get("created_at")
+        self.client_msg_id: Optional[str] = msg.get("client_msg_id")
+        # attachment references (see attachment_service.attachment_ref), copied on read
+        self.attachments: Tuple[dict, ...] = tuple(msg.get("attachments") or ())
+        self.edit_seq: int = msg.get("edit_seq") or 0
+        self.edited_at: Optional[str] = msg.get("edited_at")
+        self.deleted: bool = bool(msg.get("deleted"))
+        self.deleted_at: Optional[str] = msg.get("deleted_at")
+
+    def size(self) -> int:
+        refs = sum(_ATTACHMENT_OVERHEAD_BYTES + len(a.get("filename") or "") for a in self.attachments)
+        return _ENTRY_OVERHEAD_BYTES + len(self.content) + refs
+
+    def to_dict(self, chat_id: str) -> dict:
+        d = {
+            "_id": self.id,
+            "chat_id": chat_id,
+            "seq": self.seq,
+            "sender_id": self.sender_id,
+            "content": self.content,
+            "created_at": self.created_at,
+        }
+        if self.sender_username is not None:
+            d["sender_username"] = self.sender_username
+        if self.client_msg_id is not None:
+            d["client_msg_id"] = self.client_msg_id
+        if self.attachments:
+            d["attachments"] = [dict(a) for a in self.attachments]
+        if self.edit_seq:
+            d["edit_seq"] = self.edit_seq
+            if self.deleted:
+                d["deleted"] = True
+                del d["content"]
+                if self.deleted_at is not None:
+                    d["deleted_at"] = self.deleted_at
+            else:
+                d["edited_at"] = self.edited_at
+        return d
+
+
+# a room's (seq, edit_seq) counters: its newest message and its latest edit
+Counters = Tuple[int, int]
+
+
+class _RoomBuffer:
+    __slots__ = ("entries", "seqs", "bytes", "synced")
+
+    def __init__(self):
+        self.entries: List[BufferedMessage] = []
+        self.seqs: List[int] = []
+        self.bytes = 0
+        # the room counters the entries are known to be current with; None until a Mongo read says so
+        self.synced: Optional[Counters] = None
+
+
+def _contiguous(entries: List[BufferedMessage]) -> bool:
+    return not entries or entries[-1].seq - entries[0].seq + 1 == len(entries)
+
+
+class RecentMessageBuffer:
+    """Bounded per-room ring buffer of the most recent messages of each room.
+
+    Rooms are kept in LRU order; when the global message or byte cap is
+    exceeded the coldest rooms are evicted whole. A read is only answered from
+    the buffer when the requested range is held without gaps, otherwise the
+    caller falls back to Mongo.
+
+    The buffer is per worker and only sees messages posted and edited through
+    this process, so every read is checked against the room's authoritative
+    counters (seq and edit_seq, passed in by the caller). A room is only served
+    while the buffer has seen every message and edit up to them: a page read
+    from Mongo records the counters it is current with, and local sends and
+    edits advance them only when they directly follow. Anything posted or
+    edited on another worker makes the counters disagree and the read falls
+    back to Mongo, which resynchronizes the room.
+    """
+
+    def __init__(self, room_size: int, max_messages: int, max_bytes: int):
+        self.room_size = room_size
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._rooms: "OrderedDict[str, _RoomBuffer]" = OrderedDict()
+        self._messages = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _insert(self, room: _RoomBuffer, entry: BufferedMessage) -> int:
+        i = bisect_left(room.seqs, entry.seq)
+        if i < len(room.seqs) and room.seqs[i] == entry.seq:
+            # a page read before an edit must not bring back the older version
+            if entry.edit_seq > room.entries[i].edit_seq:
+                room.bytes += entry.size() - room.entries[i].size()
+                room.entries[i] = entry
+            return 0
+        room.seqs.insert(i, entry.seq)
+        room.entries.insert(i, entry)
+        room.bytes += entry.size()
+        added = 1
+        while len(room.entries) > self.room_size:
+            dropped = room.entries.pop(0)
+            room.seqs.pop(0)
+            room.bytes -= dropped.size()
+            added -= 1
+        return added
+
+    def _add(self, chat_id: str, msgs: List[dict]):
+        msgs = [m for m in msgs if m.get("seq") is not None]
+        if not msgs:
+            return
+        room = self._rooms.get(chat_id)
+        if room is None:
+            room = self._rooms[chat_id] = _RoomBuffer()
+        self._rooms.move_to_end(chat_id)
+        before_bytes = room.bytes
+        for msg in msgs:
+            self._messages += self._insert(room, BufferedMessage(msg))
+        self._bytes += room.bytes - before_bytes
+        self._evict()
+
+    def _evict(self):
+        while self._rooms and (self._messages > self.max_messages or self._bytes > self.max_bytes):
+            _, room = self._rooms.popitem(last=False)
+            self._messages -= len(room.entries)
+            self._bytes -= room.bytes
+
+    def append(self, chat_id: str, msg: dict):
+        """Feed a freshly stored message (called from the send path)."""
+        room = self._rooms.get(chat_id)
+        synced = room.synced if room is not None else None
+        self._add(chat_id, [msg])
+        room = self._rooms.get(chat_id)
+        if room is not None and synced is not None and synced[0] == msg["seq"] - 1:
+            room.synced = (msg["seq"], synced[1])
+
+    def fill(self, chat_id: str, msgs: List[dict], counters: Optional[Counters] = None):
+        """Feed a page read from Mongo so the next reads of it are served from memory.
+        With `counters` (read before the page) the room is replaced by the page and marked current
+        with them; without, the page only adds older entries to what is held."""
+        if counters is not None:
+            self.invalidate(chat_id)
+        self._add(chat_id, msgs)
+        room = self._rooms.get(chat_id)
+        if room is not None and counters is not None:
+            room.synced = counters
+
+    def update(self, chat_id: str, msg: dict):
+        """Replace a held message by its edited or deleted version. Messages not held are ignored."""
+        room = self._rooms.get(chat_id)
+        if room is None:
+            return
+        i = bisect_left(room.seqs, msg["seq"])
+        if i < len(room.seqs) and room.seqs[i] == msg["seq"]:
+            before_bytes = room.bytes
+            self._insert(room, BufferedMessage(msg))
+            self._bytes += room.bytes - before_bytes
+        if room.synced is not None and room.synced[1] == msg["edit_seq"] - 1:
+            room.synced = (room.synced[0], msg["edit_seq"])
+
+    def invalidate(self, chat_id: str):
+        room = self._rooms.pop(chat_id, None)
+        if room is not None:
+            self._messages -= len(room.entries)
+            self._bytes -= room.bytes
+
+    def latest(self, chat_id: str, limit: int, counters: Counters, first_seq: int = 1,
+               before_seq: Optional[int] = None) -> Optional[List[dict]]:
+        """The newest `limit` messages (below `before_seq`), oldest first, or None on a miss.
+        `counters` are the room's current ones; the buffer must be current with them.
+        `first_seq` is the seq of the room's first message."""
+        room = self._rooms.get(chat_id)
+        if room is not None and room.synced == counters and room.seqs and room.seqs[-1] == counters[0]:
+            end = len(room.seqs) if before_seq is None else bisect_left(room.seqs, before_seq)
+            page = room.entries[max(0, end - limit):end]
+            # a full page, or everything since the room's first message
+            complete = len(page) == limit or (page and page[0].seq == first_seq)
+            if before_seq is not None and page and page[-1].seq != before_seq - 1:
+                complete = False
+            if complete and _contiguous(page):
+                self._rooms.move_to_end(chat_id)
+                self.hits += 1
+                return [e.to_dict(chat_id) for e in page]
+        self.misses += 1
+        return None
+
+    def since(self, chat_id: str, after_seq: int, limit: int, counters: Counters) -> Optional[List[dict]]:
+        """Messages with seq > after_seq (at most `limit`), or None when the buffer does not reach back
+        that far or is not current with the room's `counters`."""
+        room = self._rooms.get(chat_id)
+        if (room is not None and room.synced == counters and room.seqs and room.seqs[-1] == counters[0]
+                and room.seqs[0] <= after_seq + 1 and after_seq <= room.seqs[-1]):
+            start = bisect_right(room.seqs, after_seq)
+            page = room.entries[start:start + limit]
+            if (not page or page[0].seq == after_seq + 1) and _contiguous(page):
+                self._rooms.move_to_end(chat_id)
+                self.hits += 1
+                return [e.to_dict(chat_id) for e in page]
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        return {"rooms": len(self._rooms), "messages": self._messages, "bytes": self._bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+recent_messages = RecentMessageBuffer(
+    room_size=settings.message_buffer_room_size,
+    max_messages=settings.message_buffer_max_messages,
+    max_bytes=settings.message_buffer_max_bytes,
+)
+metrics.register("message_buffer", recent_messages.stats)
@@ -0,0 +1,29 @@
+from collections import defaultdict
+from typing import Callable
+
+
+class Metrics:
+    """Process-local metrics: plain counters plus named sources that are sampled
+    when a snapshot is taken (buffers, queues, limiters report their own stats)."""
+
+    def __init__(self):
+        self.counters: dict[str, int] = defaultdict(int)
+        self._sources: dict[str, Callable[[], dict]] = {}
+
+    def inc(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def register(self, name: str, source: Callable[[], dict]):
+        self._sources[name] = source
+
+    def snapshot(self) -> dict:
+        snap = {"counters": dict(self.counters)}
+        for name, source in self._sources.items():
+            try:
+                snap[name] = source()
+            except Exception as e:
+                snap[name] = {"error": str(e)}
+        return snap
+
+
+metrics = Metrics()
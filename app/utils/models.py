@@ -40,7 +40,7 @@ class ResetPasswordPayload(BaseModel):
     confirm_new_password: str
 
 class RefreshPayload(BaseModel):
-    refresh_token: str
+    refresh_token: Optional[str] = None
 
 class LogoutPayload(BaseModel):
     refresh_token: Optional[str] = None
@@ -58,6 +58,10 @@ class JoinGroupPayload(BaseModel):
 class AiChatPayload(BaseModel):
     content: str
 
+class RetentionPayload(BaseModel):
+    # None = use the global RETENTION_DAYS, 0 = keep forever
+    retention_days: Optional[int] = Field(None, ge=0)
+
 
 # --- Database Models ---
 
@@ -94,7 +98,7 @@ class Session(BaseModel):
 class Group(BaseModel):
     id: PyObjectId = Field(alias="_id")
     name: str
-    members: List[PyObjectId] = []
+    member_count: int = 0
     created_at: datetime
 
 
@@ -152,7 +156,7 @@ class Session(BaseModel):
 class Group(BaseModel):
     id: PyObjectId = Field(alias="_id")
     name: str
-    members: List[PyObjectId] = []
+    member_count: int = 0
     created_at: datetime
 
 
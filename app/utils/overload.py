@@ -0,0 +1,140 @@
+import time
+from typing import Awaitable, Callable
+from fastapi import HTTPException
+from .background import register_periodic
+from .metrics import metrics
+from .config import settings
+
+# shed levels, each including the ones below it
+NORMAL, SHED_AI, DEFER_PRESENCE, SHED_READS = 0, 1, 2, 3
+LEVEL_NAMES = ("normal", "shed_ai", "defer_presence", "shed_reads")
+
+
+def _parse_thresholds(spec: str) -> tuple[float, ...]:
+    """"50,150,400" (milliseconds of lag for levels 1..3) -> seconds."""
+    return tuple(float(part) / 1000 for part in spec.split(",") if part.strip())
+
+
+class OverloadController:
+    """Decides how much optional work the worker should refuse right now.
+
+    Sockets, REST handlers, bcrypt, SMTP and AI streams all share one event
+    loop, so loop lag is the common symptom of any of them being overloaded.
+    A periodic tick measures how late it was woken up (lag), and the HTTP
+    middleware counts requests in flight. Either signal can raise the level:
+
+      1 shed_ai         new /chat/ai streams are refused
+      2 defer_presence  typing, read-receipt and join broadcasts are held back
+      3 shed_reads      non-critical reads (search, user lists, ...) get 503
+
+    Message delivery, history and sync are never shed. The level rises as soon
+    as a threshold is crossed and steps down one level at a time once the
+    signals have stayed below it for the cooldown, so it does not flap.
+    """
+
+    def __init__(self, lag_thresholds: tuple[float, ...], max_inflight: int, interval: float, cooldown: float):
+        self.lag_thresholds = lag_thresholds
+        self.max_inflight = max_inflight
+        self.interval = interval
+        self.cooldown = cooldown
+        self.level = NORMAL
+        self.lag = 0.0  # seconds, rises immediately and decays smoothly
+        self.max_lag = 0.0
+        self.inflight = 0
+        self._last_tick: float | None = None
+        self._calm_since: float | None = None
+
+    def _target(self) -> int:
+        level = sum(self.lag >= t for t in self.lag_thresholds)
+        if self.max_inflight:
+            level = max(level, sum(self.inflight >= self.max_inflight * f for f in (0.5, 0.75, 1.0)))
+        return min(level, SHED_READS)
+
+    async def tick(self):
+        now = time.monotonic()
+        if self._last_tick is not None:
+            lag = max(0.0, now - self._last_tick - self.interval)
+            self.lag = lag if lag > self.lag else 0.7 * self.lag + 0.3 * lag
+            self.max_lag = max(self.max_lag, lag)
+        self._last_tick = now
+
+        target = self._target()
+        if target > self.level:
+            self._set_level(target)
+            self._calm_since = None
+        elif target < self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.cooldown:
+                self._set_level(self.level - 1)
+                self._calm_since = now
+        else:
+            self._calm_since = None
+
+    def _set_level(self, level: int):
+        print(f"Overload level {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} "
+              f"(lag {self.lag * 1000:.0f} ms, {self.inflight} requests in flight)")
+        self.level = level
+        metrics.inc(f"overload.entered_{LEVEL_NAMES[level]}")
+
+    def sheds(self, level: int) -> bool:
+        return self.level >= level
+
+    def deferrable(self, fn: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+        """Wrap a periodic flush so it is skipped (its work stays buffered) while presence is deferred."""
+        async def run():
+            if self.level >= DEFER_PRESENCE:
+                metrics.inc("overload.deferred_flushes")
+                return
+            await fn()
+        return run
+
+    def status(self) -> dict:
+        return {"level": self.level, "state": LEVEL_NAMES[self.level],
+                "lag_ms": round(self.lag * 1000, 1), "inflight": self.inflight}
+
+    def stats(self) -> dict:
+        return {**self.status(), "max_lag_ms": round(self.max_lag * 1000, 1),
+                "lag_thresholds_ms": [t * 1000 for t in self.lag_thresholds], "max_inflight": self.max_inflight}
+
+
+overload = OverloadController(
+    _parse_thresholds(settings.overload_lag_ms),
+    settings.overload_max_inflight,
+    settings.overload_sample_seconds,
+    settings.overload_cooldown_seconds,
+)
+register_periodic("overload-sample", settings.overload_sample_seconds, overload.tick, flush_on_stop=False)
+metrics.register("overload", overload.stats)
+
+
+class InflightMiddleware:
+    """Counts HTTP requests being handled (streamed responses count until they finish)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        overload.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            overload.inflight -= 1
+
+
+def shed_at(level: int, name: str):
+    """FastAPI dependency: 503 with Retry-After while the worker is at or above `level`."""
+
+    async def dependency():
+        if overload.sheds(level):
+            metrics.inc(f"overload.shed.{name}")
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, try again shortly",
+                headers={"Retry-After": str(max(1, round(overload.cooldown)))},
+            )
+
+    return dependency
@@ -0,0 +1,168 @@
+import math
+import time
+from typing import Optional
+from fastapi import HTTPException, Request
+from pymongo import ReturnDocument
+from .config import settings
+from .db import connect
+from .background import register_periodic
+from .metrics import metrics
+
+# rule name -> "<tokens>/<seconds>[:<burst>]". Override any of them with RATE_LIMITS, e.g.
+# RATE_LIMITS="socket.message=10/1:20,auth.login=5/60"
+DEFAULT_RULES = {
+    "socket.message": "5/1:10",
+    "socket.typing": "5/1:10",
+    "socket.read": "10/1:20",
+    "socket.sync": "1/5:3",
+    "socket.join_room": "5/1:20",
+    "socket.edit_message": "1/1:5",
+    "socket.delete_message": "1/1:5",
+    "auth.signup": "5/300:5",
+    "auth.login": "10/60:10",
+    "auth.forgot_password": "3/300:3",
+    "auth.reset_password": "5/300:5",
+    "auth.refresh": "30/60:30",
+    "chat.ai": "10/60:5",
+}
+
+
+class Rule:
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate  # tokens refilled per second
+        self.burst = burst  # bucket capacity
+
+
+def parse_rule(spec: str) -> Rule:
+    amount, _, rest = spec.partition("/")
+    seconds, _, burst = rest.partition(":")
+    rate = float(amount) / float(seconds)
+    return Rule(rate, float(burst) if burst else float(amount))
+
+
+def load_rules(overrides: str) -> dict[str, Rule]:
+    specs = dict(DEFAULT_RULES)
+    for item in filter(None, (part.strip() for part in overrides.split(","))):
+        name, _, spec = item.partition("=")
+        specs[name.strip()] = spec.strip()
+    return {name: parse_rule(spec) for name, spec in specs.items()}
+
+
+class MemoryBucketStore:
+    """Token buckets in a dict: O(1) per check. Per worker."""
+
+    def __init__(self):
+        # key -> [tokens, last_refill_monotonic, seconds_to_full]
+        self._buckets: dict[str, list] = {}
+
+    async def ensure_indexes(self):
+        pass
+
+    async def take(self, key: str, rule: Rule, cost: float = 1.0) -> tuple[bool, float]:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [rule.burst, now, rule.burst / rule.rate]
+        else:
+            bucket[0] = min(rule.burst, bucket[0] + (now - bucket[1]) * rule.rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return True, 0.0
+        return False, (cost - bucket[0]) / rule.rate
+
+    async def sweep(self):
+        """Forget buckets that have been idle long enough to be full again."""
+        now = time.monotonic()
+        idle = [k for k, (_, last, to_full) in self._buckets.items() if now - last >= to_full]
+        for k in idle:
+            del self._buckets[k]
+
+
+class MongoBucketStore:
+    """Token buckets shared by all workers: one atomic pipeline update per check."""
+
+    def __init__(self):
+        self.col = connect()["rate_limits"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("expires_at", 1)], expireAfterSeconds=0)
+
+    async def take(self, key: str, rule: Rule, cost: float = 1.0) -> tuple[bool, float]:
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$ts", "$$NOW"]}]}, 1000]}
+        refilled = {"$min": [rule.burst, {"$add": [{"$ifNull": ["$tokens", rule.burst]}, {"$multiply": [elapsed, rule.rate]}]}]}
+        doc = await self.col.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "ts": "$$NOW"}},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                    "expires_at": {"$add": ["$$NOW", int(math.ceil(rule.burst / rule.rate)) * 1000]},
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc["allowed"]:
+            return True, 0.0
+        return False, (cost - doc["tokens"]) / rule.rate
+
+    async def sweep(self):
+        pass  # expired buckets are removed by the TTL index
+
+
+class RateLimiter:
+    def __init__(self, store, rules: dict[str, Rule]):
+        self.store = store
+        self.rules = rules
+        self.rejected = 0
+
+    async def check(self, rule_name: str, scope: str, identity: Optional[str]) -> tuple[bool, float]:
+        """Take one token from the (rule, scope, identity) bucket. Returns (allowed, retry_after_seconds)."""
+        rule = self.rules.get(rule_name)
+        if rule is None or not identity:
+            return True, 0.0
+        allowed, retry_after = await self.store.take(f"{rule_name}:{scope}:{identity}", rule)
+        if not allowed:
+            self.rejected += 1
+        return allowed, retry_after
+
+
+rate_limiter = RateLimiter(
+    MongoBucketStore() if settings.rate_limit_backend == "mongo" else MemoryBucketStore(),
+    load_rules(settings.rate_limits),
+)
+register_periodic("rate-limit-sweep", 60.0, rate_limiter.store.sweep)
+metrics.register("rate_limit", lambda: {"backend": settings.rate_limit_backend, "rejected": rate_limiter.rejected})
+
+
+def client_ip(request: Request) -> str:
+    if settings.trust_forwarded_for:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def rate_limit(rule_name: str, per_user: bool = False):
+    """FastAPI dependency: 429 with Retry-After once the caller's bucket for `rule_name` is empty.
+    Buckets are per client IP, or per authenticated user when `per_user` is set."""
+
+    async def dependency(request: Request):
+        if per_user:
+            user = getattr(request.state, "user", None) or {}
+            scope, identity = "user", user.get("_id")
+        else:
+            scope, identity = "ip", client_ip(request)
+        allowed, retry_after = await rate_limiter.check(rule_name, scope, identity)
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests. Please slow down.",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+    return dependency
@@ -1,32 +1,79 @@
-from .db import connect
+import zlib
+import bson
+from .db import connect, connect_read, JSON_READY_CODEC_OPTIONS
 from datetime import datetime, timedelta
 from bson import ObjectId
+from bson.codec_options import CodecOptions
 from typing import Optional, List, Any
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from .utils import normalize_doc
+from .singleflight import SingleFlight
+from .config import settings
+
+# concurrent lookups of the same document share one query (e.g. a room reconnecting after a deploy)
+_user_by_id = SingleFlight("users.find_by_id")
+_group_by_id = SingleFlight("groups.find_by_id")
+
+
+async def _upsert(col, query: dict, on_insert: dict) -> dict:
+    """Get-or-create in one round trip. Relies on a unique index over `query`: when two
+    concurrent upserts both try to insert, the loser gets a duplicate-key error and
+    simply reads the winner's document on retry."""
+    for attempt in range(2):
+        try:
+            return await col.find_one_and_update(
+                query, {"$setOnInsert": on_insert}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            if attempt:
+                raise
+
+
+async def _backfill_unique_key(col, query: dict, field: str, key_of):
+    """Set a uniquely indexed `field` on documents written before it existed. When several
+    old documents map to the same key only the oldest gets it; the others stay reachable
+    by id but are no longer returned by key lookups."""
+    async for doc in col.find({**query, field: {"$exists": False}}).sort("created_at", 1):
+        key = key_of(doc)
+        if key is None:
+            continue
+        try:
+            await col.update_one({"_id": ObjectId(doc["_id"])}, {"$set": {field: key}})
+        except DuplicateKeyError:
+            pass
 
 
 class UserRepository:
     def __init__(self):
         self._db = connect()
         self.col = self._db["users"]
+        self.read_col = connect_read()["users"]
 
     async def create(self, user: dict) -> dict:
         user["created_at"] = datetime.utcnow()
-        r = await self.col.insert_one(user)
-        doc = await self.col.find_one({"_id": r.inserted_id})
-        return normalize_doc(doc)
+        await self.col.insert_one(user)
+        return normalize_doc(user)
 
     async def find_by_email(self, email: str) -> Optional[dict]:
         doc = await self.col.find_one({"email": email})
-        return normalize_doc(doc)
+        return doc
 
     async def find_by_id(self, _id: str) -> Optional[dict]:
-        doc = await self.col.find_one({"_id": ObjectId(_id)})
-        return normalize_doc(doc)
+        return await _user_by_id.do(_id, lambda: self.col.find_one({"_id": ObjectId(_id)}))
+
+    async def find_by_ids(self, ids: List[str]) -> dict[str, dict]:
+        """Fetch many users in one query. Returns a mapping of id -> user."""
+        object_ids = [ObjectId(i) for i in set(ids) if ObjectId.is_valid(i)]
+        if not object_ids:
+            return {}
+        cursor = self.read_col.find({"_id": {"$in": object_ids}}, {"password_hash": 0})
+        return {u["_id"]: u async for u in cursor}
 
     async def list_all(self) -> List[dict]:
-        cursor = self.col.find({})
-        return [normalize_doc(user) async for user in cursor]
+        cursor = self.read_col.find({}, {"password_hash": 0})
+        return [user async for user in cursor]
 
     async def update(self, _id: Any, data: dict):
         if not isinstance(_id, ObjectId):
@@ -38,82 +85,484 @@ class UserRepository:
         find_filter = {"username": {"$regex": query, "$options": "i"}}
         if exclude_id:
             find_filter["_id"] = {"$ne": ObjectId(exclude_id)}
-        cursor = self.col.find(find_filter).limit(limit)
-        return [normalize_doc(u, exclude={"password_hash"}) async for u in cursor]
+        cursor = self.read_col.find(find_filter, {"password_hash": 0}).limit(limit)
+        return [u async for u in cursor]
 
 
 class SessionRepository:
+    """One document per refresh token, keyed by its sha256 digest. Rotated tokens are
+    kept (with `replaced_by` set) until they expire so that replays can be detected;
+    the TTL index removes every session once `expires_at` has passed."""
+
     def __init__(self):
         self._db = connect()
         self.col = self._db["sessions"]
 
+    async def ensure_indexes(self):
+        await self.col.create_index([("token_hash", 1)], unique=True)
+        await self.col.create_index([("family", 1)])
+        await self.col.create_index([("expires_at", 1)], expireAfterSeconds=0)
+
+    async def drop_unhashed(self):
+        """Sessions stored before token hashing hold raw tokens and can no longer be used."""
+        await self.col.delete_many({"token_hash": {"$exists": False}})
+
     async def create(self, session: dict) -> dict:
         session["created_at"] = datetime.utcnow()
-        r = await self.col.insert_one(session)
-        doc = await self.col.find_one({"_id": r.inserted_id})
-        return normalize_doc(doc)
+        await self.col.insert_one(session)
+        return normalize_doc(session)
+
+    async def find_by_refresh(self, token_hash: str) -> Optional[dict]:
+        return await self.col.find_one({"token_hash": token_hash})
 
-    async def find_by_refresh(self, token: str) -> Optional[dict]:
-        doc = await self.col.find_one({"refresh_token": token})
-        return normalize_doc(doc)
+    async def rotate(self, token_hash: str, new_session: dict) -> Optional[dict]:
+        """Mark the session unused-until-now as replaced and store its successor.
+        Returns the old session, or None if it is unknown or was already rotated."""
+        old = await self.col.find_one_and_update(
+            {"token_hash": token_hash, "replaced_by": None},
+            {"$set": {"replaced_by": new_session["token_hash"], "rotated_at": datetime.utcnow()}},
+        )
+        if old is not None:
+            await self.create(new_session)
+        return old
 
-    async def delete(self, token: str):
-        await self.col.delete_one({"refresh_token": token})
+    async def delete_family(self, family: str):
+        await self.col.delete_many({"family": family})
+
+    async def delete(self, token_hash: str):
+        await self.col.delete_one({"token_hash": token_hash})
+
+
+_COUNTER_FIELDS = {"seq": 1, "edit_seq": 1, "first_seq": 1}
+
+
+def _counters(room: Optional[dict]) -> Optional[dict]:
+    """{"seq", "edit_seq", "first_seq"} of a room document: its newest message, its latest edit and
+    its first message (below 1 when history written by older versions was moved into `messages`)."""
+    if room is None:
+        return None
+    return {"seq": room.get("seq") or 0, "edit_seq": room.get("edit_seq") or 0, "first_seq": room.get("first_seq", 1)}
 
 
 class MessageRepository:
     def __init__(self):
         self._db = connect()
         self.col = self._db["messages"]
+        self.read_col = connect_read()["messages"]
 
     async def create(self, message: dict) -> dict:
         message["created_at"] = datetime.utcnow()
-        r = await self.col.insert_one(message)
-        doc = await self.col.find_one({"_id": r.inserted_id})
-        return normalize_doc(doc)
+        await self.col.insert_one(message)
+        return normalize_doc(message)
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("chat_id", 1), ("seq", 1)], unique=True)
+        await self.col.create_index(
+            [("chat_id", 1), ("client_msg_id", 1)],
+            unique=True,
+            partialFilterExpression={"client_msg_id": {"$type": "string"}},
+        )
+        # only edited and deleted messages carry an edit_seq: the index holds just those
+        await self.col.create_index(
+            [("chat_id", 1), ("edit_seq", 1)],
+            partialFilterExpression={"edit_seq": {"$exists": True}},
+        )
+
+    async def insert(self, message: dict) -> dict:
+        """Insert a fully formed message (chat_id, seq and created_at already set)."""
+        await self.col.insert_one(message)
+        return normalize_doc(message)  # local dict: still holds ObjectId/datetime values
+
+    async def migrate_embedded(self, rooms, chat_id_of):
+        """Move `messages` arrays embedded in room documents by older versions into this collection.
+
+        They are the room's oldest messages, so they are numbered below everything
+        sequenced since: seq 1 - n .. 0, with the room's start kept as `first_seq`.
+        Inserts are keyed by (chat_id, seq), so an interrupted or concurrent run
+        simply repeats them; the array is only removed once they are all stored."""
+        raw = rooms.with_options(codec_options=CodecOptions())
+        async for room in raw.find({"messages.0": {"$exists": True}}):
+            chat_id = chat_id_of(room)
+            if chat_id is None:
+                continue
+            legacy = room["messages"]
+            first_seq = 1 - len(legacy)
+            docs = [
+                {**m, "_id": m.get("_id") or ObjectId(), "chat_id": chat_id, "seq": first_seq + i}
+                for i, m in enumerate(legacy)
+            ]
+            try:
+                await self.col.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # already moved by an earlier or concurrent run
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+            moved = await self.col.count_documents({"chat_id": chat_id, "seq": {"$gte": first_seq, "$lte": 0}})
+            if moved != len(legacy):
+                print(f"Not moving embedded history of {chat_id}: {moved} of {len(legacy)} messages stored")
+                continue
+            await raw.update_one({"_id": room["_id"], "last_message": {"$exists": False}},
+                                 {"$set": {"last_message": {**legacy[-1], "seq": 0}}})
+            await raw.update_one({"_id": room["_id"]},
+                                 {"$set": {"first_seq": first_seq}, "$unset": {"messages": ""}, "$inc": {"version": 1}})
+
+    async def find_by_client_id(self, chat_id: str, client_msg_id: str) -> Optional[dict]:
+        doc = await self.col.find_one({"chat_id": chat_id, "client_msg_id": client_msg_id})
+        return doc
+
+    async def find_by_seq(self, chat_id: str, seq: int) -> Optional[dict]:
+        return await self.col.find_one({"chat_id": chat_id, "seq": seq})
+
+    async def apply_edit(self, chat_id: str, seq: int, edit_seq: int, changes: dict,
+                         unset: tuple = ()) -> Optional[dict]:
+        """Apply an edit or delete stamped with the room's `edit_seq`, in place.
+        Returns the updated message, or None if it is gone, deleted, or already carries a later edit."""
+        update: dict = {"$set": {**changes, "edit_seq": edit_seq}}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        return await self.col.find_one_and_update(
+            {"chat_id": chat_id, "seq": seq, "deleted": {"$ne": True}, "edit_seq": {"$not": {"$gte": edit_seq}}},
+            update,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def edits_since(self, chat_id: str, after_edit_seq: int, max_seq: Optional[int] = None,
+                          limit: int = 100) -> List[dict]:
+        """Messages edited or deleted after `after_edit_seq` (optionally only those with seq <= max_seq),
+        in edit order, with just the fields a client needs to patch its copy."""
+        query: dict = {"chat_id": chat_id, "edit_seq": {"$gt": after_edit_seq}}
+        if max_seq is not None:
+            query["seq"] = {"$lte": max_seq}
+        cursor = self.col.find(
+            query, {"chat_id": 1, "seq": 1, "edit_seq": 1, "content": 1, "edited_at": 1, "deleted": 1}
+        ).sort("edit_seq", 1).limit(limit)
+        return [m async for m in cursor]
+
+    async def list_for_chat(self, chat_id: str, limit: int = 100, before_seq: Optional[int] = None) -> List[dict]:
+        """Latest `limit` messages of a chat (optionally older than `before_seq`), oldest first."""
+        query: dict = {"chat_id": chat_id}
+        if before_seq is not None:
+            query["seq"] = {"$lt": before_seq}
+        cursor = self.read_col.find(query).sort("seq", -1).limit(limit)
+        msgs = [m async for m in cursor]
+        msgs.reverse()
+        return msgs
+
+    async def list_since(self, chat_id: str, after_seq: int, limit: int = 100) -> List[dict]:
+        """Messages with seq > after_seq, oldest first (indexed range read)."""
+        cursor = self.col.find({"chat_id": chat_id, "seq": {"$gt": after_seq}}).sort("seq", 1).limit(limit)
+        return [m async for m in cursor]
+
+    async def oldest(self, chat_id: str, limit: int) -> List[dict]:
+        """The `limit` lowest-seq messages of a chat with their raw BSON values, for archiving."""
+        raw = self.col.with_options(codec_options=CodecOptions())
+        cursor = raw.find({"chat_id": chat_id}).sort("seq", 1).limit(limit)
+        return [m async for m in cursor]
+
+    async def delete_range(self, chat_id: str, first_seq: int, last_seq: int) -> int:
+        r = await self.col.delete_many({"chat_id": chat_id, "seq": {"$gte": first_seq, "$lte": last_seq}})
+        return r.deleted_count
+
+
+class MessageArchiveRepository:
+    """Cold storage for messages moved out of `messages` by the retention job.
+
+    One document per segment: a run of consecutive messages of one room,
+      {"chat_id": ..., "first_seq": 1, "last_seq": 500, "count": 500,
+       "archived_at": ..., "codec": "zlib", "data": <compressed BSON>}
+    Segments are immutable; a room's history is read newest segment first.
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["message_archive"]
+        self.read_col = connect_read()["message_archive"]
+
+    async def ensure_indexes(self):
+        # unique, so re-archiving the same run after an interrupted job is detected
+        await self.col.create_index([("chat_id", 1), ("first_seq", 1)], unique=True)
+        await self.col.create_index([("chat_id", 1), ("last_seq", 1)])
+
+    @staticmethod
+    def _pack(messages: List[dict]) -> bytes:
+        return zlib.compress(bson.encode({"messages": messages}), 6)
+
+    @staticmethod
+    def _unpack(segment: dict) -> List[dict]:
+        # decoded with the app's codec so archived messages look exactly like hot ones
+        raw = zlib.decompress(segment["data"])
+        return bson.decode(raw, codec_options=JSON_READY_CODEC_OPTIONS)["messages"]
+
+    async def insert_segment(self, chat_id: str, messages: List[dict]) -> int:
+        """Store `messages` (raw BSON values, ascending seq) as one segment.
+        Returns the last seq the archive now holds for that run, which is lower than the
+        batch's own when an earlier, shorter segment starting at the same seq already exists."""
+        segment = {
+            "chat_id": chat_id,
+            "first_seq": messages[0]["seq"],
+            "last_seq": messages[-1]["seq"],
+            "count": len(messages),
+            "archived_at": datetime.utcnow(),
+            "codec": "zlib",
+            "data": self._pack(messages),
+        }
+        try:
+            await self.col.insert_one(segment)
+            return segment["last_seq"]
+        except DuplicateKeyError:
+            existing = await self.col.find_one({"chat_id": chat_id, "first_seq": segment["first_seq"]}, {"last_seq": 1})
+            return existing["last_seq"]
+
+    async def list_before(self, chat_id: str, before_seq: Optional[int], limit: int) -> List[dict]:
+        """Up to `limit` archived messages with seq < before_seq (all if None), oldest first."""
+        query: dict = {"chat_id": chat_id}
+        if before_seq is not None:
+            query["first_seq"] = {"$lt": before_seq}
+        out: List[dict] = []
+        async for segment in self.read_col.find(query).sort("first_seq", -1):
+            msgs = [m for m in self._unpack(segment) if before_seq is None or m["seq"] < before_seq]
+            out[:0] = msgs
+            if len(out) >= limit:
+                break
+        return out[-limit:]
+
+    async def list_since(self, chat_id: str, after_seq: int, limit: int) -> List[dict]:
+        """Up to `limit` archived messages with seq > after_seq, oldest first."""
+        out: List[dict] = []
+        # segments never overlap, so last_seq order is first_seq order
+        cursor = self.read_col.find({"chat_id": chat_id, "last_seq": {"$gt": after_seq}}).sort("last_seq", 1)
+        async for segment in cursor:
+            out.extend(m for m in self._unpack(segment) if m["seq"] > after_seq)
+            if len(out) >= limit:
+                break
+        return out[:limit]
+
+    async def delete_chat(self, chat_id: str):
+        await self.col.delete_many({"chat_id": chat_id})
 
-    async def list_for_chat(self, chat_id: str, limit: int = 100) -> List[dict]:
-        cursor = self.col.find({"chat_id": chat_id}).sort("created_at", -1).limit(limit)
-        return [normalize_doc(m) async for m in cursor]
+
+class AttachmentRepository:
+    """Files shared in rooms, stored in GridFS (`attachments.files` / `attachments.chunks`).
+    The file document carries the upload's `sha256`; its `metadata` holds room_id, uploader_id,
+    content_type and, once generated, thumbnail_id. Thumbnails are GridFS files themselves
+    (`metadata.thumbnail_of`)."""
+
+    def __init__(self):
+        self._db = connect()
+        self.files = self._db["attachments.files"]
+        self._bucket = None
+
+    @property
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        if self._bucket is None:
+            # GridFS matches chunks on the raw ObjectId files_id, so it gets the default codec
+            self._bucket = AsyncIOMotorGridFSBucket(self._db.with_options(codec_options=CodecOptions()),
+                                                    bucket_name="attachments")
+        return self._bucket
+
+    def open_upload(self, filename: str, chunk_size: int, metadata: dict):
+        return self.bucket.open_upload_stream(filename, chunk_size_bytes=chunk_size, metadata=metadata)
+
+    async def upload(self, filename: str, data: bytes, metadata: dict) -> str:
+        return str(await self.bucket.upload_from_stream(filename, data, metadata=metadata))
+
+    async def open_download(self, file_id: str):
+        return await self.bucket.open_download_stream(ObjectId(file_id))
+
+    async def find_by_id(self, file_id: str) -> Optional[dict]:
+        return await self.files.find_one({"_id": ObjectId(file_id)})
+
+    async def find_by_ids(self, ids: List[str]) -> List[dict]:
+        cursor = self.files.find({"_id": {"$in": [ObjectId(i) for i in ids]}})
+        return [f async for f in cursor]
+
+    async def set_thumbnail(self, file_id: str, thumbnail_id: str):
+        await self.files.update_one({"_id": ObjectId(file_id)}, {"$set": {"metadata.thumbnail_id": thumbnail_id}})
 
 
 class GroupRepository:
+    """Group documents hold the group's own fields plus a cached `member_count`;
+    membership lives in `group_members` (see GroupMemberRepository)."""
+
     def __init__(self):
         self._db = connect()
         self.col = self._db["groups"]
+        self.read_col = connect_read()["groups"]
 
     async def create(self, group: dict) -> dict:
+        """Insert a new group. Raises DuplicateKeyError if the name is already taken."""
         group["created_at"] = datetime.utcnow()
-        r = await self.col.insert_one(group)
-        doc = await self.col.find_one({"_id": r.inserted_id})
-        return normalize_doc(doc)
+        group["name_key"] = group["name"]
+        await self.col.insert_one(group)
+        return normalize_doc(group)
 
-    async def find_by_id(self, _id: str) -> Optional[dict]:
-        doc = await self.col.find_one({"_id": ObjectId(_id)})
-        return normalize_doc(doc)
+    async def find_by_id(self, _id: str, shared: bool = True) -> Optional[dict]:
+        """The group. With `shared` a read already in flight is joined, so the result may predate
+        the call; pass False where the body must be at least as new as something read before it."""
+        if not shared:
+            return await self.col.find_one({"_id": ObjectId(_id)}, {"members": 0})
+        return await _group_by_id.do(_id, lambda: self.col.find_one({"_id": ObjectId(_id)}, {"members": 0}))
+
+    async def find_by_ids(self, ids: List[str]) -> List[Any]:
+        # legacy embedded `messages` arrays are trimmed to their last entry
+        cursor = self.read_col.find(
+            {"_id": {"$in": [ObjectId(i) for i in ids]}},
+            {"messages": {"$slice": -1}, "members": 0},
+        ).sort("created_at", -1)
+        return [g async for g in cursor]
 
-    async def find_by_member(self, user_id: str) -> List[Any]:
-        # returns groups where `members` array contains the user_id
-        cursor = self.col.find({"members": user_id}).sort("created_at", -1)
-        return [normalize_doc(g) async for g in cursor]
+    async def ensure_indexes(self):
+        # group names are unique; `name_key` is only set on the group that owns the name
+        await self.col.create_index([("name_key", 1)], unique=True,
+                                    partialFilterExpression={"name_key": {"$type": "string"}})
+
+    async def backfill_name_keys(self):
+        """Give groups created before `name_key` existed their key."""
+        await _backfill_unique_key(self.col, {"name": {"$type": "string"}}, "name_key", lambda g: g["name"])
 
     async def find_by_name(self, name: str) -> Optional[dict]:
-        doc = await self.col.find_one({"name": name})
-        return normalize_doc(doc)
+        doc = await self.col.find_one({"name_key": name}, {"members": 0})
+        return doc
 
-    async def add_member(self, group_id: str, user_id: str):
-        """Add a user to the group's members list if they are not already a member."""
-        await self.col.update_one({"_id": ObjectId(group_id)}, {"$addToSet": {"members": user_id}})
+    async def get_or_create_by_name(self, name: str, created_by: str) -> dict:
+        """The group called `name`, created (owned by `created_by`) if it does not exist yet."""
+        return await _upsert(
+            self.col,
+            {"name_key": name},
+            {"name": name, "created_by": created_by, "member_count": 0, "created_at": datetime.utcnow()},
+        )
 
-    async def add_message(self, group_id: str, message: dict):
-        """Add a message to the group's messages array."""
-        message["created_at"] = datetime.utcnow()
-        await self.col.update_one({"_id": ObjectId(group_id)}, {"$push": {"messages": message}})
+    async def inc_member_count(self, group_id: str, delta: int):
+        await self.col.update_one({"_id": ObjectId(group_id)}, {"$inc": {"member_count": delta, "version": 1}})
+
+    async def version(self, group_id: str) -> Optional[int]:
+        """The group's `version`, bumped by every write to the document; None if it does not exist."""
+        doc = await self.col.find_one({"_id": ObjectId(group_id)}, {"version": 1})
+        return doc.get("version", 0) if doc else None
+
+    async def next_seq(self, group_id: str) -> Optional[dict]:
+        """Atomically allocate the group's next message sequence number.
+        Returns {"_id", "seq"} or None if the group does not exist.
+        """
+        return await self.col.find_one_and_update(
+            {"_id": ObjectId(group_id)},
+            {"$inc": {"seq": 1, "version": 1}},
+            projection={"seq": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def counters(self, group_id: str) -> Optional[dict]:
+        """The group's message counters, read from the primary (see _counters)."""
+        return _counters(await self.col.find_one({"_id": ObjectId(group_id)}, _COUNTER_FIELDS))
+
+    async def next_edit_seq(self, group_id: str) -> Optional[dict]:
+        """Atomically allocate the group's next edit number (edits and deletes share one counter).
+        Returns {"_id", "edit_seq", "last_message": {"seq"}} or None if the group does not exist.
+        """
+        return await self.col.find_one_and_update(
+            {"_id": ObjectId(group_id)},
+            {"$inc": {"edit_seq": 1, "version": 1}},
+            projection={"edit_seq": 1, "last_message.seq": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def set_last_message(self, group_id: str, message: dict):
+        """Keep a copy of the newest message on the group for the chat list."""
+        await self.col.update_one({"_id": ObjectId(group_id)}, {"$set": {"last_message": message}, "$inc": {"version": 1}})
+
+    async def edit_last_message(self, group_id: str, seq: int, changes: dict, unset: tuple = ()):
+        """Apply an edit to the group's copy of its newest message, if it is still message `seq`."""
+        update: dict = {"$set": {f"last_message.{k}": v for k, v in changes.items()}, "$inc": {"version": 1}}
+        if unset:
+            update["$unset"] = {f"last_message.{field}": "" for field in unset}
+        await self.col.update_one({"_id": ObjectId(group_id), "last_message.seq": seq}, update)
 
     async def delete(self, group_id: str):
         """Delete a group by its ID."""
         await self.col.delete_one({"_id": ObjectId(group_id)})
 
+    async def set_retention(self, group_id: str, days: Optional[int]):
+        """Per-group retention override in days; None falls back to the global policy."""
+        await self.col.update_one({"_id": ObjectId(group_id)}, {"$set": {"retention_days": days}, "$inc": {"version": 1}})
+
+    async def retention_policies(self):
+        """Yield (room_id, retention_days or None) for every group."""
+        async for g in self.col.find({}, {"retention_days": 1}):
+            yield f"group:{g['_id']}", g.get("retention_days")
+
+    async def migrate_embedded_members(self, members: "GroupMemberRepository"):
+        """Move `members` arrays written by older versions into `group_members`."""
+        async for g in self.col.find({"members": {"$exists": True}}, {"members": 1}):
+            group_id = str(g["_id"])
+            await members.add_many(group_id, g.get("members") or [])
+            count = await members.count(group_id)
+            await self.col.update_one({"_id": ObjectId(group_id)},
+                                      {"$set": {"member_count": count}, "$unset": {"members": ""}, "$inc": {"version": 1}})
+
+
+class GroupMemberRepository:
+    """One small document per (group, user) with the member's role. Joining is a single
+    upsert regardless of group size; member lists are read page by page."""
+
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["group_members"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("group_id", 1), ("user_id", 1)], unique=True)
+        await self.col.create_index([("user_id", 1)])
+        await self.col.create_index([("group_id", 1), ("_id", 1)])
+
+    async def add(self, group_id: str, user_id: str, role: str = "member") -> bool:
+        """Add a member if not already present. Returns True if the user was added."""
+        r = await self.col.update_one(
+            {"group_id": group_id, "user_id": user_id},
+            {"$setOnInsert": {"role": role, "joined_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        return r.upserted_id is not None
+
+    async def add_many(self, group_id: str, user_ids: List[str], role: str = "member") -> int:
+        if not user_ids:
+            return 0
+        now = datetime.utcnow()
+        ops = [
+            UpdateOne({"group_id": group_id, "user_id": uid}, {"$setOnInsert": {"role": role, "joined_at": now}}, upsert=True)
+            for uid in dict.fromkeys(user_ids)
+        ]
+        r = await self.col.bulk_write(ops, ordered=False)
+        return r.upserted_count
+
+    async def is_member(self, group_id: str, user_id: str) -> bool:
+        return await self.col.find_one({"group_id": group_id, "user_id": user_id}, {"_id": 1}) is not None
+
+    async def role(self, group_id: str, user_id: str) -> Optional[str]:
+        doc = await self.col.find_one({"group_id": group_id, "user_id": user_id}, {"role": 1})
+        return doc["role"] if doc else None
+
+    async def group_ids_for_user(self, user_id: str) -> List[str]:
+        cursor = self.col.find({"user_id": user_id}, {"group_id": 1, "_id": 0})
+        return [m["group_id"] async for m in cursor]
+
+    async def member_ids(self, group_id: str) -> List[str]:
+        # covered by the (group_id, user_id) index
+        cursor = self.col.find({"group_id": group_id}, {"user_id": 1, "_id": 0})
+        return [m["user_id"] async for m in cursor]
+
+    async def list(self, group_id: str, after: Optional[str] = None, limit: int = 50) -> List[Any]:
+        """A page of members in join order. Pass the last `_id` seen as `after` for the next page."""
+        query: dict = {"group_id": group_id}
+        if after:
+            query["_id"] = {"$gt": ObjectId(after)}
+        cursor = self.col.find(query).sort("_id", 1).limit(limit)
+        return [m async for m in cursor]
+
+    async def count(self, group_id: str) -> int:
+        return await self.col.count_documents({"group_id": group_id})
+
+    async def delete_group(self, group_id: str):
+        await self.col.delete_many({"group_id": group_id})
+
+
 class AiSessionRepository:
     """Repository for storing AI chat sessions for each user."""
     def __init__(self):
@@ -123,14 +572,13 @@ class AiSessionRepository:
     async def find_by_user_id(self, user_id: str) -> Optional[dict]:
         """Find an AI chat session by user ID."""
         doc = await self.col.find_one({"user_id": ObjectId(user_id)})
-        return normalize_doc(doc)
+        return doc
 
     async def create(self, user_id: str) -> dict:
         """Create a new AI chat session for a user."""
         session = {"user_id": ObjectId(user_id), "messages": [], "created_at": datetime.utcnow()}
-        r = await self.col.insert_one(session)
-        doc = await self.col.find_one({"_id": r.inserted_id})
-        return normalize_doc(doc)
+        await self.col.insert_one(session)
+        return normalize_doc(session)
 
     async def add_message(self, session_id: str, message: dict):
         """Add a message to the session's messages array.
@@ -157,39 +605,455 @@ class ConversationRepository:
     def __init__(self):
         self._db = connect()
         self.col = self._db["conversations"]
+        self.read_col = connect_read()["conversations"]
+
+    @staticmethod
+    def dm_key(a: str, b: str) -> str:
+        ids = sorted([a, b])
+        return f"{ids[0]}-{ids[1]}"
+
+    async def ensure_indexes(self):
+        # one DM per pair of users
+        await self.col.create_index([("dm_key", 1)], unique=True,
+                                    partialFilterExpression={"dm_key": {"$type": "string"}})
+
+    async def backfill_dm_keys(self):
+        """Give DMs created before `dm_key` existed their key."""
+        await _backfill_unique_key(
+            self.col, {"type": "dm"}, "dm_key",
+            lambda c: self.dm_key(*c["participant_ids"]) if len(c.get("participant_ids") or []) == 2 else None,
+        )
 
     async def create(self, conv: dict) -> dict:
         conv["created_at"] = datetime.utcnow()
-        r = await self.col.insert_one(conv)
-        doc = await self.col.find_one({"_id": r.inserted_id})
-        return normalize_doc(doc)
+        await self.col.insert_one(conv)
+        return normalize_doc(conv)
 
     async def find_dm_between(self, a: str, b: str) -> Optional[dict]:
-        # participant_ids stored as unordered array of strings
-        # find conversation with exactly these two participants
-        ids = sorted([a, b])
-        doc = await self.col.find_one({"type": "dm", "participant_ids": ids})
-        return normalize_doc(doc)
+        doc = await self.col.find_one({"dm_key": self.dm_key(a, b)})
+        return doc
+
+    async def get_or_create_dm(self, a: str, b: str) -> dict:
+        """The DM between a and b, created if it does not exist yet."""
+        return await _upsert(
+            self.col,
+            {"dm_key": self.dm_key(a, b)},
+            {"type": "dm", "participant_ids": sorted([a, b]), "created_at": datetime.utcnow()},
+        )
 
     async def find_by_participant(self, user_id: str) -> List[Any]:
-        cursor = self.col.find({"participant_ids": user_id}).sort("created_at", -1)
-        return [normalize_doc(c) async for c in cursor]
+        cursor = self.read_col.find({"participant_ids": user_id}, {"messages": {"$slice": -1}}).sort("created_at", -1)
+        return [c async for c in cursor]
 
     async def find_by_id(self, _id: str) -> Optional[dict]:
         doc = await self.col.find_one({"_id": ObjectId(_id)})
-        return normalize_doc(doc)
-    
-    async def add_message(self, conv_id: str, message: dict):
-        """Add a message to the conversation.
-        This assumes the conversation document has a `messages` array.
+        return doc
+
+    async def room_ids_for_participant(self, user_id: str) -> List[str]:
+        cursor = self.col.find({"participant_ids": user_id, "type": "dm"}, {"participant_ids": 1})
+        return [f"dm:{c['participant_ids'][0]}-{c['participant_ids'][1]}" async for c in cursor
+                if len(c.get("participant_ids", [])) == 2]
+
+    async def next_dm_seq(self, a: str, b: str) -> Optional[dict]:
+        """Atomically allocate the next message sequence number of the DM between a and b.
+        Returns {"_id", "seq"} or None if no such conversation exists.
         """
-        message["created_at"] = datetime.utcnow()
-        result = await self.col.update_one(
-            {"_id": ObjectId(conv_id)},
-            {"$push": {"messages": message}}
+        return await self.col.find_one_and_update(
+            {"dm_key": self.dm_key(a, b)},
+            {"$inc": {"seq": 1, "version": 1}},
+            projection={"seq": 1},
+            return_document=ReturnDocument.AFTER,
         )
-        return result.modified_count > 0
+
+    async def dm_counters(self, a: str, b: str) -> Optional[dict]:
+        """The DM's message counters, read from the primary (see _counters)."""
+        return _counters(await self.col.find_one({"dm_key": self.dm_key(a, b)}, _COUNTER_FIELDS))
+
+    async def next_dm_edit_seq(self, a: str, b: str) -> Optional[dict]:
+        """Atomically allocate the next edit number of the DM between a and b.
+        Returns {"_id", "edit_seq", "last_message": {"seq"}} or None if no such conversation exists.
+        """
+        return await self.col.find_one_and_update(
+            {"dm_key": self.dm_key(a, b)},
+            {"$inc": {"edit_seq": 1, "version": 1}},
+            projection={"edit_seq": 1, "last_message.seq": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def set_last_message(self, conv_id: str, message: dict):
+        """Keep a copy of the newest message on the conversation for the chat list."""
+        await self.col.update_one({"_id": ObjectId(conv_id)}, {"$set": {"last_message": message}, "$inc": {"version": 1}})
+
+    async def edit_last_message(self, conv_id: str, seq: int, changes: dict, unset: tuple = ()):
+        """Apply an edit to the conversation's copy of its newest message, if it is still message `seq`."""
+        update: dict = {"$set": {f"last_message.{k}": v for k, v in changes.items()}, "$inc": {"version": 1}}
+        if unset:
+            update["$unset"] = {f"last_message.{field}": "" for field in unset}
+        await self.col.update_one({"_id": ObjectId(conv_id), "last_message.seq": seq}, update)
 
     async def delete(self, conv_id: str):
         """Delete a conversation by its ID."""
         await self.col.delete_one({"_id": ObjectId(conv_id)})
+
+    async def retention_policies(self):
+        """Yield (room_id, retention_days or None) for every DM."""
+        async for c in self.col.find({"type": "dm"}, {"participant_ids": 1, "retention_days": 1}):
+            parts = c.get("participant_ids") or []
+            if len(parts) == 2:
+                yield f"dm:{self.dm_key(*parts)}", c.get("retention_days")
+
+
+class ReadReceiptRepository:
+    """Per-user, per-room "last read" watermarks.
+    One document per (user_id, room_id): {"user_id": ..., "room_id": ..., "last_read_at": ...}
+    Watermarks only ever move forward ($max), so late or reordered writes are harmless.
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["read_receipts"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("user_id", 1), ("room_id", 1)], unique=True)
+        await self.col.create_index([("room_id", 1)])
+
+    async def bulk_advance(self, watermarks: dict[tuple[str, str], datetime]):
+        """Advance many (user_id, room_id) watermarks in a single round trip."""
+        if not watermarks:
+            return
+        ops = [
+            UpdateOne({"user_id": user_id, "room_id": room_id}, {"$max": {"last_read_at": ts}}, upsert=True)
+            for (user_id, room_id), ts in watermarks.items()
+        ]
+        await self.col.bulk_write(ops, ordered=False)
+
+    async def find_for_room(self, room_id: str) -> List[dict]:
+        cursor = self.col.find({"room_id": room_id}, {"_id": 0})
+        return [r async for r in cursor]
+
+
+class UnreadCounterRepository:
+    """Unread message counters, one document per (user_id, room_id):
+      {"user_id": ..., "room_id": ..., "count": 3, "v": 41, "pending": 0}
+    Counters are maintained incrementally, never computed by scanning messages.
+    `v` is the user's chat list version at which the room last changed (see
+    ChatListVersionRepository).
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["unread_counters"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("user_id", 1), ("room_id", 1)], unique=True)
+
+    async def apply(self, increments: dict[tuple[str, str], int], resets: set[tuple[str, str]],
+                    touched: set[tuple[str, str]] = frozenset()):
+        """Apply a batch of increments and resets in one round trip.
+        A key that was reset and then incremented in the same batch ends at its increment.
+        Every written key (and every key in `touched`) is also marked `pending` until `stamp`.
+        """
+        ops = []
+        for user_id, room_id in resets:
+            ops.append(UpdateOne(
+                {"user_id": user_id, "room_id": room_id},
+                {"$set": {"count": increments.get((user_id, room_id), 0)}, "$inc": {"pending": 1}},
+                upsert=True,
+            ))
+        for (user_id, room_id), delta in increments.items():
+            if (user_id, room_id) in resets:
+                continue
+            ops.append(UpdateOne({"user_id": user_id, "room_id": room_id},
+                                 {"$inc": {"count": delta, "pending": 1}}, upsert=True))
+        for user_id, room_id in touched:
+            if (user_id, room_id) in resets or (user_id, room_id) in increments:
+                continue
+            ops.append(UpdateOne({"user_id": user_id, "room_id": room_id},
+                                 {"$inc": {"pending": 1}, "$setOnInsert": {"count": 0}}, upsert=True))
+        if ops:
+            await self.col.bulk_write(ops, ordered=False)
+
+    async def counts_for_user(self, user_id: str) -> dict[str, int]:
+        cursor = self.col.find({"user_id": user_id, "count": {"$gt": 0}}, {"_id": 0, "room_id": 1, "count": 1})
+        return {c["room_id"]: c["count"] async for c in cursor}
+
+    async def counts_for(self, user_ids: List[str], room_ids: List[str]) -> List[dict]:
+        cursor = self.col.find(
+            {"user_id": {"$in": user_ids}, "room_id": {"$in": room_ids}},
+            {"_id": 0, "user_id": 1, "room_id": 1, "count": 1},
+        )
+        return [c async for c in cursor]
+
+    async def stamp(self, versions: dict[tuple[str, str], int], marks: Optional[dict[tuple[str, str], int]] = None):
+        """Record `v`, the chat list version at which each (user, room) last changed, and
+        clear the `pending` marks `apply` set (one per key, or as many as `marks` says). Until
+        then the room counts as changed for any version: its user's version may already have
+        moved past the stamp it will get."""
+        marks = marks or {}
+        ops = [
+            UpdateOne({"user_id": user_id, "room_id": room_id},
+                      {"$max": {"v": v}, "$inc": {"pending": -marks.get((user_id, room_id), 1)}})
+            for (user_id, room_id), v in versions.items()
+        ]
+        if ops:
+            await self.col.bulk_write(ops, ordered=False)
+
+    async def changed_since(self, user_id: str, v: int) -> List[str]:
+        """Rooms of a user's chat list that changed after list version `v`."""
+        cursor = self.col.find({"user_id": user_id, "$or": [{"v": {"$gt": v}}, {"pending": {"$gt": 0}}]},
+                               {"_id": 0, "room_id": 1})
+        return [c["room_id"] async for c in cursor]
+
+
+class ChatListVersionRepository:
+    """Version of each user's chat list, one document per user:
+      {"_id": user_id, "v": 41, "epoch": 2}
+    `v` is bumped after anything shown in the list changed, and the rooms that
+    changed are stamped with it in `unread_counters`, so a client holding an
+    older `v` can ask for just those. `epoch` is bumped when rooms leave the
+    list, which a delta cannot express; clients from an older epoch get the
+    full list again.
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["chat_list_versions"]
+
+    async def bump(self, user_ids: List[str], removed: bool = False) -> dict[str, tuple[int, int]]:
+        """Bump the versions of `user_ids` and return each user's (epoch, v) afterwards."""
+        if not user_ids:
+            return {}
+        inc = {"v": 1, "epoch": 1} if removed else {"v": 1}
+        await self.col.bulk_write([UpdateOne({"_id": uid}, {"$inc": inc}, upsert=True) for uid in user_ids],
+                                  ordered=False)
+        # read back rather than returned per update: a concurrent bump can only make these larger
+        cursor = self.col.find({"_id": {"$in": user_ids}})
+        return {d["_id"]: (d.get("epoch", 0), d["v"]) async for d in cursor}
+
+    async def get(self, user_id: str) -> tuple[int, int]:
+        """(epoch, v) of a user's chat list."""
+        doc = await self.col.find_one({"_id": user_id}) or {}
+        return doc.get("epoch", 0), doc.get("v", 0)
+
+
+class NotificationRepository:
+    """Messages waiting to be mentioned in an offline user's email digest, one document each:
+      {"user_id", "room_id", "sender_username", "preview", "created_at", "attempts"}
+    plus `notification_claims`, one lease per user being handled by a digest run:
+      {"_id": user_id, "owner": <run token>, "claimed_until": ...}
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["notification_queue"]
+        self.claims = self._db["notification_claims"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("user_id", 1), ("created_at", 1)])
+        await self.col.create_index([("created_at", 1)])
+        # leases of crashed runs are cleaned up once expired
+        await self.claims.create_index([("claimed_until", 1)], expireAfterSeconds=0)
+
+    async def claim(self, user_ids: List[str], owner: str, until: datetime) -> List[str]:
+        """Take the digest lease of these users until `until`. Returns the ones claimed: a user
+        leased by another run that has not expired yet fails its upsert with a duplicate key."""
+        now = datetime.utcnow()
+        ops = [
+            UpdateOne({"_id": uid, "claimed_until": {"$lte": now}},
+                      {"$set": {"owner": owner, "claimed_until": until}}, upsert=True)
+            for uid in user_ids
+        ]
+        if not ops:
+            return []
+        try:
+            await self.claims.bulk_write(ops, ordered=False)
+            return list(user_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            taken = {err["index"] for err in errors}
+            return [uid for i, uid in enumerate(user_ids) if i not in taken]
+
+    async def release(self, user_ids: List[str], owner: str):
+        if user_ids:
+            await self.claims.delete_many({"_id": {"$in": user_ids}, "owner": owner})
+
+    async def insert_many(self, docs: List[dict]):
+        if docs:
+            await self.col.insert_many(docs, ordered=False)
+
+    async def due_users(self, cutoff: datetime, after: Optional[str], limit: int) -> List[str]:
+        """Users (in id order, after `after`) with a notification queued before `cutoff`."""
+        pipeline: list = [{"$match": {"created_at": {"$lte": cutoff}}}, {"$group": {"_id": "$user_id"}}]
+        if after is not None:
+            pipeline.append({"$match": {"_id": {"$gt": after}}})
+        pipeline += [{"$sort": {"_id": 1}}, {"$limit": limit}]
+        return [d["_id"] async for d in self.col.aggregate(pipeline)]
+
+    async def summarize(self, user_ids: List[str], until: datetime) -> List[dict]:
+        """Per (user, room): how many notifications are queued until `until`, the latest one,
+        when the oldest was queued and the highest attempt count."""
+        pipeline = [
+            {"$match": {"user_id": {"$in": user_ids}, "created_at": {"$lte": until}}},
+            {"$sort": {"created_at": 1}},
+            {"$group": {
+                "_id": {"user_id": "$user_id", "room_id": "$room_id"},
+                "count": {"$sum": 1},
+                "last_sender": {"$last": "$sender_username"},
+                "last_preview": {"$last": "$preview"},
+                "attempts": {"$max": "$attempts"},
+                "first_at": {"$first": "$created_at"},
+            }},
+        ]
+        return [d async for d in self.col.aggregate(pipeline)]
+
+    async def delete_for(self, user_ids: List[str], until: datetime):
+        if user_ids:
+            await self.col.delete_many({"user_id": {"$in": user_ids}, "created_at": {"$lte": until}})
+
+    async def mark_failed(self, user_ids: List[str], until: datetime):
+        if user_ids:
+            await self.col.update_many({"user_id": {"$in": user_ids}, "created_at": {"$lte": until}},
+                                       {"$inc": {"attempts": 1}})
+
+
+class PresenceRepository:
+    """Which users have a live socket connection, across workers. One document per user and worker:
+      {"user_id", "worker", "seen_at"}
+    refreshed by the worker's heartbeat and removed when the user's last connection there closes.
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["presence"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("user_id", 1), ("worker", 1)], unique=True)
+        # documents of a worker that died without cleaning up
+        await self.col.create_index([("seen_at", 1)], expireAfterSeconds=int(3 * settings.presence_heartbeat_seconds))
+
+    async def heartbeat(self, worker: str, user_ids: List[str]):
+        now = datetime.utcnow()
+        ops = [UpdateOne({"user_id": uid, "worker": worker}, {"$set": {"seen_at": now}}, upsert=True)
+               for uid in user_ids]
+        if ops:
+            await self.col.bulk_write(ops, ordered=False)
+
+    async def remove(self, worker: str, user_id: str):
+        await self.col.delete_one({"user_id": user_id, "worker": worker})
+
+    async def online(self, user_ids: List[str], seen_after: datetime) -> set[str]:
+        cursor = self.col.find({"user_id": {"$in": user_ids}, "seen_at": {"$gt": seen_after}}, {"user_id": 1})
+        return {d["user_id"] async for d in cursor}
+
+
+class MessageSearchRepository:
+    """Search copy of messages with a text index on `content`.
+    Kept apart from `messages` so inserts on the send path never pay for text index maintenance;
+    documents share the message `_id`, which makes re-indexing idempotent.
+    """
+    def __init__(self):
+        self._db = connect()
+        self.col = self._db["message_search"]
+        self.read_col = connect_read()["message_search"]
+
+    async def ensure_indexes(self):
+        await self.col.create_index([("content", "text")], default_language="none")
+        await self.col.create_index([("chat_id", 1), ("seq", 1)])
+
+    @staticmethod
+    def document(msg: dict) -> dict:
+        """The search copy of a stored message, whether read JSON-ready or raw."""
+        created_at = msg.get("created_at")
+        return {
+            "_id": ObjectId(msg["_id"]),
+            "chat_id": msg["chat_id"],
+            "seq": msg.get("seq"),
+            "sender_id": msg.get("sender_id"),
+            "sender_username": msg.get("sender_username"),
+            "content": msg["content"],
+            "created_at": datetime.fromisoformat(created_at) if isinstance(created_at, str) else created_at,
+        }
+
+    async def backfill(self, messages: "MessageRepository", batch_size: int = 1000) -> int:
+        """Index every live message in `messages`, walking it in `_id` order.
+        Idempotent: messages already indexed are skipped by their shared `_id`. Returns how many were read."""
+        raw = messages.col.with_options(codec_options=CodecOptions())
+        query = {"content": {"$nin": [None, ""]}, "deleted": {"$ne": True}}
+        fields = {"chat_id": 1, "seq": 1, "sender_id": 1, "sender_username": 1, "content": 1, "created_at": 1}
+        last_id, read = None, 0
+        while True:
+            page = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+            batch = [m async for m in raw.find(page, fields).sort("_id", 1).limit(batch_size)]
+            if not batch:
+                return read
+            await self.insert_many([self.document(m) for m in batch])
+            read += len(batch)
+            last_id = batch[-1]["_id"]
+
+    async def insert_many(self, docs: List[dict]):
+        if not docs:
+            return
+        try:
+            await self.col.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # already indexed (duplicate _id) is fine, anything else is not
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    async def apply_changes(self, changes: dict[str, Optional[str]]):
+        """Apply message edits ({_id: new content}) and deletes ({_id: None}) to the index."""
+        ops = [
+            DeleteOne({"_id": ObjectId(_id)}) if content is None
+            else UpdateOne({"_id": ObjectId(_id)}, {"$set": {"content": content}})
+            for _id, content in changes.items()
+        ]
+        if ops:
+            await self.col.bulk_write(ops, ordered=False)
+
+    async def delete_range(self, chat_id: str, first_seq: int, last_seq: int) -> int:
+        r = await self.col.delete_many({"chat_id": chat_id, "seq": {"$gte": first_seq, "$lte": last_seq}})
+        return r.deleted_count
+
+    async def search(self, query: str, chat_ids: List[str], skip: int = 0, limit: int = 20) -> List[dict]:
+        cursor = (
+            self.read_col.find(
+                {"$text": {"$search": query}, "chat_id": {"$in": chat_ids}},
+                {"score": {"$meta": "textScore"}},
+            )
+            .sort([("score", {"$meta": "textScore"}), ("created_at", -1)])
+            .skip(skip)
+            .limit(limit)
+        )
+        return [m async for m in cursor]
+
+
+async def ensure_indexes():
+    """Create the indexes the repositories rely on. Idempotent and cheap once they exist:
+    safe to call on every startup. Data in older layouts is moved by `migrate`."""
+    await SessionRepository().ensure_indexes()
+    await GroupMemberRepository().ensure_indexes()
+    await GroupRepository().ensure_indexes()
+    await ConversationRepository().ensure_indexes()
+    await MessageRepository().ensure_indexes()
+    await MessageArchiveRepository().ensure_indexes()
+    await MessageSearchRepository().ensure_indexes()
+    await ReadReceiptRepository().ensure_indexes()
+    await UnreadCounterRepository().ensure_indexes()
+    await NotificationRepository().ensure_indexes()
+    await PresenceRepository().ensure_indexes()
+
+
+async def migrate():
+    """Move data written by older versions into the current layout: full scans, run once
+    per deployment (python -m app.cli.migrate) rather than on startup. Every step skips
+    what is already migrated, so re-running it, or running it while the app serves, is safe."""
+    # unhashed sessions would collide in the unique token_hash index
+    await SessionRepository().drop_unhashed()
+    # the moves below rely on the unique indexes to stay idempotent
+    await ensure_indexes()
+    groups, convs, messages = GroupRepository(), ConversationRepository(), MessageRepository()
+    await groups.migrate_embedded_members(GroupMemberRepository())
+    await groups.backfill_name_keys()
+    await convs.backfill_dm_keys()
+    await messages.migrate_embedded(groups.col, lambda g: f"group:{g['_id']}")
+    await messages.migrate_embedded(
+        convs.col,
+        lambda c: f"dm:{c['participant_ids'][0]}-{c['participant_ids'][1]}" if len(c.get("participant_ids") or []) == 2 else None,
+    )
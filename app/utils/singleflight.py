@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+from .metrics import metrics
+
+
+class SingleFlight:
+    """Collapses concurrent identical reads into one.
+
+    The first caller for a key starts the query; callers arriving while it is
+    still in flight await the same task and get the same result (or error)
+    instead of issuing their own. Nothing is kept once the query finishes, so
+    this never serves stale data; a longer-lived cache can sit in front of or
+    inside the callable without either knowing about the other.
+
+    The shared result is one object for every caller: treat it as read-only.
+    The query runs as its own task, so a cancelled caller does not cancel it
+    for the others.
+    """
+
+    def __init__(self, name: str, tracked_keys: int = 256):
+        self.name = name
+        self.tracked_keys = tracked_keys
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+        # key -> [calls, shared] for the most recently used keys
+        self._keys: "OrderedDict[Hashable, list[int]]" = OrderedDict()
+        _registry.append(self)
+
+    def _count(self, key: Hashable, shared: bool):
+        self.calls += 1
+        self.shared += shared
+        counts = self._keys.pop(key, None) or [0, 0]
+        counts[0] += 1
+        counts[1] += shared
+        self._keys[key] = counts
+        if len(self._keys) > self.tracked_keys:
+            self._keys.popitem(last=False)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+            self._count(key, shared=False)
+        else:
+            self._count(key, shared=True)
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so an error nobody awaited is not logged as lost
+
+    def stats(self, top: int = 10) -> dict:
+        hottest = sorted(self._keys.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "inflight": len(self._inflight),
+            # keys carry user and room ids: reported as short hashes, enough to tell them apart
+            "hot_keys": {_key_hash(k): {"calls": c, "shared": s} for k, (c, s) in hottest if s},
+        }
+
+
+def _key_hash(key: Hashable) -> str:
+    return hashlib.sha256(str(key).encode()).hexdigest()[:12]
+
+
+_registry: list[SingleFlight] = []
+metrics.register("singleflight", lambda: {f.name: f.stats() for f in _registry})
@@ -1,10 +1,76 @@
 import socketio
-from .utils import decode_token
-from ..services.chat_service import ChatService
+from datetime import datetime, timezone
+from .utils import decode_token, fast_json
+from .config import settings
+from .background import register_periodic
+from .rate_limit import rate_limiter
+from .broadcast import SlowConsumerGuard
+from .metrics import metrics
+from .overload import overload, DEFER_PRESENCE, SHED_AI
+from ..services.chat_service import ChatService, DuplicateMessage
+from ..services.presence_service import TypingBatcher, ReadReceiptBuffer, online_users
+from ..services.unread_service import unread_counters
+from ..services.membership_service import membership, user_channel
+from ..services.room_ai_service import room_assistant
+from ..services.notification_service import notification_digests
 from .repositories import UserRepository  # Import the UserRepository
 
-# create a Socket.IO server
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+# create a Socket.IO server. The serializer is opt-in binary MessagePack; JSON stays the default.
+# Payloads above the threshold are compressed on the polling transport; on the websocket
+# transport compression is the server's permessage-deflate (uvicorn --ws-per-message-deflate).
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",
+    serializer="msgpack" if settings.socketio_serializer == "msgpack" else "default",
+    http_compression=True,
+    compression_threshold=settings.socketio_compression_threshold,
+    json=fast_json,
+)
+
+# every broadcast goes through the guard so one slow client cannot grow the worker's memory
+broadcaster = SlowConsumerGuard(sio, settings.slow_consumer_soft_limit, settings.slow_consumer_hard_limit)
+register_periodic("slow-consumer-check", settings.slow_consumer_check_seconds, broadcaster.check)
+metrics.register("socketio", broadcaster.stats)
+
+# typing indicators and read receipts are coalesced and broadcast in batches
+typing_batcher = TypingBatcher(emit=broadcaster.emit)
+receipt_buffer = ReadReceiptBuffer(emit=broadcaster.emit)
+# both are held back while the worker is overloaded; message delivery is never deferred
+register_periodic("typing-flush", settings.typing_flush_seconds, overload.deferrable(typing_batcher.flush))
+register_periodic("receipt-flush", settings.receipt_flush_seconds, overload.deferrable(receipt_buffer.flush))
+# unread counts are pushed to each user's personal channel after every flush
+unread_counters.emit = broadcaster.emit
+room_assistant.emit = broadcaster.emit
+# DMs to users connected here are delivered live and never queued for an email digest
+notification_digests.is_online = lambda user_id: next(sio.manager.get_participants("/", user_channel(user_id)), None) is not None
+# presence shared with the other workers is refreshed from the user channels held here
+online_users.local_users = lambda: [room.split(":", 1)[1] for room in sio.manager.rooms.get("/", {})
+                                    if isinstance(room, str) and room.startswith("user:")]
+
+
+async def _session_username(sid, session) -> str:
+    """Username for a socket session, looked up once and cached in the session."""
+    username = session.get("username")
+    if username is None:
+        user = await UserRepository().find_by_id(session.get("user_id"))
+        username = user.get("username", "Unknown User") if user else "Unknown User"
+        session["username"] = username
+        await sio.save_session(sid, session)
+    return username
+
+
+async def _rate_limited(sid, event: str, user_id) -> float:
+    """Take a token from the sid's and the user's bucket for `event`. Returns 0 when allowed,
+    otherwise the seconds to wait, after telling the client with an `error` event."""
+    rule = f"socket.{event}"
+    retry_after = 0.0
+    for scope, identity in (("sid", sid), ("user", user_id)):
+        allowed, wait = await rate_limiter.check(rule, scope, identity)
+        if not allowed:
+            retry_after = max(retry_after, wait)
+    if retry_after:
+        await sio.emit("error", {"event": event, "code": "rate_limited", "retry_after": round(retry_after, 2)}, to=sid)
+    return retry_after
 
 
 @sio.event
@@ -20,22 +86,41 @@ async def connect(sid, environ):
         payload = decode_token(token)
         user_id = payload.get("sub")
         await sio.save_session(sid, {"user_id": user_id})
+        # messages of all the user's rooms, unread counts and AI replies arrive on this channel
+        await sio.enter_room(sid, user_channel(user_id))
+        await online_users.connected(user_id)
         print(f"User {user_id} authenticated for SID {sid}")
     except Exception as e:
         print(f"Authentication failed for {sid}: {e}")
         await sio.disconnect(sid)
 
 
+@sio.event
+async def disconnect(sid, reason=None):
+    """Drop the user's presence on this worker once their last connection to it closes."""
+    session = await sio.get_session(sid)
+    user_id = session.get("user_id")
+    if not user_id:
+        return
+    # the closing connection is still in its rooms while this handler runs
+    if all(other == sid for other, _ in sio.manager.get_participants("/", user_channel(user_id))):
+        await online_users.disconnected(user_id)
+
+
 @sio.event
 async def join_room(sid, data):
+    """Join a room's presence: typing, read receipts and join notices. Messages do not need it,
+    they reach every member over their user channel."""
     room = data.get("room")
-    print(f"Received join_room event from SID {sid} for room: {room}")  # Debug log
     if room:
+        session = await sio.get_session(sid)
+        if await _rate_limited(sid, "join_room", session.get("user_id")):
+            return
         await sio.enter_room(sid, room)
-        print(f"SID {sid} successfully joined room {room}")
+        if overload.sheds(DEFER_PRESENCE):
+            return  # the join notice is presence chatter: skip it and its user lookups
 
         # Fetch the username of the user who joined
-        session = await sio.get_session(sid)
         user_id = session.get("user_id")
         user_repo = UserRepository()
         user = await user_repo.find_by_id(user_id)
@@ -57,22 +142,153 @@ async def join_room(sid, data):
             room_display = room
 
         # Notify the room about the new participant with the username
-        await sio.emit("system", {"message": f"{username} has joined the room {room_display}."}, room=room)
+        await broadcaster.emit("system", {"message": f"{username} has joined the room {room_display}."}, room=room)
 
 
 @sio.event
 async def message(sid, data):
-    print(f"Received message event from SID {sid} with data: {data}")  # Debug log
+    """Send a message: {"room": ..., "content": ..., "client_msg_id": ..., "attachments": [...]}.
+    Only members of the room may post to it."""
     session = await sio.get_session(sid)
     user_id = session.get("user_id")
-    print(f"User ID from session: {user_id}")  # Debug log
+    retry_after = await _rate_limited(sid, "message", user_id)
+    if retry_after:
+        return {"ok": False, "error": "rate_limited", "retry_after": round(retry_after, 2)}
 
-    room_id = data.get("room")
+    room_id = (data or {}).get("room")
+    if not isinstance(room_id, str):
+        return {"ok": False, "error": "invalid_room"}
+    if user_id not in await membership.members(room_id):
+        return {"ok": False, "error": "forbidden"}
     is_group = room_id.startswith("group:")
 
     chat_service = ChatService()
-    msg = await chat_service.post_message(room_id, user_id, data["content"], is_group)
-    print(f"Message processed and saved: {msg}")  # Debug log
-    # Emit the message to the room
-    await sio.emit("message", {"message": msg}, room=data["room"])
-    print(f"Message emitted to room {data['room']}")
\ No newline at end of file
+    try:
+        msg = await chat_service.post_message(room_id, user_id, data.get("content") or "", is_group,
+                                              client_msg_id=data.get("client_msg_id"),
+                                              attachments=data.get("attachments"))
+    except DuplicateMessage as dup:
+        # a retried send: already stored and broadcast, just acknowledge it again
+        return {"ok": True, "duplicate": True, "message": dup.message}
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}
+    typing_batcher.stop(room_id, user_id)
+    # Emit the message to the room and to every member's user channel, so members get it
+    # without having joined the room; unknown (unstored) rooms only reach those who joined them
+    targets = await membership.channels(room_id) if msg.get("seq") else room_id
+    await broadcaster.emit("message", {"message": msg}, room=targets)
+    if is_group and msg.get("seq") and room_assistant.mentioned(msg.get("content")):
+        await _invoke_room_ai(sid, room_id, user_id, msg)
+    return {"ok": True, "message": msg}
+
+
+async def _invoke_room_ai(sid, room_id: str, user_id: str, msg: dict):
+    """Start the room assistant's reply to a message that mentions it, unless refused."""
+    code, retry_after = None, 0.0
+    if overload.sheds(SHED_AI):
+        code, retry_after = "overloaded", overload.cooldown
+    elif room_assistant.busy(room_id):
+        code = "ai_busy"
+    else:
+        allowed, retry_after = await rate_limiter.check("chat.ai", "user", user_id)
+        if not allowed:
+            code = "rate_limited"
+    if code is None:
+        room_assistant.invoke(room_id, user_id, msg)
+        return
+    metrics.inc(f"room_ai.refused.{code}")
+    await sio.emit("error", {"event": "ai", "code": code, "retry_after": round(retry_after, 2)}, to=sid)
+
+
+async def _change_message(sid, event: str, data, **kwargs) -> dict:
+    """Shared body of edit_message/delete_message: apply the change and send the resulting
+    delta to the room's members as one `message_update`."""
+    session = await sio.get_session(sid)
+    user_id = session.get("user_id")
+    retry_after = await _rate_limited(sid, event, user_id)
+    if retry_after:
+        return {"ok": False, "error": "rate_limited", "retry_after": round(retry_after, 2)}
+    room_id = (data or {}).get("room")
+    if not isinstance(room_id, str):
+        return {"ok": False, "error": "invalid_room"}
+    try:
+        service = ChatService()
+        change = service.edit_message if event == "edit_message" else service.delete_message
+        update = await change(room_id, user_id, data.get("seq"), **kwargs)
+    except (ValueError, PermissionError) as e:
+        return {"ok": False, "error": str(e)}
+    await broadcaster.emit("message_update", update, room=await membership.channels(room_id))
+    return {"ok": True, "update": update}
+
+
+@sio.event
+async def edit_message(sid, data):
+    """Edit one of your messages: {"room": ..., "seq": ..., "content": ...}.
+    Members get a `message_update` {"room", "seq", "edit_seq", "content", "edited_at"}."""
+    return await _change_message(sid, "edit_message", data, content=(data or {}).get("content"))
+
+
+@sio.event
+async def delete_message(sid, data):
+    """Delete a message (yours, or any in a group you own): {"room": ..., "seq": ...}.
+    Members get a `message_update` {"room", "seq", "edit_seq", "deleted": true}."""
+    return await _change_message(sid, "delete_message", data)
+
+
+@sio.event
+async def sync(sid, data):
+    """Reconnect catch-up. Data: {"rooms": {room_id: last_seq}, "edits": {room_id: last_edit_seq}}.
+    Acknowledged with {"rooms": {room_id: {"messages": [...], "has_more": bool, "edits": [...]}}};
+    `edits` (update deltas, as in `message_update`) only for rooms listed in "edits".
+    """
+    session = await sio.get_session(sid)
+    if await _rate_limited(sid, "sync", session.get("user_id")):
+        return {"rooms": {}, "error": "rate_limited"}
+    rooms = (data or {}).get("rooms") or {}
+    if not isinstance(rooms, dict):
+        return {"rooms": {}}
+    return {"rooms": await ChatService().sync(session.get("user_id"), rooms, (data or {}).get("edits"))}
+
+
+@sio.event
+async def typing(sid, data):
+    """Typing indicator: {"room": ..., "typing": true|false}. Broadcast in batches; ignored for
+    rooms the user is not a member of."""
+    room = (data or {}).get("room")
+    if not room or not isinstance(room, str):
+        return
+    session = await sio.get_session(sid)
+    user_id = session.get("user_id")
+    if await _rate_limited(sid, "typing", user_id):
+        return
+    if user_id not in await membership.members(room):
+        return
+    if data.get("typing", True):
+        username = await _session_username(sid, session)
+        typing_batcher.touch(room, user_id, username)
+    else:
+        typing_batcher.stop(room, user_id)
+
+
+@sio.event
+async def read(sid, data):
+    """Read receipt: {"room": ..., "last_read_at": <ISO timestamp of newest message seen>}.
+    Ignored for rooms the user is not a member of."""
+    room = (data or {}).get("room")
+    if not room or not isinstance(room, str):
+        return
+    session = await sio.get_session(sid)
+    if await _rate_limited(sid, "read", session.get("user_id")):
+        return
+    if session.get("user_id") not in await membership.members(room):
+        return
+    now = datetime.utcnow()
+    try:
+        last_read_at = datetime.fromisoformat(data["last_read_at"]) if data.get("last_read_at") else now
+    except (TypeError, ValueError):
+        return
+    if last_read_at.tzinfo is not None:
+        # stored timestamps are naive UTC: convert before dropping the offset
+        last_read_at = last_read_at.astimezone(timezone.utc).replace(tzinfo=None)
+    receipt_buffer.mark_read(session.get("user_id"), room, min(last_read_at, now))
+    unread_counters.mark_read(session.get("user_id"), room)
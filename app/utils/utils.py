@@ -3,7 +3,11 @@ from datetime import datetime, timedelta
 from jose import jwt
 from .config import settings
 from typing import Any
+import hashlib
+import secrets
 from bson import ObjectId
+from starlette.responses import JSONResponse
+import orjson
 
 def normalize_doc(obj: Any, exclude: set[str] | None = None) -> Any:
     """Recursively convert ObjectId to str in documents returned from Motor.
@@ -30,6 +34,40 @@ def normalize_doc(obj: Any, exclude: set[str] | None = None) -> Any:
         return obj.isoformat()
     return obj
 
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_json(obj: Any) -> bytes:
+    """Serialize to compact JSON bytes without walking the document first.
+    Stray ObjectId/datetime values are handled by the encoder's default hook."""
+    return orjson.dumps(obj, default=_json_default)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse that encodes with orjson. Return it directly from a route to skip
+    FastAPI's jsonable_encoder pass over already JSON-ready documents."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+
+class fast_json:
+    """`json`-module lookalike handed to python-socketio so packets are encoded with orjson."""
+
+    @staticmethod
+    def dumps(obj: Any, *args, **kwargs) -> str:
+        return dumps_json(obj).decode("utf-8")
+
+    @staticmethod
+    def loads(s, *args, **kwargs) -> Any:
+        return orjson.loads(s)
+
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
@@ -47,5 +85,18 @@ def create_access_token(subject: str, expires_delta: int | None = None) -> str:
     return jwt.encode(to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm)
 
 
+def create_refresh_token(subject: str, family: str) -> str:
+    """Single-use refresh token. `fam` ties every token rotated from one login together,
+    `jti` makes each one unique."""
+    expire = datetime.utcnow() + timedelta(seconds=settings.refresh_token_expires_seconds)
+    to_encode = {"sub": subject, "exp": expire.timestamp(), "typ": "refresh", "fam": family, "jti": secrets.token_urlsafe(16)}
+    return jwt.encode(to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm)
+
+
+def hash_token(token: str) -> str:
+    """Digest stored and indexed instead of the raw token."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 def decode_token(token: str) -> dict[str, Any]:
     return jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
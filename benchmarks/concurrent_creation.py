@@ -0,0 +1,94 @@
+"""Concurrent DM / group creation: no duplicates, and what each creation costs.
+
+Fires `--parallel` simultaneous calls of
+
+  create_dm(a, b)                         (same pair every time)
+  join_or_create_group_by_name(name, u)   (same name, a different user each time)
+
+and checks that exactly one conversation / group exists afterwards, with every
+user counted once. Exits non-zero if a duplicate shows up.
+
+Needs a running MongoDB (MONGO_URI). Uses MONGO_DB=realtime_chat_bench unless set.
+
+    python -m benchmarks.concurrent_creation --parallel 200 --rounds 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from bson import ObjectId
+
+os.environ.setdefault("MONGO_DB", "realtime_chat_bench")
+
+from app.utils.repositories import ensure_indexes  # noqa: E402
+from app.services.chat_service import ChatService  # noqa: E402
+
+
+async def _timed(coro):
+    t = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - t
+
+
+async def one_round(service: ChatService, parallel: int) -> tuple[list, list, list]:
+    problems = []
+    a, b = str(ObjectId()), str(ObjectId())
+    dms = await asyncio.gather(*[_timed(service.create_dm(a, b) if i % 2 else service.create_dm(b, a))
+                                 for i in range(parallel)])
+    if len({d["_id"] for d, _ in dms}) != 1:
+        problems.append("create_dm returned different conversations")
+    stored = await service.convs.col.count_documents({"participant_ids": sorted([a, b])})
+    if stored != 1:
+        problems.append(f"{stored} conversations stored for one pair")
+
+    name = f"bench-{ObjectId()}"
+    users = [str(ObjectId()) for _ in range(parallel)]
+    groups = await asyncio.gather(*[_timed(service.join_or_create_group_by_name(name, u)) for u in users])
+    if len({g["_id"] for g, _ in groups}) != 1:
+        problems.append("join_or_create returned different groups")
+    if (stored := await service.groups.col.count_documents({"name": name})) != 1:
+        problems.append(f"{stored} groups stored under one name")
+    group = await service.groups.find_by_name(name)
+    members = await service.members.count(group["_id"])
+    if members != parallel or group.get("member_count") != parallel:
+        problems.append(f"{members} member docs / member_count {group.get('member_count')} for {parallel} joins")
+    owners = await service.members.col.count_documents({"group_id": group["_id"], "role": "owner"})
+    if owners != 1:
+        problems.append(f"{owners} owners")
+    return [t for _, t in dms], [t for _, t in groups], problems
+
+
+def _report(name: str, samples: list):
+    samples = sorted(s * 1000 for s in samples)
+    print(f"{name:<16} n={len(samples):<6} p50={samples[len(samples) // 2]:8.3f} ms  "
+          f"p99={samples[min(len(samples) - 1, int(0.99 * len(samples)))]:8.3f} ms  "
+          f"mean={statistics.fmean(samples):8.3f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parallel", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    await ensure_indexes()
+    service = ChatService()
+    dm_times, group_times, failures = [], [], []
+    for _ in range(args.rounds):
+        dms, groups, problems = await one_round(service, args.parallel)
+        dm_times += dms
+        group_times += groups
+        failures += problems
+    _report("create_dm", dm_times)
+    _report("join_or_create", group_times)
+    if failures:
+        print("DUPLICATES:", *sorted(set(failures)), sep="\n  ")
+        sys.exit(1)
+    print(f"ok: {args.rounds} rounds x {args.parallel} parallel calls, no duplicates")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""Cold-start cost of the application: import time (`-X importtime`) and RSS.
+
+Each scenario runs in a fresh interpreter so nothing is cached in-process:
+
+  app only:        import app.main (what every worker / serverless cold start pays)
+  app + AI stack:  import app.main, then load the AI service as the first /chat/ai call does
+
+    python -m benchmarks.import_time
+"""
+import os
+import subprocess
+import sys
+
+SCENARIOS = {
+    "app only": "import app.main",
+    "app + AI stack": "import app.main; from app.services import ai_loader; ai_loader._import_ai_service()",
+}
+
+_REPORT = "import resource; print('RSS_KB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+
+def _run(code: str) -> tuple[float, int, list[tuple[int, str]]]:
+    env = dict(os.environ)
+    # the AI clients refuse to construct without keys; values are irrelevant for import cost
+    env.setdefault("GROQ_API_KEY", "benchmark")
+    env.setdefault("TAVILY_API_KEY", "benchmark")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-W", "ignore", "-c", f"{code}; {_REPORT}"],
+        capture_output=True, text=True, env=env, check=True,
+    )
+    rss_kb = int(next(line.split()[1] for line in proc.stdout.splitlines() if line.startswith("RSS_KB")))
+    top_level = []
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented under the module that triggered them
+        if len(name) - len(name.lstrip()) == 1:
+            top_level.append((int(cumulative), name.strip()))
+            total_us += int(cumulative)
+    top_level.sort(reverse=True)
+    return total_us / 1e6, rss_kb, top_level
+
+
+def main():
+    for name, code in SCENARIOS.items():
+        seconds, rss_kb, top = _run(code)
+        print(f"{name}: {seconds:.2f}s import, {rss_kb / 1024:.0f} MiB max RSS")
+        for cumulative, module in top[:8]:
+            print(f"    {cumulative / 1e3:8.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
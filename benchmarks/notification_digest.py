@@ -0,0 +1,152 @@
+"""Offline-notification digests: throughput of one digest run against a local SMTP sink.
+
+Queues `--pending` notifications for `--pending / --per-user` offline users
+spread over `--domains` email domains, then times one digest run:
+
+  digest:    NotificationDigests.run   (one email per user, NOTIFY_SMTP_BATCH emails per connection)
+  per-email: send_smtp_email           (previous pattern: one connection per email, `--per-email` samples)
+
+The sink is a small threaded SMTP server in this process that accepts
+everything and counts connections and messages. `--rtt-ms` delays each of its
+replies to stand in for the network round trip to a real relay.
+
+Needs a running MongoDB (MONGO_URI). Uses MONGO_DB=realtime_chat_bench unless set.
+
+    python -m benchmarks.notification_digest --pending 100000
+    python -m benchmarks.notification_digest --pending 100000 --domain-rate 600/60:100   # with throttling
+"""
+import argparse
+import asyncio
+import os
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+
+class SinkStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.stats = SinkStats()
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def reply(self, *lines: str):
+        if self.server.rtt:
+            time.sleep(self.server.rtt)
+        self.wfile.write(b"".join(line.encode() + b"\r\n" for line in lines))
+
+    def handle(self):
+        stats = self.server.stats
+        with stats.lock:
+            stats.connections += 1
+        self.reply("220 sink ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb == b"EHLO":
+                self.reply("250-sink", "250 8BITMIME")
+            elif verb == b"DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with stats.lock:
+                    stats.messages += 1
+                self.reply("250 queued")
+            elif verb == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:  # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply("250 ok")
+
+
+async def load(repo, users, total: int, per_user: int, domains: int, batch: int = 10_000):
+    created_at = datetime.utcnow() - timedelta(hours=1)
+    user_ids = []
+    for start in range(0, total // per_user, batch):
+        docs = []
+        for i in range(start, min(start + batch, total // per_user)):
+            oid = ObjectId()
+            user_ids.append(str(oid))
+            docs.append({"_id": oid, "username": f"bench{i}", "email": f"bench{i}@domain{i % domains}.test"})
+        await users.col.insert_many(docs, ordered=False)
+    for start in range(0, total, batch):
+        await repo.insert_many([
+            {"user_id": user_ids[i // per_user], "room_id": f"dm:bench-{i // per_user}",
+             "sender_username": "sender", "preview": f"message {i}", "created_at": created_at}
+            for i in range(start, min(start + batch, total))
+        ])
+    return user_ids
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pending", type=int, default=100_000, help="queued notifications")
+    parser.add_argument("--per-user", type=int, default=5, help="notifications per user (one digest each)")
+    parser.add_argument("--domains", type=int, default=50)
+    parser.add_argument("--domain-rate", default="1000000/1", help="NOTIFY_DOMAIN_RATE for the run")
+    parser.add_argument("--connections", type=int, default=4, help="NOTIFY_SMTP_CONNECTIONS")
+    parser.add_argument("--smtp-batch", type=int, default=100, help="NOTIFY_SMTP_BATCH")
+    parser.add_argument("--per-email", type=int, default=500, help="emails timed with one connection each")
+    parser.add_argument("--rtt-ms", type=float, default=1.0, help="delay before every sink reply")
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.rtt_ms / 1000)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    os.environ.setdefault("MONGO_DB", "realtime_chat_bench")
+    os.environ.update({
+        "ZOHO_SMTP_SERVER": "127.0.0.1", "ZOHO_SMTP_PORT": str(sink.server_address[1]),
+        "ZOHO_SMTP_STARTTLS": "False", "ZOHO_EMAIL": "bench@sink.test", "ZOHO_APP_PASSWORD": "unused",
+        "NOTIFY_DOMAIN_RATE": args.domain_rate, "NOTIFY_SMTP_CONNECTIONS": str(args.connections),
+        "NOTIFY_SMTP_BATCH": str(args.smtp_batch), "NOTIFY_DIGEST_WINDOW_SECONDS": "60",
+    })
+    # imported only now: SMTP and notification settings are read from the environment at import
+    from app.services import email_service
+    from app.services.notification_service import notification_digests
+
+    repo, users = notification_digests.repo, notification_digests.users
+    await repo.ensure_indexes()
+    await repo.col.delete_many({})
+    print(f"queueing {args.pending:,} notifications for {args.pending // args.per_user:,} users "
+          f"over {args.domains} domains")
+    await load(repo, users, args.pending, args.per_user, args.domains)
+
+    t = time.perf_counter()
+    await notification_digests.run()
+    elapsed = time.perf_counter() - t
+    run = notification_digests.last_run
+    print(f"digest     {elapsed:8.2f} s  sent={run['sent']:,} failed={run['failed']:,} deferred={run['deferred']:,}  "
+          f"{args.pending / elapsed:,.0f} notifications/s  {run['sent'] / elapsed:,.0f} emails/s  "
+          f"smtp connections={sink.stats.connections:,}")
+    print(f"left in queue: {await repo.col.count_documents({}):,}")
+
+    if args.per_email:
+        connections, t = sink.stats.connections, time.perf_counter()
+        for i in range(args.per_email):
+            email_service.send_smtp_email(f"single{i}@domain0.test", "bench", "<p>bench</p>")
+        elapsed = time.perf_counter() - t
+        print(f"per-email  {elapsed:8.2f} s  sent={args.per_email:,}  {args.per_email / elapsed:,.0f} emails/s  "
+              f"smtp connections={sink.stats.connections - connections:,}")
+    await users.col.delete_many({"email": {"$regex": r"^bench\d+@"}})
+    sink.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
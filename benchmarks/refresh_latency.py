@@ -0,0 +1,106 @@
+"""/auth/refresh latency with a large `sessions` collection.
+
+Fills a scratch database with synthetic sessions, then times:
+
+  legacy:   find_one({"refresh_token": <raw jwt>})   (previous, unindexed lookup)
+  rotate:   AuthService.refresh on a live token       (digest index + rotation)
+  reuse:    AuthService.refresh on a rotated token    (replay spotted in memory, family revoked)
+  revoked:  the same token again                       (rejected from memory, no database hit)
+
+Needs a running MongoDB (MONGO_URI). Uses MONGO_DB=realtime_chat_bench unless set.
+
+    python -m benchmarks.refresh_latency --sessions 10000000
+    python -m benchmarks.refresh_latency --sessions 10000000 --skip-load   # reuse the loaded data
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import statistics
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("MONGO_DB", "realtime_chat_bench")
+
+from app.utils.db import connect  # noqa: E402
+from app.utils.repositories import SessionRepository  # noqa: E402
+from app.utils.utils import hash_token  # noqa: E402
+from app.services.auth_service import AuthService  # noqa: E402
+
+
+def _fake_token() -> str:
+    # same length/shape as a refresh JWT, without paying for HMAC on millions of rows
+    return f"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.{secrets.token_urlsafe(150)}.{secrets.token_urlsafe(32)}"
+
+
+async def load(col, total: int, batch: int):
+    expires = datetime.utcnow() + timedelta(days=7)
+    have = await col.estimated_document_count()
+    started = time.perf_counter()
+    while have < total:
+        n = min(batch, total - have)
+        docs = []
+        for _ in range(n):
+            raw = _fake_token()
+            docs.append({"user_id": secrets.token_hex(12), "refresh_token": raw, "token_hash": hash_token(raw),
+                         "family": secrets.token_hex(12), "expires_at": expires, "created_at": datetime.utcnow()})
+        await col.insert_many(docs, ordered=False)
+        have += n
+        if have % (batch * 50) == 0 or have == total:
+            rate = have / (time.perf_counter() - started)
+            print(f"  loaded {have:,} sessions ({rate:,.0f}/s)")
+
+
+def _report(name: str, samples: list):
+    samples = sorted(s * 1000 for s in samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]  # noqa: E731
+    print(f"{name:<8} n={len(samples):<6} p50={p(0.50):8.3f} ms  p95={p(0.95):8.3f} ms  "
+          f"p99={p(0.99):8.3f} ms  mean={statistics.fmean(samples):8.3f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10_000_000)
+    parser.add_argument("--samples", type=int, default=2000, help="timed refreshes")
+    parser.add_argument("--legacy-samples", type=int, default=10, help="timed unindexed lookups (each is a collection scan)")
+    parser.add_argument("--batch", type=int, default=10_000)
+    parser.add_argument("--skip-load", action="store_true")
+    args = parser.parse_args()
+
+    repo = SessionRepository()
+    await repo.ensure_indexes()
+    if not args.skip_load:
+        print(f"loading up to {args.sessions:,} sessions into {connect().name}.sessions")
+        await load(repo.col, args.sessions, args.batch)
+    print(f"sessions stored: {await repo.col.estimated_document_count():,}")
+
+    legacy = []
+    async for doc in repo.col.aggregate([{"$sample": {"size": args.legacy_samples}}, {"$project": {"refresh_token": 1}}]):
+        t = time.perf_counter()
+        assert await repo.col.find_one({"refresh_token": doc["refresh_token"]}) is not None
+        legacy.append(time.perf_counter() - t)
+    if legacy:
+        _report("legacy", legacy)
+
+    auth = AuthService()
+    live = [await auth._issue_refresh(secrets.token_hex(12), family=secrets.token_hex(12)) for _ in range(args.samples)]
+    rotate, reuse, revoked = [], [], []
+    for token in live:
+        t = time.perf_counter()
+        await auth.refresh(token)
+        rotate.append(time.perf_counter() - t)
+    for timings in (reuse, revoked):
+        for token in live:
+            t = time.perf_counter()
+            try:
+                await auth.refresh(token)
+            except ValueError:
+                pass
+            timings.append(time.perf_counter() - t)
+    _report("rotate", rotate)
+    _report("reuse", reuse)
+    _report("revoked", revoked)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+"""Repository read + JSON encode cost: `normalize_doc` walk vs. JSON-ready BSON decoding.
+
+Both paths start from the raw BSON bytes Motor receives off the wire:
+
+  baseline: bson.decode -> normalize_doc -> json.dumps   (previous behaviour)
+  fast:     bson.decode(JSON_READY_CODEC_OPTIONS) -> dumps_json
+
+    python -m benchmarks.serialization
+"""
+import json
+import timeit
+from datetime import datetime, timedelta
+import bson
+from bson import ObjectId
+from app.utils.db import JSON_READY_CODEC_OPTIONS
+from app.utils.utils import normalize_doc, dumps_json
+
+
+def _group(members: int, messages: int) -> dict:
+    start = datetime(2024, 5, 1)
+    member_ids = [str(ObjectId()) for _ in range(members)]
+    return {
+        "_id": ObjectId(),
+        "name": "release-planning",
+        "members": member_ids,
+        "created_at": start,
+        "seq": messages,
+        "last_message": {"_id": ObjectId(), "sender_id": member_ids[0], "content": "ship it", "created_at": start},
+        "messages": [
+            {"_id": ObjectId(), "seq": i + 1, "sender_id": member_ids[i % members], "sender_username": f"user{i % members}",
+             "content": f"message {i} about the rollout schedule", "created_at": start + timedelta(seconds=i)}
+            for i in range(messages)
+        ],
+    }
+
+
+DOCS = {
+    "user": {"_id": ObjectId(), "username": "ada", "email": "ada@example.com", "created_at": datetime(2024, 5, 1)},
+    "group (50 members, 200 msgs)": _group(50, 200),
+    "group (5k members, 1k msgs)": _group(5000, 1000),
+}
+
+
+def main():
+    print(f"{'document':<30} {'baseline us':>12} {'fast us':>10} {'speedup':>8}")
+    for name, doc in DOCS.items():
+        raw = bson.encode(doc)
+        number = max(20, 20000 // max(1, len(raw) // 100))
+        baseline = lambda: json.dumps(normalize_doc(bson.decode(raw)))  # noqa: E731
+        fast = lambda: dumps_json(bson.decode(raw, codec_options=JSON_READY_CODEC_OPTIONS))  # noqa: E731
+        assert json.loads(baseline()) == json.loads(fast())
+        t_base = timeit.timeit(baseline, number=number) / number * 1e6
+        t_fast = timeit.timeit(fast, number=number) / number * 1e6
+        print(f"{name:<30} {t_base:>12.1f} {t_fast:>10.1f} {t_base / t_fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
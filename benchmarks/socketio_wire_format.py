@@ -0,0 +1,60 @@
+"""Bytes on the wire and server CPU per message for each Socket.IO wire format.
+
+Encodes representative payloads the way the server does for a room broadcast
+(one Socket.IO EVENT packet) with the JSON and MessagePack packet classes, and
+compares raw size with permessage-deflate size (raw DEFLATE, as negotiated by
+WebSocket compression).
+
+    python -m benchmarks.socketio_wire_format
+"""
+import timeit
+import zlib
+from datetime import datetime, timedelta
+from socketio import packet, msgpack_packet
+
+
+def _message(seq: int, content: str) -> dict:
+    return {
+        "_id": "6650f1c2a1b2c3d4e5f6a7b8",
+        "chat_id": "group:6650f1c2a1b2c3d4e5f60001",
+        "seq": seq,
+        "sender_id": "6650f1c2a1b2c3d4e5f60002",
+        "sender_username": "ada",
+        "content": content,
+        "created_at": (datetime(2024, 5, 1) + timedelta(seconds=seq)).isoformat(),
+        "client_msg_id": "0b6f5d1e-3c1a-4c8e-9d55-0f2e8a7b9c10",
+    }
+
+
+PAYLOADS = {
+    "chat message": ("message", {"message": _message(42, "see you at 6?")}),
+    "typing batch": ("typing", {"room": "group:6650f1c2a1b2c3d4e5f60001",
+                                "users": [{"user_id": "6650f1c2a1b2c3d4e5f60002", "username": "ada"}]}),
+    "history page (50)": ("sync", {"rooms": {"group:6650f1c2a1b2c3d4e5f60001": {
+        "messages": [_message(i, f"message number {i} about the release plan") for i in range(50)],
+        "has_more": False}}}),
+    "AI reply (4 KB)": ("message", {"message": _message(43, ("The answer depends on the workload. " * 115)[:4096])}),
+}
+
+FORMATS = {"json": packet.Packet, "msgpack": msgpack_packet.MsgPackPacket}
+
+
+def _deflate(data: bytes) -> bytes:
+    c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+
+
+def main(number: int = 2000):
+    print(f"{'payload':<20} {'format':<8} {'bytes':>8} {'deflated':>9} {'encode us':>10} {'+deflate us':>12}")
+    for name, (event, data) in PAYLOADS.items():
+        for fmt, cls in FORMATS.items():
+            encode = lambda: cls(packet.EVENT, namespace="/", data=[event, data]).encode()  # noqa: E731
+            encoded = encode()
+            raw = encoded.encode() if isinstance(encoded, str) else encoded
+            encode_us = timeit.timeit(encode, number=number) / number * 1e6
+            deflate_us = timeit.timeit(lambda: _deflate(raw), number=number) / number * 1e6
+            print(f"{name:<20} {fmt:<8} {len(raw):>8} {len(_deflate(raw)):>9} {encode_us:>10.1f} {deflate_us:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
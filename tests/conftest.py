@@ -0,0 +1,37 @@
+"""Shared fixtures. Tests that need MongoDB use MONGO_URI with a throwaway database
+(MONGO_DB=realtime_chat_test unless set), dropped afterwards, and are skipped when no server answers."""
+import asyncio
+import os
+
+import pytest
+from pymongo.errors import PyMongoError
+
+os.environ.setdefault("MONGO_DB", "realtime_chat_test")
+
+from app.utils import db as database  # noqa: E402
+from app.utils.config import settings  # noqa: E402
+from app.utils.repositories import ensure_indexes  # noqa: E402
+
+
+@pytest.fixture
+def run_on_mongo():
+    """Run `scenario()` (a coroutine function) on a fresh event loop and a clean test database."""
+    def run(scenario):
+        async def main():
+            database.connect()
+            try:
+                await database.db.client.admin.command("ping")
+            except PyMongoError as e:
+                database.close()
+                pytest.skip(f"no MongoDB at {settings.mongo_uri}: {e}")
+            try:
+                await database.db.client.drop_database(settings.mongo_db)
+                await ensure_indexes()
+                await scenario()
+            finally:
+                await database.db.client.drop_database(settings.mongo_db)
+                database.close()
+
+        asyncio.run(main())
+
+    return run
@@ -0,0 +1,38 @@
+"""Concurrent DM and group creation against a real MongoDB (see conftest.run_on_mongo)."""
+import asyncio
+
+from bson import ObjectId
+
+from app.services.chat_service import ChatService
+
+PARALLEL = 50
+
+
+def test_parallel_create_dm_stores_one_conversation_per_pair(run_on_mongo):
+    async def scenario():
+        service = ChatService()
+        a, b = str(ObjectId()), str(ObjectId())
+        dms = await asyncio.gather(*[
+            service.create_dm(a, b) if i % 2 else service.create_dm(b, a) for i in range(PARALLEL)
+        ])
+        assert len({d["_id"] for d in dms}) == 1
+        assert await service.convs.col.count_documents({"participant_ids": sorted([a, b])}) == 1
+
+    run_on_mongo(scenario)
+
+
+def test_parallel_join_or_create_stores_one_group_with_one_owner(run_on_mongo):
+    async def scenario():
+        service = ChatService()
+        name = f"test-{ObjectId()}"
+        users = [str(ObjectId()) for _ in range(PARALLEL)]
+        groups = await asyncio.gather(*[service.join_or_create_group_by_name(name, u) for u in users])
+        assert len({g["_id"] for g in groups}) == 1
+        assert await service.groups.col.count_documents({"name": name}) == 1
+
+        group = await service.groups.find_by_name(name)
+        assert await service.members.count(group["_id"]) == PARALLEL
+        assert group["member_count"] == PARALLEL
+        assert await service.members.col.count_documents({"group_id": group["_id"], "role": "owner"}) == 1
+
+    run_on_mongo(scenario)
@@ -0,0 +1,83 @@
+"""The recent-message buffer must hand back messages exactly as stored."""
+from bson import ObjectId
+
+from app.services.chat_service import ChatService
+from app.utils.message_buffer import RecentMessageBuffer, recent_messages
+
+ROOM = "group:000000000000000000000001"
+REF = {"id": "0123456789abcdef01234567", "filename": "cat.png", "content_type": "image/png",
+       "size": 3, "sha256": "ab" * 32}
+
+
+def _msg(seq: int, **fields) -> dict:
+    return {"_id": f"m{seq}", "chat_id": ROOM, "seq": seq, "sender_id": "u1",
+            "content": f"message {seq}", "created_at": "2026-01-01T00:00:00", **fields}
+
+
+def _buffer() -> RecentMessageBuffer:
+    return RecentMessageBuffer(room_size=100, max_messages=1000, max_bytes=1 << 20)
+
+
+def test_latest_and_since_keep_attachments():
+    buffer = _buffer()
+    buffer.fill(ROOM, [_msg(1), _msg(2)], counters=(2, 0))
+    buffer.append(ROOM, _msg(3, attachments=[REF]))
+
+    latest = buffer.latest(ROOM, 10, counters=(3, 0))
+    since = buffer.since(ROOM, 2, 10, counters=(3, 0))
+    assert latest is not None and since is not None
+    assert latest[-1]["attachments"] == [REF]
+    assert since == [latest[-1]]
+    assert "attachments" not in latest[0]
+
+
+def test_returned_attachments_are_copies():
+    buffer = _buffer()
+    buffer.fill(ROOM, [_msg(1, attachments=[REF])], counters=(1, 0))
+    buffer.latest(ROOM, 10, counters=(1, 0))[0]["attachments"][0]["filename"] = "changed"
+    assert buffer.latest(ROOM, 10, counters=(1, 0))[0]["attachments"] == [REF]
+
+
+def test_attachments_count_towards_the_byte_cap():
+    with_ref, without = _buffer(), _buffer()
+    with_ref.fill(ROOM, [_msg(1, attachments=[REF])], counters=(1, 0))
+    without.fill(ROOM, [_msg(1)], counters=(1, 0))
+    assert with_ref.stats()["bytes"] > without.stats()["bytes"]
+
+
+def test_deleted_message_keeps_deleted_at():
+    buffer = _buffer()
+    buffer.fill(ROOM, [_msg(1, attachments=[REF])], counters=(1, 0))
+    tombstone = {k: v for k, v in _msg(1).items() if k != "content"}
+    buffer.update(ROOM, {**tombstone, "deleted": True, "deleted_at": "2026-01-02T00:00:00", "edit_seq": 1})
+
+    (msg,) = buffer.latest(ROOM, 10, counters=(1, 1))
+    assert msg["deleted"] is True
+    assert msg["deleted_at"] == "2026-01-02T00:00:00"
+    assert "content" not in msg and "attachments" not in msg
+
+
+async def _chunks():
+    yield b"cat"
+
+
+def test_posted_attachment_survives_buffered_history_and_sync(run_on_mongo):
+    async def scenario():
+        service = ChatService()
+        user = str(ObjectId())
+        group = await service.join_or_create_group_by_name(f"test-{ObjectId()}", user)
+        room = f"group:{group['_id']}"
+        ref = await service.attachments.upload(room, user, "cat.png", "image/png", _chunks())
+
+        await service.post_message(room, user, "hi", is_group=True)
+        await service.get_history(room, user)  # read from Mongo, so the buffer holds the room from here on
+        await service.post_message(room, user, "look", is_group=True, attachments=[ref["id"]])
+        hits = recent_messages.hits
+        history = await service.get_history(room, user)
+        synced = await service.sync(user, {room: 0})
+        assert recent_messages.hits == hits + 2  # both answered from the buffer
+
+        assert history["messages"][-1]["attachments"] == [ref]
+        assert synced[room]["messages"][-1]["attachments"] == [ref]
+
+    run_on_mongo(scenario)